@@ -20,17 +20,26 @@
 usage from a top directory, of after you install it as a module:
 
 $ python -mrepostats.tool -h
-usage: tool.py [-h] {stats,list} ...
+usage: tool.py [-h] {stats,serve,diff,errata,list} ...
 
 CDN Content Viewer
 
 positional arguments:
-  {stats,list}  commands to invoke
-    stats       Obtain stats for a repolabel: ex rhel-7-server-extras-rpms
-    list        List all repolabels that all found entitlements provide
+  {stats,serve,diff,errata,list}
+                        commands to invoke
+    stats               Obtain stats for a repolabel: ex rhel-7-server-extras-
+                        rpms
+    serve               Keep polling repos and serve their stats over http for
+                        Prometheus
+    diff                Show packages and errata added and removed between two
+                        recorded revisions of a repo
+    errata              Count or list errata of the repos kept with --errata-
+                        db, without going to the CDN
+    list                List all repolabels that all found entitlements
+                        provide
 
 optional arguments:
-  -h, --help    show this help message and exit
+  -h, --help            show this help message and exit
 """
 
 import logging
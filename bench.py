@@ -0,0 +1,528 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Time the metadata handlers on synthetic repodata, without an entitlement or
+the CDN: generates primary.xml, updateinfo.xml and primary.sqlite files of
+the given sizes, and a repomd.xml for them, then streams each through its
+handler the way CdnBrowser does, once per compression the CDN uses. Every
+case runs on a process of its own so its peak RSS is its own.
+
+usage to keep a baseline, and to check a change against it:
+
+$ python -mrepostats.bench --packages 1000 20000 --errata 5000 --save base.json
+$ python -mrepostats.bench --packages 1000 20000 --errata 5000 --compare base.json
+
+makeRepo() writes a whole repo with repodata/repomd.xml, to point a test
+CDN at.
+"""
+import os, sys, re, gc, bz2, gzip, json, time, random, shutil, hashlib, logging, resource, tempfile, subprocess
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, SUPPRESS
+from repostats.repomd import RepomdHandler, PrimaryStatsHandler, PrimaryDetailHandler, ErrataStatsHandler, PrimaryDbSqlHandler
+from repostats.consumers import ErrataSeverityConsumer, ErrataYearConsumer, CveConsumer
+from repostats.cdnbrowser import Decompressor, CHUNK_SIZE
+from repostats.parallel import ParallelSpool, ParsePool
+from repostats.instrument import peakRss
+
+log = logging.getLogger(__name__)
+
+SEED = 7
+# versions of every package name a repo keeps, like a channel that never drops updates
+VERSIONS = 4
+ARCHES = (('x86_64', 70), ('noarch', 25), ('i686', 5))
+TYPES = (('security', 40), ('bugfix', 40), ('enhancement', 20))
+SEVERITIES = ('Critical', 'Important', 'Moderate', 'Low')
+WORDS = ('lib', 'python', 'devel', 'tools', 'common', 'utils', 'data', 'core', 'server', 'client',
+	'perl', 'ruby', 'java', 'gtk', 'qt', 'kernel', 'firmware', 'doc', 'xml', 'ssl')
+# the second every generated file says it was made at
+EPOCH = 1476000000
+# a run repeats a case until it took this long, to time the small ones
+MIN_TIME = 0.5
+# a case is that much slower, or bigger, before compare calls it a regression
+TOLERANCE = 0.10
+# growth in peak RSS that is noise whatever the tolerance says
+RSS_SLACK = 1024
+
+def _weighted(rnd, choices):
+    n = rnd.randint(1, sum(w for (c, w) in choices))
+    for (c, w) in choices:
+	n -= w
+	if n <= 0:
+	    return c
+
+def _name(i):
+    return '{}-{}{}'.format(WORDS[i % len(WORDS)], WORDS[i // len(WORDS) % len(WORDS)], i)
+
+# the packages of a synthetic repo, the same ones for the same count
+def packages(count, seed=SEED):
+    rnd = random.Random(seed)
+    names = max(1, count // VERSIONS)
+    for i in xrange(count):
+	n = i % names
+	name = _name(n)
+	(ver, rel) = ('{}.{}.{}'.format(1 + n % 9, i // names, rnd.randint(0, 20)), '{}.el7'.format(rnd.randint(1, 40)))
+	yield {
+	    'key': i + 1, 'name': name, 'arch': _weighted(rnd, ARCHES), 'epoch': '0', 'ver': ver, 'rel': rel,
+	    'pkgid': hashlib.sha256('{}-{}-{}'.format(name, ver, rel)).hexdigest(),
+	    'build': EPOCH - rnd.randint(0, 5 * 365 * 86400), 'size': rnd.randint(2000, 50000000),
+	    'requires': [ _name(rnd.randint(0, names - 1)) for r in range(rnd.randint(1, 8)) ],
+	    'files': [ '/usr/{}/{}{}'.format(rnd.choice(('bin', 'lib64', 'share/doc')), name, f) for f in range(rnd.randint(1, 4)) ],
+	}
+
+PACKAGE = '''<package type="rpm">
+  <name>{name}</name>
+  <arch>{arch}</arch>
+  <version epoch="{epoch}" ver="{ver}" rel="{rel}"/>
+  <checksum type="sha256" pkgid="YES">{pkgid}</checksum>
+  <summary>The {name} package</summary>
+  <description>Provides {name}, built for {arch} from {name}-{ver}-{rel}.src.rpm.</description>
+  <packager>Red Hat, Inc. &lt;http://bugzilla.redhat.com/bugzilla&gt;</packager>
+  <url>http://www.example.com/{name}</url>
+  <time file="{file_time}" build="{build}"/>
+  <size package="{size}" installed="{installed}" archive="{archive}"/>
+  <location href="Packages/{initial}/{name}-{ver}-{rel}.{arch}.rpm"/>
+  <format>
+    <rpm:license>GPLv2+</rpm:license>
+    <rpm:vendor>Red Hat, Inc.</rpm:vendor>
+    <rpm:group>System Environment/Libraries</rpm:group>
+    <rpm:buildhost>x86-041.build.eng.bos.redhat.com</rpm:buildhost>
+    <rpm:sourcerpm>{name}-{ver}-{rel}.src.rpm</rpm:sourcerpm>
+    <rpm:header-range start="4504" end="{header_end}"/>
+    <rpm:provides>
+      <rpm:entry name="{name}" flags="EQ" epoch="{epoch}" ver="{ver}" rel="{rel}"/>
+      <rpm:entry name="{name}({arch})" flags="EQ" epoch="{epoch}" ver="{ver}" rel="{rel}"/>
+    </rpm:provides>
+    <rpm:requires>
+{requires_xml}    </rpm:requires>
+{files_xml}  </format>
+</package>
+'''
+
+def _elements(text):
+    return text.count('<') - text.count('</') - text.count('<?')
+
+# counts the elements of the xml written through it
+class _Writer(object):
+    def __init__(self, f):
+	self.f = f
+	self.elements = 0
+
+    def write(self, text):
+	self.elements += _elements(text)
+	self.f.write(text)
+
+def writePrimary(f, count, header=True, seed=SEED):
+    w = _Writer(f)
+    w.write('<?xml version="1.0" encoding="UTF-8"?>\n<metadata xmlns="http://linux.duke.edu/metadata/common"'
+	    ' xmlns:rpm="http://linux.duke.edu/metadata/rpm"{}>\n'.format(' packages="{}"'.format(count) if header else ''))
+    for p in packages(count, seed):
+	w.write(PACKAGE.format(initial=p['name'][0], file_time=p['build'] + 3600, installed=p['size'] * 3,
+		archive=p['size'] * 3 + 1024, header_end=4504 + p['size'] % 60000,
+		requires_xml=''.join('      <rpm:entry name="{}"/>\n'.format(r) for r in p['requires']),
+		files_xml=''.join('    <file>{}</file>\n'.format(f) for f in p['files']), **p))
+    w.write('</metadata>\n')
+    return w.elements
+
+UPDATE = '''<update from="release-engineering@redhat.com" status="final" type="{type}" version="2">
+  <id>{id}</id>
+  <title>{title}</title>
+  <issued date="{issued}"/>
+  <updated date="{issued}"/>
+  <rights>Copyright {year} Red Hat Inc</rights>
+  <release>Red Hat Enterprise Linux 7</release>
+{severity}  <summary>Updated packages that fix several issues are now available.</summary>
+  <description>The {name} packages have been upgraded to a newer upstream version.</description>
+  <solution>Before applying this update, make sure all previously released errata relevant to your system have been applied.</solution>
+  <references>
+    <reference href="https://access.redhat.com/errata/{id}" id="{id}" type="self" title="{id}"/>
+{references}  </references>
+  <pkglist>
+    <collection short="">
+      <name>Red Hat Enterprise Linux 7</name>
+{packages}    </collection>
+  </pkglist>
+</update>
+'''
+
+def writeUpdateinfo(f, count, seed=SEED):
+    rnd = random.Random(seed)
+    w = _Writer(f)
+    w.write('<?xml version="1.0" encoding="UTF-8"?>\n<updates>\n')
+    for i in xrange(count):
+	t = _weighted(rnd, TYPES)
+	year = 2002 + i * 15 // max(count, 1)
+	name = _name(rnd.randint(0, max(count // 2, 1)))
+	refs = [ '    <reference href="https://bugzilla.redhat.com/{0}" id="{0}" type="bugzilla" title="bug {0}"/>\n'.format(rnd.randint(100000, 1999999))
+		for r in range(rnd.randint(1, 4)) ]
+	if t == 'security':
+	    refs += [ '    <reference href="https://access.redhat.com/security/cve/{0}" id="{0}" type="cve" title="{0}"/>\n'.format(
+		'CVE-{}-{}'.format(year - rnd.randint(0, 1), rnd.randint(1000, 20000))) for r in range(rnd.randint(1, 6)) ]
+	pkgs = [ ('      <package name="{0}" version="1.{1}" release="{2}.el7" epoch="0" arch="{3}" src="{0}-1.{1}-{2}.el7.src.rpm">\n'
+		'        <filename>{0}-1.{1}-{2}.el7.{3}.rpm</filename>\n        <sum type="sha256">{4}</sum>\n      </package>\n').format(
+		    name, i, r, _weighted(rnd, ARCHES), hashlib.sha256('{}{}'.format(i, r)).hexdigest()) for r in range(rnd.randint(1, 10)) ]
+	# epoch seconds in some old updateinfo files instead of a date
+	issued = str(EPOCH - (2016 - year) * 31536000) if i % 50 == 0 else '{}-{:02d}-{:02d} 00:00:00'.format(year, 1 + i % 12, 1 + i % 28)
+	w.write(UPDATE.format(type=t, year=year, name=name, issued=issued,
+		id='{}-{}:{:04d}'.format({ 'security': 'RHSA', 'bugfix': 'RHBA', 'enhancement': 'RHEA' }[t], year, i % 10000),
+		title='{} {} update'.format(name, t), references=''.join(refs), packages=''.join(pkgs),
+		severity='  <severity>{}</severity>\n'.format(rnd.choice(SEVERITIES)) if t == 'security' else ''))
+    w.write('</updates>\n')
+    return w.elements
+
+# what createrepo puts in a primary.sqlite, version 10
+PRIMARY_DB = '''
+CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+CREATE TABLE packages ( pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT, version TEXT, epoch TEXT,
+    release TEXT, summary TEXT, description TEXT, url TEXT, time_file INTEGER, time_build INTEGER, rpm_license TEXT,
+    rpm_vendor TEXT, rpm_group TEXT, rpm_buildhost TEXT, rpm_sourcerpm TEXT, rpm_header_start INTEGER,
+    rpm_header_end INTEGER, rpm_packager TEXT, size_package INTEGER, size_installed INTEGER, size_archive INTEGER,
+    location_href TEXT, location_base TEXT, checksum_type TEXT);
+CREATE TABLE provides ( name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER );
+CREATE TABLE requires ( name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER , pre BOOLEAN DEFAULT FALSE);
+CREATE TABLE files ( name TEXT, type TEXT, pkgKey INTEGER);
+CREATE INDEX packagename ON packages (name);
+CREATE INDEX packageId ON packages (pkgId);
+CREATE INDEX providesname ON provides (name);
+CREATE INDEX requiresname ON requires (name);
+CREATE INDEX filenames ON files (name);
+'''
+
+def writePrimaryDb(path, count, seed=SEED):
+    import sqlite3
+    if os.path.exists(path):
+	os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+	conn.executescript(PRIMARY_DB)
+	conn.execute('insert into db_info values (10, ?)', ('0' * 64,))
+	for p in packages(count, seed):
+	    (key, nevr) = (p['key'], (p['epoch'], p['ver'], p['rel']))
+	    conn.execute('insert into packages values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+		key, p['pkgid'], p['name'], p['arch'], p['ver'], p['epoch'], p['rel'], 'The {} package'.format(p['name']),
+		'Provides {}.'.format(p['name']), 'http://www.example.com/' + p['name'], p['build'] + 3600, p['build'],
+		'GPLv2+', 'Red Hat, Inc.', 'System Environment/Libraries', 'x86-041.build.eng.bos.redhat.com',
+		'{}-{}-{}.src.rpm'.format(p['name'], p['ver'], p['rel']), 4504, 4504 + p['size'] % 60000,
+		'Red Hat, Inc.', p['size'], p['size'] * 3, p['size'] * 3 + 1024,
+		'Packages/{}/{}-{}-{}.{}.rpm'.format(p['name'][0], p['name'], p['ver'], p['rel'], p['arch']), None, 'sha256'))
+	    conn.executemany('insert into provides values (?, ?, ?, ?, ?, ?)',
+		    [ (n, 'EQ') + nevr + (key,) for n in (p['name'], '{}({})'.format(p['name'], p['arch'])) ])
+	    conn.executemany('insert into requires (name, pkgKey) values (?, ?)', [ (r, key) for r in p['requires'] ])
+	    conn.executemany('insert into files values (?, ?, ?)', [ (f, 'file', key) for f in p['files'] ])
+	conn.commit()
+    finally:
+	conn.close()
+    return count
+
+OPENERS = { '': open, '.gz': gzip.open, '.bz2': bz2.BZ2File }
+
+def compress(src, dst):
+    ext = os.path.splitext(dst)[1]
+    with open(src, 'rb') as f_in:
+	f_out = OPENERS[ext](dst, 'wb')
+	try:
+	    shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+	finally:
+	    f_out.close()
+
+def _sums(path):
+    (digest, size) = (hashlib.sha256(), 0)
+    with open(path, 'rb') as f_in:
+	for data in iter(lambda: f_in.read(CHUNK_SIZE), ''):
+	    digest.update(data)
+	    size += len(data)
+    return (digest.hexdigest(), size)
+
+REPOMD_DATA = '''<data type="{type}">
+  <checksum type="sha256">{checksum}</checksum>
+  <open-checksum type="sha256">{open_checksum}</open-checksum>
+  <location href="{href}"/>
+  <timestamp>{timestamp}</timestamp>
+{database}  <size>{size}</size>
+  <open-size>{open_size}</open-size>
+</data>
+'''
+
+# a repo at path with primary.xml.gz, primary.sqlite.bz2, updateinfo.xml.gz
+# and a repomd.xml for them, named by checksum like createrepo does
+def makeRepo(path, count, errata, header=True, timestamp=EPOCH, seed=SEED):
+    repodata = os.path.join(path, 'repodata')
+    if not os.path.isdir(repodata):
+	os.makedirs(repodata)
+    files = []
+    for (kind, name) in (('primary', 'primary.xml.gz'), ('primary_db', 'primary.sqlite.bz2'), ('updateinfo', 'updateinfo.xml.gz')):
+	if kind == 'updateinfo' and not errata:
+	    continue
+	open_path = os.path.join(repodata, os.path.splitext(name)[0])
+	if kind == 'primary':
+	    with open(open_path, 'wb') as f_out:
+		writePrimary(f_out, count, header, seed)
+	elif kind == 'updateinfo':
+	    with open(open_path, 'wb') as f_out:
+		writeUpdateinfo(f_out, errata, seed)
+	else:
+	    writePrimaryDb(open_path, count, seed)
+	tmp = os.path.join(repodata, name)
+	compress(open_path, tmp)
+	(open_checksum, open_size) = _sums(open_path)
+	os.remove(open_path)
+	(checksum, size) = _sums(tmp)
+	href = 'repodata/{}-{}'.format(checksum, name)
+	os.rename(tmp, os.path.join(path, href))
+	files.append(REPOMD_DATA.format(type=kind, checksum=checksum, open_checksum=open_checksum, href=href,
+		timestamp=timestamp, size=size, open_size=open_size,
+		database='  <database_version>10</database_version>\n' if kind == 'primary_db' else ''))
+    with open(os.path.join(repodata, 'repomd.xml'), 'wb') as f_out:
+	f_out.write('<?xml version="1.0" encoding="UTF-8"?>\n<repomd xmlns="http://linux.duke.edu/metadata/repo"'
+		' xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n  <revision>{}</revision>\n'.format(timestamp))
+	f_out.write(''.join(files))
+	f_out.write('</repomd>\n')
+    return os.path.join(repodata, 'repomd.xml')
+
+def _errataDetail(pool):
+    handler = ErrataStatsHandler()
+    for c in (ErrataSeverityConsumer, ErrataYearConsumer, CveConsumer):
+	handler.addConsumer(c())
+    return handler
+
+# what each case streams its file through; None only decompresses it
+HANDLERS = {
+	'repomd': lambda pool: RepomdHandler(),
+	'primary-fast': lambda pool: PrimaryStatsHandler(True),
+	'primary': lambda pool: PrimaryStatsHandler(False),
+	'primary-detail': lambda pool: PrimaryDetailHandler(),
+	'primary-parallel': lambda pool: ParallelSpool(PrimaryStatsHandler(False), pool),
+	'primary_db': lambda pool: PrimaryDbSqlHandler(),
+	'primary_db-detail': lambda pool: PrimaryDbSqlHandler(True),
+	'errata': lambda pool: ErrataStatsHandler(),
+	'errata-detail': _errataDetail,
+	'decompress': lambda pool: None,
+	}
+
+# feed path through handler in the chunks a download comes in
+def stream(handler, path):
+    unz = Decompressor(path)
+    opened = 0
+    if handler is not None:
+	handler.begin()
+    with open(path, 'rb') as f_in:
+	while handler is None or not handler.done:
+	    data = f_in.read(CHUNK_SIZE)
+	    if not data:
+		break
+	    data = unz.decompress(data)
+	    opened += len(data)
+	    if data and handler is not None:
+		handler.feed(data)
+    if handler is not None and not handler.done:
+	data = unz.flush()
+	opened += len(data)
+	if data:
+	    handler.feed(data)
+    if handler is not None:
+	handler.finish()
+    return opened
+
+# times one case, on the process it was started on for it
+def runCase(case, repeat=3, processes=2):
+    factory = HANDLERS[case['handler']]
+    # made once, like stats does, so the fork is not part of every parse
+    pool = ParsePool(processes) if case['handler'] == 'primary-parallel' else None
+    try:
+	return _runCase(case, factory, pool, repeat)
+    finally:
+	if pool is not None:
+	    pool.close()
+
+def _runCase(case, factory, pool, repeat):
+    best = None
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    runs = 0
+    for r in range(repeat):
+	(elapsed, n) = (0, 0)
+	while n == 0 or elapsed < MIN_TIME:
+	    ts = time.time()
+	    handler = factory(pool)
+	    opened = stream(handler, case['path'])
+	    elapsed += time.time() - ts
+	    if handler is not None and handler.failed:
+		raise ValueError('{}: {} failed to parse {}'.format(case['name'], handler.cls, case['path']))
+	    # a handler and its parser point at each other; do not let them pile up
+	    handler = None
+	    gc.collect()
+	    n += 1
+	elapsed /= n
+	best = elapsed if best is None else min(best, elapsed)
+	runs += n
+    # python 2 has no tracemalloc; new pages touched are the closest thing
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+    return { 'name': case['name'], 'seconds': best, 'elements': case['elements'], 'bytes': opened,
+	    'elements_per_second': case['elements'] / best, 'mb_per_second': opened / best / 1048576,
+	    'rss_kb': peakRss(), 'faults': faults // runs }
+
+# the files a case list needs, made in work unless they already are
+def prepare(work, sizes, errata):
+    counts_path = os.path.join(work, 'elements.json')
+    counts = {}
+    if os.path.exists(counts_path):
+	with open(counts_path) as f_in:
+	    counts = json.load(f_in)
+    def make(name, write):
+	path = os.path.join(work, name)
+	if name not in counts or not os.path.exists(path):
+	    log.warn('Generating %s', name)
+	    if name.endswith('.sqlite'):
+		counts[name] = write(path)
+	    else:
+		with open(path, 'wb') as f_out:
+		    counts[name] = write(f_out)
+	return path
+    def packed(name, ext):
+	path = os.path.join(work, name + ext)
+	if not os.path.exists(path):
+	    log.warn('Compressing %s%s', name, ext)
+	    compress(os.path.join(work, name), path)
+	return path
+    files = []
+    for n in sizes:
+	for header in (True, False):
+	    name = 'primary-{}{}.xml'.format(n, '' if header else '-noheader')
+	    make(name, lambda f, n=n, header=header: writePrimary(f, n, header))
+	    files.append((name, '.gz'))
+	    if not header:
+		files += [ (name, ''), (name, '.bz2') ]
+	name = 'primary-{}.sqlite'.format(n)
+	make(name, lambda p, n=n: writePrimaryDb(p, n))
+	files.append((name, '.bz2'))
+    for n in errata:
+	name = 'updateinfo-{}.xml'.format(n)
+	make(name, lambda f, n=n: writeUpdateinfo(f, n))
+	files.append((name, '.gz'))
+    paths = dict(((name, ext), packed(name, ext) if ext else os.path.join(work, name)) for (name, ext) in files)
+    if not os.path.exists(os.path.join(work, 'repo', 'repodata', 'repomd.xml')):
+	makeRepo(os.path.join(work, 'repo'), min(sizes or [1000]), min(errata or [1000]))
+    with open(counts_path, 'w') as f_out:
+	json.dump(counts, f_out)
+    return (paths, counts)
+
+def cases(work, sizes, errata, processes):
+    (paths, counts) = prepare(work, sizes, errata)
+    def case(handler, name, ext):
+	# the fast count stops at the header, so the file's elements say
+	# nothing about it; it goes by the bytes it opened instead
+	elements = 0 if handler == 'primary-fast' else counts[name]
+	return { 'name': '{} {}{}'.format(handler, name, ext), 'handler': handler,
+		'path': paths[(name, ext)], 'elements': elements }
+    repomd = os.path.join(work, 'repo', 'repodata', 'repomd.xml')
+    with open(repomd) as f_in:
+	elements = _elements(f_in.read())
+    out = [ { 'name': 'repomd repomd.xml', 'handler': 'repomd', 'path': repomd, 'elements': elements } ]
+    for n in sizes:
+	(xml, bare, db) = ('primary-{}.xml'.format(n), 'primary-{}-noheader.xml'.format(n), 'primary-{}.sqlite'.format(n))
+	out.append(case('primary-fast', xml, '.gz'))
+	out += [ case('primary', bare, ext) for ext in ('', '.gz', '.bz2') ]
+	out.append(case('primary-detail', bare, '.gz'))
+	if processes > 1:
+	    out.append(case('primary-parallel', bare, '.gz'))
+	out += [ case('primary_db', db, '.bz2'), case('primary_db-detail', db, '.bz2') ]
+	out += [ case('decompress', bare, '.gz'), case('decompress', bare, '.bz2') ]
+    for n in errata:
+	xml = 'updateinfo-{}.xml'.format(n)
+	out += [ case('errata', xml, '.gz'), case('errata-detail', xml, '.gz') ]
+    return out
+
+# runs case on a process of its own, so the peak RSS is the case's alone
+def runIsolated(case, repeat, processes):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+    proc = subprocess.Popen([ sys.executable, '-m', 'repostats.bench', '--case', json.dumps(case),
+	'--repeat', str(repeat), '--processes', str(processes) ], stdout=subprocess.PIPE, env=env)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+	raise RuntimeError('{}: benchmark process exited with {}'.format(case['name'], proc.returncode))
+    return json.loads(out.strip().splitlines()[-1])
+
+def _change(new, old):
+    return (new - old) / float(old) if old else 0
+
+# prints how results moved from baseline; the number of regressions
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = 0
+    print '{:<44} {:>10} {:>10}'.format('case', 'speed', 'peak rss')
+    for r in results:
+	base = baseline.get(r['name'])
+	if base is None:
+	    print '{:<44} {:>10}'.format(r['name'], 'new')
+	    continue
+	# decompression has no elements, only bytes
+	key = 'mb_per_second' if r['elements'] == 0 or r['name'].startswith('decompress') else 'elements_per_second'
+	(speed, rss) = (_change(r[key], base[key]), _change(r['rss_kb'], base['rss_kb']))
+	slower = speed < -tolerance
+	bigger = rss > tolerance and r['rss_kb'] - base['rss_kb'] > RSS_SLACK
+	print '{:<44} {:>+9.1f}% {:>+9.1f}%{}'.format(r['name'], speed * 100, rss * 100,
+		'  REGRESSION' if slower or bigger else '')
+	regressions += slower or bigger
+    return regressions
+
+def main():
+    parser = ArgumentParser(description='Time the metadata handlers on synthetic repodata', formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--packages', type=int, nargs='*', default=[1000, 20000], help='primary.xml and primary.sqlite sizes to try, in packages')
+    parser.add_argument('--errata', type=int, nargs='*', default=[5000], help='updateinfo.xml sizes to try, in errata')
+    parser.add_argument('--only', help='only run the cases matching this regex')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case to take the fastest of')
+    parser.add_argument('--processes', type=int, default=2, help='processes for the parallel primary.xml parse; 1 to skip it')
+    parser.add_argument('--work-dir', help='keep the generated files here to reuse them next time; default a temp dir')
+    parser.add_argument('--save', help='write the results to this file, to compare with later')
+    parser.add_argument('--compare', help='compare the results with the ones saved in this file')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='fraction slower or bigger a case can get before it is a regression')
+    parser.add_argument('--case', help=SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARN, format='%(message)s')
+
+    if args.case is not None:
+	print json.dumps(runCase(json.loads(args.case), args.repeat, args.processes))
+	return 0
+
+    work = args.work_dir or tempfile.mkdtemp(prefix='repostats-bench-')
+    if not os.path.isdir(work):
+	os.makedirs(work)
+    try:
+	todo = cases(work, args.packages, args.errata, args.processes)
+	if args.only is not None:
+	    todo = [ c for c in todo if re.search(args.only, c['name']) ]
+	results = []
+	print '{:<44} {:>9} {:>12} {:>8} {:>8} {:>8}'.format('case', 'elements', 'elements/s', 'MB/s', 'rss MB', 'faults')
+	for case in todo:
+	    r = runIsolated(case, args.repeat, args.processes)
+	    results.append(r)
+	    print '{:<44} {:>9} {:>12} {:>8.1f} {:>8.1f} {:>8}'.format(r['name'], r['elements'] or '-',
+		    '{:.0f}'.format(r['elements_per_second']) if r['elements'] else '-', r['mb_per_second'], r['rss_kb'] / 1024.0, r['faults'])
+    finally:
+	if args.work_dir is None:
+	    shutil.rmtree(work, True)
+    if args.save is not None:
+	with open(args.save, 'w') as f_out:
+	    json.dump({ 'python': sys.version.split()[0], 'results': dict((r['name'], r) for r in results) }, f_out, indent=1, sort_keys=True)
+    if args.compare is not None:
+	with open(args.compare) as f_in:
+	    baseline = json.load(f_in)['results']
+	print
+	if compare(results, baseline, args.tolerance):
+	    return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
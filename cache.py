@@ -0,0 +1,130 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+# 
+# This file is part of repostats
+# 
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import os, json, time, logging, tempfile, threading
+from repostats.costmodel import CostModel
+
+log = logging.getLogger(__name__)
+
+MAX_REPOS = 512
+# bump whenever handlers start computing a result differently
+VERSION = 2
+
+def defaultCacheDir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'repostats')
+
+def writeJson(path, obj):
+    # write to a temp file next to the target and rename it, so a reader in
+    # another process never sees a half written file
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+	os.makedirs(d)
+    (fd, tmp) = tempfile.mkstemp(dir=d, prefix='.' + os.path.basename(path))
+    try:
+	with os.fdopen(fd, 'w') as f_out:
+	    json.dump(obj, f_out)
+	os.rename(tmp, path)
+    except:
+	os.remove(tmp)
+	raise
+
+def readJson(path, default):
+    try:
+	with open(path, 'r') as f_in:
+	    return json.load(f_in)
+    except (IOError, OSError):
+	return default
+    except ValueError, ex:
+	log.warn('Ignoring corrupt cache file %s: %s', path, ex)
+	return default
+
+# Results of previous runs, per repo url. Every repo keeps the last repomd.xml
+# we saw with its ETag/Last-Modified validators, and the handler results for
+# the files it pointed at, keyed by the checksum repomd advertised for them.
+class StatsCache(object):
+    def __init__(self, cachedir=None, max_repos=MAX_REPOS):
+	self.path = os.path.join(cachedir or defaultCacheDir(), 'stats.json')
+	self.max_repos = max_repos
+	self.lock = threading.Lock()
+	cached = readJson(self.path, {})
+	self.repos = {}
+	if cached.get('version') == VERSION:
+	    self.repos = cached['repos']
+	# the cost model learns from every run, so keep it with the results
+	self.model = CostModel(cached.get('model'))
+	log.debug('Loaded %d cached repos from %s', len(self.repos), self.path)
+
+    def _repo(self, url):
+	repo = self.repos.get(url)
+	if repo is not None:
+	    repo['atime'] = time.time()
+	return repo
+
+    def getRepomd(self, url):
+	with self.lock:
+	    return self._repo(url)
+
+    def putRepomd(self, url, etag, modified, body, revision, checksums):
+	with self.lock:
+	    repo = self.repos.get(url) or { 'results': {} }
+	    if 'revision' in repo and repo['revision'] != revision:
+		log.info('Repo revision changed from %s to %s: %s', repo.get('revision'), revision, url)
+	    # drop results for files the new revision no longer points at
+	    results = dict((k, v) for (k, v) in repo['results'].items() if checksums.get(k) == v['checksum'])
+	    repo.update({ 'etag': etag, 'modified': modified, 'repomd': body,
+		'revision': revision, 'results': results, 'atime': time.time() })
+	    self.repos[url] = repo
+
+    def getResult(self, url, key, checksum):
+	if checksum is None:
+	    return None
+	with self.lock:
+	    repo = self._repo(url)
+	    if repo is None:
+		return None
+	    result = repo['results'].get(key)
+	    if result is None or result['checksum'] != checksum:
+		return None
+	    return result['result']
+
+    def putResult(self, url, key, checksum, result):
+	if checksum is None:
+	    return
+	with self.lock:
+	    repo = self.repos.get(url)
+	    if repo is None:
+		return
+	    previous = repo['results'].get(key)
+	    if previous is not None and previous['checksum'] == checksum:
+		previous['result'].update(result)
+	    else:
+		repo['results'][key] = { 'checksum': checksum, 'result': result }
+
+    def evict(self):
+	if len(self.repos) <= self.max_repos:
+	    return
+	lru = sorted(self.repos.keys(), key=lambda u: self.repos[u].get('atime', 0))
+	for url in lru[:len(self.repos) - self.max_repos]:
+	    log.debug('Evicting %s from cache', url)
+	    del self.repos[url]
+
+    def save(self):
+	with self.lock:
+	    self.evict()
+	    writeJson(self.path, { 'version': VERSION, 'repos': self.repos, 'model': self.model.dump() })
+	log.debug('Saved %d cached repos to %s', len(self.repos), self.path)
@@ -16,114 +16,658 @@
 # You should have received a copy of the GNU General Public License along with
 # repostats.  If not, see <http://www.gnu.org/licenses/>.
 
-import requests, gzip, logging, time, bz2, os, tempfile
-from repostats.repomd import RepomdHandler, PrimaryStatsHandler, ErrataStatsHandler, PrimaryDbSqlHandler
+import zlib, logging, time, bz2, sys, re, hashlib, tempfile, threading
+from repostats.pool import runPool
+from repostats.costmodel import CostModel, codecOf
+from repostats.parallel import ParallelSpool
+from repostats.instrument import Tracer, takeConnectTime
+from repostats.sessions import defaultPool
+from repostats.retry import RetryPolicy, HttpError, hedge, retryAfter, MIN_HEDGE_DELAY, MAX_RETRY_AFTER, THROTTLE_STATUS
+from repostats.limiter import PRIORITY_REPOMD
+from repostats.repomd import RepomdHandler, PrimaryStatsHandler, PrimaryDetailHandler, ErrataStatsHandler, PrimaryDbSqlHandler
 
 log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 102400
+# files smaller than this are not worth splitting into byte ranges
+RANGE_MIN = 32 * 1048576
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+class Decompressor(object):
+    # incremental decompressor picked from the file suffix of a repomd href
+    def __init__(self, href):
+	self.unz = None
+	if href.endswith('.gz'):
+	    # +16 tells zlib to expect a gzip header and trailer
+	    self.unz = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	elif href.endswith('.bz2'):
+	    self.unz = bz2.BZ2Decompressor()
+
+    def decompress(self, data):
+	if self.unz is None:
+	    return data
+	return self.unz.decompress(data)
+
+    def flush(self):
+	if getattr(self.unz, 'flush', None) is None:
+	    return ''
+	return self.unz.flush()
+
+# a download that does not match what repomd.xml says about it
+class ChecksumError(IOError):
+    pass
+
+# incremental digest of a stream, checked against a repomd checksum at the end
+class Digest(object):
+    # yum calls sha1 sha
+    NAMES = { 'sha': 'sha1' }
+
+    def __init__(self, what, checksum_type, checksum):
+	self.what = what
+	self.checksum = checksum
+	self.hash = None
+	if checksum_type is not None and checksum is not None:
+	    try:
+		self.hash = hashlib.new(self.NAMES.get(checksum_type, checksum_type))
+	    except ValueError:
+		log.warn('Unable to verify %s checksum of type %s', what, checksum_type)
+
+    def update(self, data):
+	if self.hash is not None:
+	    self.hash.update(data)
+
+    def verify(self, href):
+	if self.hash is None:
+	    return
+	digest = self.hash.hexdigest()
+	if digest != self.checksum.lower():
+	    raise ChecksumError('{}: {} checksum {} does not match {} from repomd.xml'.format(href, self.what, digest, self.checksum))
+	log.debug('%s: %s checksum verified', href, self.what)
+
+    # hash whatever is left of f and verify it
+    def drain(self, f, href):
+	if self.hash is None:
+	    return
+	data = f.read(CHUNK_SIZE)
+	while data:
+	    self.hash.update(data)
+	    data = f.read(CHUNK_SIZE)
+	self.verify(href)
+
+# One data file on its way into its handler: checks it against repomd.xml,
+# keeps a copy in the blob store and times every stage. Whoever does the
+# reading calls feed() with every compressed chunk until done, then finish(),
+# or fail() if anything went wrong, and close() in the end.
+class Transfer(object):
+    def __init__(self, browser, key, target, blob):
+	self.browser = browser
+	self.key = key
+	self.target = target
+	self.blob = blob
+	self.href = getattr(browser.repomd, key)
+	# only a download that went through in full ends up in the store
+	self.tee = blob is not None and not blob.exists
+	self.stored = blob is not None and blob.exists
+	self.unz = Decompressor(self.href)
+	# verified on the same chunks the parse reads, so a bad file fails
+	# before its result can be cached or its blob stored
+	self.data_file = browser.repomd.keys[key]
+	self.digests = (Digest('compressed', self.data_file.checksum_type, self.data_file.checksum),
+		Digest('open', self.data_file.open_checksum_type, self.data_file.open_checksum))
+	(self.xfer, self.opened) = (0, 0)
+	# bytes a previous download left in the store, and whether to keep
+	# what this one adds to them if it fails too
+	(self.offset, self.keep) = (0, False)
+	# the place the download holds in the host's limit, if it has one
+	self.slot = None
+	# time spent in each stage, to tune the cost model with
+	(self.t_read, self.t_sum, self.t_unz, self.t_feed) = (0, 0, 0, 0)
+	self.process_start = time.time()
+	log.debug('streaming %s through %s', self.href, target.cls)
+	target.begin()
+
+    @property
+    def done(self):
+	return self.target.done
+
+    # headers to ask for the rest of what a previous download left in the store
+    def resumeHeaders(self):
+	if not self.tee:
+	    return {}
+	(offset, validators) = self.blob.partial()
+	if offset <= 0 or (self.data_file.size is not None and offset >= self.data_file.size):
+	    return {}
+	self.offset = offset
+	# good to resume from until it turns out otherwise
+	self.keep = True
+	headers = { 'range': 'bytes={}-'.format(offset) }
+	# only a strong etag can tell the server our bytes are still good
+	etag = validators.get('etag')
+	if etag and not etag.startswith('W/'):
+	    headers['if-range'] = etag
+	elif validators.get('modified'):
+	    headers['if-range'] = validators['modified']
+	return headers
+
+    # check the response to a request made with resumeHeaders(); if it
+    # continues where the stored bytes end, those go through first
+    def accept(self, status, headers):
+	validators = { 'etag': headers.get('etag'), 'modified': headers.get('last-modified') }
+	if self.offset and status == 206:
+	    try:
+		m = CONTENT_RANGE.match(headers.get('content-range') or '')
+		if m is None or int(m.group(1)) != self.offset or (self.data_file.size is not None
+			and m.group(3) != '*' and int(m.group(3)) != self.data_file.size):
+		    raise IOError('{}: asked for bytes {}- and got {}'.format(self.href, self.offset, headers.get('content-range')))
+		log.info('Resuming %s at byte %d of %s', self.href, self.offset, self.data_file.size)
+		with self.blob.openPart() as f_part:
+		    left = self.offset
+		    while left > 0 and not self.done:
+			data = f_part.read(min(CHUNK_SIZE, left))
+			if not data:
+			    raise IOError('{}: partial download shrank'.format(self.blob.part))
+			left -= len(data)
+			self.feed(data, False)
+	    except:
+		# the part is no good to resume from, and nothing of this
+		# download goes to the store; drop the part rather than
+		# replay it on every run for the next week
+		(self.tee, self.keep) = (False, False)
+		raise
+	    self.blob.start(self.offset, validators)
+	    return
+	if self.offset:
+	    log.info('%s changed since the partial download, starting over', self.href)
+	    self.offset = 0
+	if self.tee:
+	    self.blob.start(0, validators)
+
+    def feed(self, data, tee=True):
+	self.xfer += len(data)
+	if self.data_file.size is not None and self.xfer > self.data_file.size:
+	    raise ChecksumError('{}: more than the {} bytes repomd.xml says it has'.format(self.href, self.data_file.size))
+	ts = time.time()
+	self.digests[0].update(data)
+	self.t_sum += time.time() - ts
+	if self.tee and tee:
+	    self.blob.write(data)
+	ts = time.time()
+	data = self.unz.decompress(data)
+	self.t_unz += time.time() - ts
+	if data:
+	    ts = time.time()
+	    self.digests[1].update(data)
+	    self.t_sum += time.time() - ts
+	    self.opened += len(data)
+	    ts = time.time()
+	    self.target.feed(data)
+	    self.t_feed += time.time() - ts
+	return self.target.done
+
+    def finish(self):
+	ts = time.time()
+	if self.target.done:
+	    log.debug('%s has all it needs, dropping the rest of %s', self.target.cls, self.href)
+	    # what a previous download left is still good for a full read
+	    self.keep = self.offset > 0
+	else:
+	    data = self.unz.flush()
+	    if data:
+		self.digests[1].update(data)
+		self.opened += len(data)
+		self.target.feed(data)
+	    if self.data_file.size is not None and self.xfer != self.data_file.size:
+		# cut short rather than bad, so what did come in can be resumed
+		raise IOError('{}: got {} of the {} bytes repomd.xml says it has'.format(self.href, self.xfer, self.data_file.size))
+	    for d in self.digests:
+		d.verify(self.href)
+	self.target.finish()
+	self.t_feed += time.time() - ts
+	if self.tee and not self.target.done:
+	    self.blob.commit()
+
+    # re-raises exc, after dropping a stored blob it was caused by going bad on disk
+    def fail(self, exc, raw=None):
+	self.target.abort()
+	# bytes that did not fail a checksum are good to resume from
+	self.keep = self.tee and not isinstance(exc[1], ChecksumError)
+	if self.stored and raw is not None and isinstance(exc[1], Exception):
+	    # a stored file that breaks the parse may have gone bad on disk
+	    try:
+		if not isinstance(exc[1], ChecksumError):
+		    self.digests[0].drain(raw, self.href)
+	    except ChecksumError:
+		exc = sys.exc_info()
+	    if isinstance(exc[1], ChecksumError):
+		log.warn('Removing corrupt %s from store', self.blob.path)
+		self.blob.remove()
+	raise exc[0], exc[1], exc[2]
+
+    # size of the download, and of the file what it adds to
+    @property
+    def priority(self):
+	return (self.data_file.size or 0) + 1
+
+    def close(self):
+	if self.slot is not None:
+	    self.slot.release(self.xfer - self.offset)
+	    self.slot = None
+	if self.blob is None:
+	    return
+	self.blob.release(self.keep)
+	self.blob = None
+	if self.tee:
+	    self.browser.store.evict()
+
+    # account for a finished transfer, and hand back its handler
+    def complete(self):
+	(browser, key, handler) = (self.browser, self.key, getattr(self.browser, self.key))
+	ts = time.time() - self.process_start
+	log.debug('%s transfered %d bytes (%d uncompressed) in %.3f seconds for a rate of %.3f mbs',
+		key, self.xfer, self.opened, ts, self.xfer / ts * 8 / 1000000)
+	log.info('Processed %d entries in %.3f seconds for a total rate of %.1f entries per second',
+		handler.value, ts, handler.value / ts)
+	if not self.stored:
+	    browser.model.observe('download', self.xfer - self.offset, self.t_read)
+	browser.model.observe(codecOf(self.href), self.opened, self.t_unz)
+	if not self.target.done:
+	    browser.model.observe(key, self.opened, self.t_feed)
+	t_query = getattr(handler, 't_query', 0)
+	browser.tracer.record(browser.url, key, 'download', self.t_read, bytes=self.xfer - self.offset, stored=self.stored, resumed=self.offset)
+	browser.tracer.record(browser.url, key, 'checksum', self.t_sum, bytes=self.xfer + self.opened)
+	browser.tracer.record(browser.url, key, 'decompress', self.t_unz, bytes=self.opened)
+	browser.tracer.record(browser.url, key, 'parse', self.t_feed - t_query, bytes=self.opened, entries=handler.value, early=self.target.done)
+	if key == 'primary_db':
+	    browser.tracer.record(browser.url, key, 'sqlite', t_query, entries=handler.value)
+	if browser.cache is not None and not handler.failed:
+	    browser.cache.putResult(browser.url, key, browser.repomd.checksums.get(key), handler.result())
+	return handler
+
+# One byte range of a file, downloaded to a temp file on a thread of its own.
+# It goes under the place the first range holds in the host's limit for the
+# whole transfer: waiting for places of their own while that one is held
+# could wait forever once the limit is down to it.
+class RangePart(threading.Thread):
+    def __init__(self, browser, transfer, first, last):
+	super(RangePart, self).__init__(name='range-{}'.format(first))
+	self.daemon = True
+	(self.browser, self.href, self.key) = (browser, transfer.href, transfer.key)
+	(self.first, self.last) = (first, last)
+	(self.priority, self.slot) = (transfer.priority, transfer.slot)
+	# when it last got anywhere
+	self.ts = time.time()
+	self.f_part = tempfile.TemporaryFile()
+	self.error = None
+	(self.stopped, self.finished) = (False, False)
+	self.lock = threading.Lock()
+
+    def run(self):
+	try:
+	    headers = { 'range': 'bytes={}-{}'.format(self.first, self.last) }
+	    resp = self.browser.retry.call(lambda: self._get(headers), self.href)
+	    try:
+		m = CONTENT_RANGE.match(resp.headers.get('content-range') or '')
+		if resp.status_code != 206 or m is None or int(m.group(1)) != self.first or int(m.group(2)) != self.last:
+		    raise IOError('{}: asked for bytes {}-{} and got {} {}'.format(self.href, self.first, self.last,
+			resp.status_code, resp.headers.get('content-range')))
+		data = resp.raw.read(CHUNK_SIZE)
+		while data and not self.stopped:
+		    self.f_part.write(data)
+		    self.ts = time.time()
+		    data = resp.raw.read(CHUNK_SIZE)
+	    finally:
+		resp.close()
+	except Exception:
+	    self.error = sys.exc_info()
+	finally:
+	    with self.lock:
+		self.finished = True
+		if self.stopped:
+		    self.f_part.close()
+
+    def _get(self, headers):
+	self.ts = time.time()
+	return self.browser._get(self.href, headers, self.key, self.priority, self.slot)
+
+    # stop it; its temp file goes as soon as the thread is done with it
+    def discard(self):
+	with self.lock:
+	    self.stopped = True
+	    if self.finished:
+		self.f_part.close()
+
+# Reads like a response body, over the first byte range as it comes in and
+# then over each of the others as soon as its thread has all of it
+class RangeReader(object):
+    def __init__(self, browser, transfer, first, ranges):
+	self.current = first
+	# longest a part can go without getting anywhere: a request timing
+	# out, and the longest wait before asking again
+	self.stall = sum(browser.retry.timeout) + max(browser.retry.max_backoff, MAX_RETRY_AFTER)
+	self.parts = [ RangePart(browser, transfer, a, b) for (a, b) in ranges ]
+	for part in self.parts:
+	    part.start()
+	self.waiting = list(self.parts)
+
+    def read(self, size):
+	while True:
+	    data = self.current.read(size)
+	    if data or not self.waiting:
+		return data
+	    part = self.waiting.pop(0)
+	    # join with a timeout so a KeyboardInterrupt still gets through
+	    while part.is_alive():
+		part.join(1)
+		if part.is_alive() and time.time() - part.ts > self.stall:
+		    raise IOError('{}: bytes {}-{} got nowhere for {:.0f} seconds'.format(part.href, part.first, part.last, self.stall))
+	    if part.error is not None:
+		raise part.error[0], part.error[1], part.error[2]
+	    self.current.close()
+	    part.f_part.seek(0)
+	    self.current = part.f_part
+
+    def close(self):
+	self.current.close()
+	for part in self.parts:
+	    part.discard()
+
 class CdnBrowser(object):
-    def __init__(self, url, cert, key, cacert):
+    def __init__(self, url, cert, key, cacert, cache=None, fast=True, verify=False, detail=False, parallel=None, store=None, tracer=None, sessions=None, ranges=0, retry=None):
 	self.url = url
 	self.cert = cert
 	self.key = key
 	self.cacert = cacert
-	self.session = requests.Session()
+	self.cache = cache
+	self.store = store
+	self.model = cache.model if cache is not None else CostModel()
+	self.primary_choice = None
+	# timing spans for every file this fetches; see repostats.instrument
+	self.tracer = tracer if tracer is not None else Tracer()
+	# shared with every other browser for the same host and cert
+	self.sessions = sessions if sessions is not None else defaultPool()
+	self.session = self.sessions.get(url, cert, key, cacert)
+	# timeouts, retries and hedging of requests to the CDN
+	self.retry = retry if retry is not None else RetryPolicy()
+	self.latency = self.sessions.latency(url)
+	self.limiter = self.sessions.limiter(url)
+	(self.fast, self.verify, self.detail) = (fast, verify, detail)
 	self.repomd = RepomdHandler()
-	self.primary = PrimaryStatsHandler()
+	self.reset()
+	# byte ranges to fetch big files in at the same time
+	self.ranges = ranges
+	# ParsePool to parse primary.xml on, when every package has to be read
+	self.parallel = parallel if detail or verify or not fast else None
+
+    # start every handler over; their consumers have to be added again
+    def reset(self):
+	self.primary = PrimaryDetailHandler() if self.detail else PrimaryStatsHandler(self.fast, self.verify)
 	self.errata = ErrataStatsHandler()
-	self.primary_db = PrimaryDbSqlHandler()
+	self.primary_db = PrimaryDbSqlHandler(self.detail)
+	self.primary_choice = None
 
-    def _get(self, partial_url):
+    # fetch repomd.xml again, and reset() if it points at different files.
+    # True if it did
+    def refresh(self):
+	previous = self.repomd
+	self.repomd = RepomdHandler()
+	self.getRepomd()
+	if previous.initialized and previous.checksums == self.repomd.checksums:
+	    return False
+	log.info('Repo revision is now %s: %s', self.repomd.revision, self.url)
+	self.reset()
+	return True
+
+    # priority orders requests waiting for a place in the host's limit; the
+    # response holds that place until _release(), or until it is not ok.
+    # With shared, it goes under that place instead, which its holder releases
+    def _get(self, partial_url, headers=None, name=None, priority=PRIORITY_REPOMD, shared=None):
 	full_url = '/'.join((self.url, partial_url))
 	log.info('Processing url: %s', full_url)
+	req_headers = { 'accept-encoding': 'identity'}
+	if headers:
+	    req_headers.update(headers)
+	slot = shared
+	if slot is None and self.limiter is not None:
+	    slot = self.limiter.acquire(priority)
+	takeConnectTime()
 	ts=time.time()
-	resp = self.session.get(url=full_url, verify=self.cacert, cert=(self.cert, self.key), stream=True, headers={ 'accept-encoding': 'identity'})
+	try:
+	    resp = self.session.get(url=full_url, verify=self.cacert, cert=(self.cert, self.key), stream=True, headers=req_headers, timeout=self.retry.timeout)
+	except:
+	    if slot is not None and shared is None:
+		slot.release()
+	    raise
 	ts=time.time() - ts
+	resp.slot = slot if shared is None else None
+	self.model.observeLatency(ts)
+	t_connect = takeConnectTime()
+	self.sessions.count(t_connect is not None)
+	if t_connect is not None:
+	    self.tracer.record(self.url, name, 'connect', t_connect)
+	self.tracer.record(self.url, name, 'ttfb', ts - (t_connect or 0), status=resp.status_code, reused=t_connect is None)
 	xfer = int(resp.headers.get('content-length', 0))
 	log.debug('Obtained reponse in %-3f seconds; will xfer %d bytes in a bit.', ts, xfer)
 	if not resp.ok:
-	    raise IOError("{} {}: {}".format(full_url, resp.status_code, resp.reason))
-	return resp.raw
+	    resp.close()
+	    retry_after = retryAfter(resp.headers.get('retry-after'))
+	    if slot is not None:
+		if resp.status_code in THROTTLE_STATUS:
+		    slot.throttled(retry_after)
+		if shared is None:
+		    slot.release()
+	    raise HttpError("{} {}: {}".format(full_url, resp.status_code, resp.reason), resp.status_code, retry_after)
+	if slot is not None:
+	    slot.answered()
+	return resp
 
-    def getRepomd(self):
-	if self.repomd.initialized:
-	    return self.repomd
-	raw_xml = self._get('/repodata/repomd.xml')
+    # give back the place resp holds in the host's limit, after nbytes of body
+    def _release(self, resp, nbytes=0):
+	if resp.slot is not None:
+	    resp.slot.release(nbytes)
+
+    # the cached repomd.xml if any, and the validators to ask for a newer one with
+    def _repomdRequest(self):
+	cached = None
+	headers = {}
+	if self.cache is not None:
+	    cached = self.cache.getRepomd(self.url)
+	if cached is not None:
+	    if cached.get('etag'):
+		headers['if-none-match'] = cached['etag']
+	    if cached.get('modified'):
+		headers['if-modified-since'] = cached['modified']
+	return (cached, headers)
+
+    # parse repomd.xml from a response body, or from the cache on a 304
+    def _repomdResponse(self, cached, status, etag, modified, body):
+	if status == 304:
+	    log.info('repomd.xml not modified since last run: %s', self.url)
+	    body = cached['repomd'].encode('utf-8')
+	    etag = etag or cached.get('etag')
+	    modified = modified or cached.get('modified')
 	ts=time.time()
-	self.repomd.parse(raw_xml)
+	self.repomd.begin()
+	self.repomd.feed(body)
+	self.repomd.finish()
 	if self.repomd.primary is None:
 	    log.warn('Are you sure this is a yum repo? %s', self.url)
 	    raise ImportError('repomd.xml did not contain location url for primary files!')
 	if self.repomd.errata is None:
 	    log.warn("Repo doesn't have any errata: %s", self.url)
 	ts=time.time() - ts
+	self.tracer.record(self.url, 'repomd', 'parse', ts, bytes=len(body), entries=len(self.repomd.files))
 	log.debug('Processed repomd.xml file in %.3f seconds', ts)
+	if self.cache is not None:
+	    self.cache.putRepomd(self.url, etag, modified, body, self.repomd.revision, self.repomd.checksums)
 	return self.repomd
 
+    def getRepomd(self):
+	if self.repomd.initialized:
+	    return self.repomd
+	(cached, headers) = self._repomdRequest()
+	(status, resp_headers, body) = self.retry.call(lambda: self._fetchRepomd(headers), '/'.join((self.url, 'repodata/repomd.xml')))
+	return self._repomdResponse(cached, status, resp_headers.get('etag'), resp_headers.get('last-modified'), body)
+
+    # one go at repomd.xml, hedged with a second request if it takes longer
+    # than the policy's percentile of recent ones to the same host
+    def _fetchRepomd(self, headers):
+	delay = None
+	if self.retry.hedge:
+	    delay = self.latency.percentile(self.retry.hedge)
+	if delay is None:
+	    return self._getRepomd(headers)
+	(result, hedged, won) = hedge(lambda: self._getRepomd(headers), max(delay, MIN_HEDGE_DELAY), self.url)
+	if hedged:
+	    self.latency.count(won)
+	return result
+
+    def _getRepomd(self, headers):
+	resp = self._get('/repodata/repomd.xml', headers, 'repomd')
+	body = ''
+	# from the request going out, not from when it got a place in the limit
+	ts = time.time() - resp.elapsed.total_seconds()
+	try:
+	    if resp.status_code != 304:
+		t_read = time.time()
+		body = resp.raw.read()
+		self.tracer.record(self.url, 'repomd', 'download', time.time() - t_read, bytes=len(body))
+	finally:
+	    resp.close()
+	    self._release(resp, len(body))
+	self.latency.observe(time.time() - ts)
+	return (resp.status_code, resp.headers, body)
+
+    # restore handler key from the result cache; True if it could
+    def _restore(self, key):
+	handler = getattr(self, key)
+	checksum = self.repomd.checksums.get(key)
+	# a cached result can not stand in for the cross-check --verify asks for
+	if self.cache is None or getattr(handler, 'verify', False):
+	    return False
+	result = self.cache.getResult(self.url, key, checksum)
+	# a --detail result also answers a plain count, but not the other way around
+	if result is None or not all(k in result for k in handler.resultKeys()):
+	    return False
+	log.info('Using cached %s result for checksum %s', key, checksum)
+	handler.restore(result)
+	self.tracer.record(self.url, key, 'cache', 0, entries=handler.value)
+	return True
+
+    # start streaming data file key into its handler; the caller feeds it
+    # what it reads from the CDN, or from transfer.blob if that is stored
+    def _transfer(self, key, wait=True):
+	blob = None
+	if self.store is not None:
+	    # if another process is downloading the same file, this waits for it
+	    blob = self.store.acquire(self.repomd.checksums.get(key), wait)
+	target = getattr(self, key)
+	if key == 'primary' and self.parallel is not None and not target.consumers:
+	    target = ParallelSpool(target, self.parallel)
+	return Transfer(self, key, target, blob)
+
     def getHandler(self, key):
 	handler = getattr(self, key)
 	if handler.initialized:
 	    return handler
-	href = getattr(self.getRepomd(), key)
-	process_start = time.time()
-	ts = time.time()
-	raw_gz = self._get(href)
-	suffix_tmpl = '-{}.xml.gz' if href.endswith('.gz') else '-{}.xml.bz2'
-	f_download = tempfile.mkstemp(suffix=suffix_tmpl.format(key))
-	tmps = [ f_download ]
+	self.getRepomd()
+	if self._restore(key):
+	    return handler
+	transfer = self._transfer(key)
 	try:
-	    with os.fdopen(f_download[0], 'w+b') as f_out:
-		log.debug('writing out file from %s', href)
-		while True:
-		    data = raw_gz.read(102400)
-		    if not data:
-			break
-		    f_out.write(data)
-		f_out.flush()
-		xfer = f_out.tell()
-
-	    ts = time.time() - ts
-	    log.debug('%s.xml.gz transfered %d bytes in %.3f seconds for a rate of %.3f mbs',
-		    key, xfer, ts, xfer / ts * 8 / 1000000)
-	    f_uncompress = tempfile.mkstemp()
-	    tmps.insert(0, f_uncompress)
-	    ts = time.time()
-	    f_in = None
-	    if href.endswith('.gz'):
-		f_in = gzip.GzipFile(f_download[1], mode='rb')
+	    if transfer.stored:
+		log.info('Using stored %s for %s', transfer.blob.path, transfer.href)
+		raw = transfer.blob.open()
 	    else:
-		f_in = bz2.BZ2File(f_download[1], mode='rb')
-
-	    os.remove(f_download[1])
-	    tmps.pop()
-	    with f_in:
-		with os.fdopen(f_uncompress[0], 'r+w') as f_out:
-		    log.info('uncompressing file from %s to %s', f_download[1], f_uncompress[1])
-		    f_out.write(f_in.read())
-		    xfer = f_in.tell()
-
-	    ts = time.time() - ts
-	    log.debug('+ Uncompressed %d bytes in %.3f seconds for a rate of %.3f mbs',
-		    xfer, ts, xfer / ts * 8 / 1000000)
-	    handler.parse(f_uncompress[1])
-	    ts = time.time() - ts
+		headers = transfer.resumeHeaders()
+		size = transfer.data_file.size
+		if not headers and self.ranges > 1 and size is not None and size >= RANGE_MIN:
+		    raw = self._getRanges(transfer)
+		else:
+		    resp = self.retry.call(lambda: self._get(transfer.href, headers, key, transfer.priority), transfer.href)
+		    transfer.slot = resp.slot
+		    try:
+			transfer.accept(resp.status_code, resp.headers)
+		    except:
+			resp.close()
+			raise
+		    raw = resp.raw
+	except:
+	    transfer.close()
+	    raise
+	return self._stream(transfer, raw)
+
+    # fetch transfer's file as self.ranges byte ranges at once
+    def _getRanges(self, transfer):
+	(size, parts) = (transfer.data_file.size, self.ranges)
+	step = (size + parts - 1) // parts
+	ranges = [ (a, min(a + step, size) - 1) for a in range(0, size, step) ]
+	headers = { 'range': 'bytes={}-{}'.format(*ranges[0]) }
+	resp = self.retry.call(lambda: self._get(transfer.href, headers, transfer.key, transfer.priority), transfer.href)
+	transfer.slot = resp.slot
+	try:
+	    transfer.accept(resp.status_code, resp.headers)
+	except:
+	    resp.close()
+	    raise
+	if resp.status_code != 206:
+	    log.info('%s does not do byte ranges, fetching %s in one go', self.url, transfer.href)
+	    return resp.raw
+	m = CONTENT_RANGE.match(resp.headers.get('content-range') or '')
+	if m is None or int(m.group(1)) != 0 or int(m.group(2)) != ranges[0][1]:
+	    resp.close()
+	    raise IOError('{}: asked for bytes {}-{} and got {}'.format(transfer.href, ranges[0][0], ranges[0][1], resp.headers.get('content-range')))
+	log.info('Fetching %s as %d byte ranges', transfer.href, len(ranges))
+	return RangeReader(self, transfer, resp.raw, ranges[1:])
 
+    # read raw into transfer until it is done
+    def _stream(self, transfer, raw):
+	try:
+	    try:
+		while not transfer.done:
+		    ts = time.time()
+		    data = raw.read(CHUNK_SIZE)
+		    transfer.t_read += time.time() - ts
+		    if not data:
+			break
+		    transfer.feed(data)
+		transfer.finish()
+	    except:
+		transfer.fail(sys.exc_info(), raw)
 	finally:
-	    for t in tmps:
-		try:
-		    os.remove(t[1])
-		except:
-		    pass
-		try:
-		    os.close(t[0])
-		except:
-		    pass
-
-	process_end = time.time()
-	log.info('Processed %d entries in %.3f seconds for a total rate of %.1f entries per second',
-		handler.value,
-		process_end - process_start,
-		handler.value / (process_end - process_start))
-	return handler
+	    raw.close()
+	    transfer.close()
+	return transfer.complete()
+
+    # have consumer get its results from the same parse as handler key
+    def addConsumer(self, key, consumer):
+	return getattr(self, key).addConsumer(consumer)
+
+    # pick primary or primary_db, whichever the cost model expects to be cheapest
+    def choosePrimary(self, fast=True):
+	repomd = self.getRepomd()
+	candidates = dict((k, repomd.keys[k]) for k in ('primary', 'primary_db') if k in repomd.keys)
+	self.primary_choice = self.model.choose(candidates, fast)
+	log.info('Using %s for the package count; %s', *self.primary_choice)
+	return self.primary_choice[0]
+
+    # fetch all the given handlers at the same time, returns once all are done
+    def prefetch(self, *keys):
+	self.getRepomd()
+	keys = [ k for k in keys if not getattr(self, k).initialized ]
+	errors = []
+	def fetch(key):
+	    try:
+		self.getHandler(key)
+	    except Exception:
+		errors.append(sys.exc_info())
+	if len(keys) > 1:
+	    log.debug('Prefetching %s', ', '.join(keys))
+	    runPool(fetch, keys, len(keys))
+	else:
+	    map(fetch, keys)
+	if errors:
+	    raise errors[0][0], errors[0][1], errors[0][2]
+	return [ getattr(self, k) for k in keys ]
 
     def getErrata(self):
 	return self.getHandler('errata')
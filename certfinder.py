@@ -16,7 +16,7 @@
 # 
 # You should have received a copy of the GNU General Public License along with
 # repostats.  If not, see <http://www.gnu.org/licenses/>.
-import sys, os, logging
+import sys, os, re, time, logging, multiprocessing
 from urlparse import urlparse
 from string import Template
 
@@ -29,6 +29,7 @@ from rct.cert_commands import CatCertCommand
 from rhsm.config import initConfig
 from rhsm.certificate import create_from_file
 from os.path import isdir
+from repostats.cache import defaultCacheDir, readJson, writeJson
 
 log = logging.getLogger(__name__)
 
@@ -84,6 +85,20 @@ class Cert(object):
 		self.cert,
 		self.key)
 
+# runs in a worker process, so only hand back plain lists
+def decodeCert(path):
+    log.debug('Checking cert: %s', path)
+    ts = time.time()
+    cmd = CatCertCommand()	# it's not multi-use
+    cmd.args = [ path ]
+    cert = cmd._create_cert()
+    log.debug('+ Cert %s; provides %s content urls', path, len(cert.content))
+    content = []
+    for c in cert.content:
+	log.debug('++ content %s', c)
+	content.append([c.label, c.url])
+    return (path, content, time.time() - ts)
+
 class CertFinder(object):
     def initConfig(self):
 	log.info('Reading in rhsm.conf')
@@ -95,12 +110,16 @@ class CertFinder(object):
 	if self.cacert is None:
 	    self.cacert = self.config.get('rhsm', 'repo_ca_cert')
 
-    def __init__(self, releasever, basearch, repolabel, **overrides):
+    # index=False neither reads nor writes the entitlement index
+    def __init__(self, releasever, basearch, repolabel, cachedir=None, processes=None, index=True, **overrides):
 	global _validation_error
 	(self.cdn, self.certdir, self.cacert) = (None, None, None)
+	self.index_path = os.path.join(cachedir or defaultCacheDir(), 'entitlements.json') if index else None
 	self.substitutes = { 'releasever': releasever, 'basearch': basearch }
 	self.repolabel = repolabel
 	self.entitlements = {}
+	self.decode_times = {}
+	self.processes = processes
 	# start with a negative premise
 	self.failed = True
 
@@ -125,39 +144,97 @@ class CertFinder(object):
 	    log.debug('Setting for %s: %s', i, getattr(self, i))
 
 	# get list of certs, but not keys
-	self.possible_certs = filter(lambda d: d.endswith('.pem') and not d.endswith('-key.pem'), os.listdir(self.certdir))
+	self.possible_certs = sorted(filter(lambda d: d.endswith('.pem') and not d.endswith('-key.pem'), os.listdir(self.certdir)))
 	log.debug('Possible certs: %s', self.possible_certs)
 
+    def _add(self, path, label, url):
+	template = Template(url)
+	obj = Cert(self.cacert)
+	obj.cert = path
+	obj.cdn = '/'.join((self.cdn, template.safe_substitute( self.substitutes )))
+	obj.key = path.partition('.pem')[0] + '-key.pem'
+	obj.repolabel = label
+	self.entitlements[label] = obj
+
+    def _decodeAll(self, paths):
+	if len(paths) < 2 or self.processes == 1:
+	    results = map(decodeCert, paths)
+	else:
+	    processes = min(self.processes or multiprocessing.cpu_count(), len(paths))
+	    log.info('Decoding %d certs on %d processes', len(paths), processes)
+	    pool = multiprocessing.Pool(processes)
+	    try:
+		results = pool.map(decodeCert, paths)
+	    finally:
+		pool.close()
+		pool.join()
+	for (path, content, elapsed) in results:
+	    log.debug('Decoded %s in %.3f seconds', path, elapsed)
+	if results:
+	    slowest = max(results, key=lambda r: r[2])
+	    log.info('Decoded %d certs; slowest was %s in %.3f seconds', len(results), slowest[0], slowest[2])
+	return results
+
     def list(self):
 	if self.entitlements:
 	    return self.entitlements
 
 	log.info('Getting list of repos')
-	# loop through certs and see if one has the info we need
+	# decoding certs is expensive, so only do it for certs that changed
+	# since they were put in the index
+	index = readJson(self.index_path, {}) if self.index_path is not None else {}
+	fresh = {}
+	changed = []
+	# the index is keyed by absolute path, so a relative certdir still
+	# finds its entries from another working directory
+	certdir = os.path.abspath(self.certdir)
 	for cert_arg in self.possible_certs:
-	    log.debug('Checking cert: %s', cert_arg)
-	    cmd = CatCertCommand()	# it's not multi-use
-	    cmd.args = [ os.path.join(self.certdir, cert_arg) ]
-	    cert = cmd._create_cert()
-	    log.debug('+ Cert %s; provides %s content urls', cert_arg, len(cert.content))
-	    for c in cert.content:
-		log.debug('++ content %s', c)
-		template = Template(c.url)
-		obj = Cert(self.cacert)
-		obj.cert = cmd.args[0]
-		cdn = '/'.join((self.cdn, template.safe_substitute( self.substitutes ))),
-		obj.cdn = cdn[0]
-		obj.key = cmd.args[0].partition('.pem')[0] + '-key.pem'
-		obj.repolabel = c.label
-		self.entitlements[c.label] = obj
+	    path = os.path.join(certdir, cert_arg)
+	    st = os.stat(path)
+	    stamp = [ st.st_mtime, st.st_size, st.st_ino ]
+	    entry = index.get(path)
+	    if entry is None or entry['stamp'] != stamp:
+		changed.append(path)
+		entry = { 'stamp': stamp }
+	    else:
+		log.debug('Using indexed content for cert: %s', path)
+	    fresh[path] = entry
+
+	for (path, content, elapsed) in self._decodeAll(changed):
+	    fresh[path].update({ 'content': content, 'decode_time': elapsed })
+
+	# possible_certs is sorted, so when several certs provide the same
+	# label the same one always wins no matter which decoded first
+	for cert_arg in self.possible_certs:
+	    path = os.path.join(certdir, cert_arg)
+	    self.decode_times[path] = fresh[path].get('decode_time')
+	    for (label, url) in fresh[path]['content']:
+		self._add(path, label, url)
+
+	# keep entries for other cert dirs, drop the ones for certs that are gone
+	previous = dict((p, index.pop(p)) for p in index.keys() if os.path.dirname(p) == certdir)
+	if self.index_path is not None and previous != fresh:
+	    index.update(fresh)
+	    try:
+		writeJson(self.index_path, index)
+	    except (IOError, OSError), ex:
+		log.warn('Unable to write entitlement index %s: %s', self.index_path, ex)
 
 	return self.entitlements
 
-    def get(self):
-	log.info('Looking up info for %s', self.repolabel)
+    def filter(self, pattern):
+	re_comp = re.compile(pattern, re.IGNORECASE)
+	labels = [ i for i in self.list().keys() if re_comp.search(i) is not None ]
+	labels.sort()
+	return labels
+
+    def get(self, repolabel=None):
+	if repolabel is None:
+	    repolabel = self.repolabel
+	log.info('Looking up info for %s', repolabel)
 	cert = None
 	try:
-	    cert = self.list()[self.repolabel]
+	    cert = self.list()[repolabel]
 	except KeyError:
 	    log.warn('Failed to find cert pair, perhaps the wrong content repo was given?')
 	    raise LookupError('Unable to locate any certificates that provide content to: ' + repolabel)
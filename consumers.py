@@ -0,0 +1,94 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+# 
+# This file is part of repostats
+# 
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+from datetime import datetime
+from repostats.repomd import Consumer
+
+log = logging.getLogger(__name__)
+
+# updateinfo dates are either "2016-01-01 00:00:00" or seconds since the epoch
+def errataDate(date):
+    if date.isdigit() and len(date) > 4:
+	return datetime.utcfromtimestamp(int(date)).strftime('%Y-%m-%d %H:%M:%S')
+    return date
+
+def errataYear(date):
+    return errataDate(date)[:4]
+
+class ErrataSeverityConsumer(Consumer):
+    NAME = 'severities'
+    RESULT = ('severities',)
+    PATHS = {
+	    '/updates/update': { 'start': 'onUpdate', 'end': 'onUpdateEnd' },
+	    '/updates/update/severity': { 'text': 'onSeverity' },
+	    }
+
+    def __init__(self):
+	self.severities = {}
+	self.severity = None
+
+    def onUpdate(self, attrs):
+	self.severity = None
+
+    def onSeverity(self, text):
+	self.severity = text.strip() or None
+
+    def onUpdateEnd(self):
+	s = self.severity or 'None'
+	self.severities[s] = self.severities.get(s, 0) + 1
+
+class ErrataYearConsumer(Consumer):
+    NAME = 'years'
+    RESULT = ('years',)
+    PATHS = { '/updates/update/issued': { 'start': 'onIssued' } }
+
+    def __init__(self):
+	self.years = {}
+
+    def onIssued(self, attrs):
+	year = errataYear(attrs.get('date', ''))
+	self.years[year] = self.years.get(year, 0) + 1
+
+class CveConsumer(Consumer):
+    NAME = 'cves'
+    RESULT = ('cves', 'errata_with_cves')
+    PATHS = {
+	    '/updates/update': { 'start': 'onUpdate', 'end': 'onUpdateEnd' },
+	    '/updates/update/references/reference': { 'start': 'onReference' },
+	    }
+
+    def __init__(self):
+	self.cve_set = set()
+	# unique CVE ids, and errata that fix at least one
+	(self.cves, self.errata_with_cves) = (0, 0)
+	self.has_cve = False
+
+    def onUpdate(self, attrs):
+	self.has_cve = False
+
+    def onReference(self, attrs):
+	if attrs.get('type') == 'cve':
+	    self.has_cve = True
+	    self.cve_set.add(attrs.get('id'))
+
+    def onUpdateEnd(self):
+	if self.has_cve:
+	    self.errata_with_cves+=1
+
+    def finish(self):
+	self.cves = len(self.cve_set)
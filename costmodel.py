@@ -0,0 +1,102 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+# 
+# This file is part of repostats
+# 
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import threading, logging
+
+log = logging.getLogger(__name__)
+
+# bytes per second for every stage a metadata file goes through. The codec
+# and handler rates are in open (uncompressed) bytes. These are only a
+# starting point, observe() pulls them towards what we actually measure.
+RATES = {
+	'download': 5e6,
+	'gz': 150e6,
+	'bz2': 25e6,
+	'plain': 1e9,
+	'primary': 25e6,
+	'primary_db': 300e6,
+	'errata': 25e6,
+	}
+# seconds for a request to come back with headers
+LATENCY = 0.2
+# open size for every compressed byte, for repomd files without open-size
+RATIOS = { 'gz': 10.0, 'bz2': 6.0, 'plain': 1.0 }
+# a fast package count only reads the first chunk of primary.xml
+HEADER_BYTES = 102400
+# how much of every new measurement to mix into a rate
+WEIGHT = 0.3
+# measurements of less than this many bytes are mostly latency
+MIN_BYTES = 1048576
+
+def codecOf(href):
+    if href.endswith('.gz'):
+	return 'gz'
+    if href.endswith('.bz2'):
+	return 'bz2'
+    return 'plain'
+
+class CostModel(object):
+    def __init__(self, state=None):
+	self.lock = threading.Lock()
+	self.rates = dict(RATES)
+	self.latency = LATENCY
+	if state:
+	    self.rates.update(state.get('rates', {}))
+	    self.latency = state.get('latency', LATENCY)
+
+    def dump(self):
+	with self.lock:
+	    return { 'rates': dict(self.rates), 'latency': self.latency }
+
+    def _mix(self, old, new):
+	return (1 - WEIGHT) * old + WEIGHT * new
+
+    def observe(self, stage, nbytes, seconds):
+	if stage not in self.rates or nbytes < MIN_BYTES or seconds <= 0:
+	    return
+	with self.lock:
+	    self.rates[stage] = self._mix(self.rates[stage], nbytes / seconds)
+	log.debug('Observed %s at %.1f MB/s, now expecting %.1f MB/s', stage, nbytes / seconds / 1e6, self.rates[stage] / 1e6)
+
+    def observeLatency(self, seconds):
+	with self.lock:
+	    self.latency = self._mix(self.latency, seconds)
+
+    # expected seconds to get a result for key out of the file described by
+    # the RepoData; None when repomd did not give us a size to go on
+    def estimate(self, key, data, fast=False):
+	if data.size is None:
+	    return None
+	codec = codecOf(data.href)
+	(size, open_size) = (data.size, data.open_size or data.size * RATIOS[codec])
+	parse = open_size / self.rates[key]
+	if key == 'primary' and fast:
+	    open_size = open_size * min(1.0, float(HEADER_BYTES) / size)
+	    size = min(size, HEADER_BYTES)
+	    parse = 0
+	return self.latency + size / self.rates['download'] + open_size / self.rates[codec] + parse
+
+    # candidates maps handler key to RepoData, returns (key, reason)
+    def choose(self, candidates, fast=False):
+	estimates = dict((k, self.estimate(k, d, fast)) for (k, d) in candidates.items())
+	if None in estimates.values():
+	    key = 'primary' if fast or 'primary_db' not in candidates else 'primary_db'
+	    return (key, 'repomd.xml has no sizes to compare')
+	key = min(estimates, key=lambda k: estimates[k])
+	reason = ', '.join('{} {:.3f}s for {} bytes{}'.format(k, estimates[k], candidates[k].size,
+	    ' (header count)' if k == 'primary' and fast else '') for k in sorted(estimates))
+	return (key, 'cheapest expected: ' + reason)
@@ -0,0 +1,201 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import os, time, logging, sqlite3
+from contextlib import closing
+from repostats.cache import defaultCacheDir
+from repostats.consumers import errataDate
+from repostats.repomd import Consumer
+
+log = logging.getLogger(__name__)
+
+# bump whenever the schema changes; an older database is started over
+VERSION = 1
+SCHEMA = '''
+CREATE TABLE info (version INTEGER);
+CREATE TABLE repos (repo INTEGER PRIMARY KEY, url TEXT UNIQUE, label TEXT, checksum TEXT, refreshed REAL);
+CREATE TABLE errata (repo INTEGER, id TEXT, type TEXT, severity TEXT, issued TEXT, updated TEXT, title TEXT,
+    PRIMARY KEY (repo, id));
+CREATE INDEX errata_updated ON errata (repo, updated);
+CREATE INDEX errata_issued ON errata (issued);
+CREATE INDEX errata_type_issued ON errata (type, issued);
+CREATE INDEX repos_label ON repos (label);
+'''
+# seconds to wait for another process to finish writing
+TIMEOUT = 30
+COLUMNS = ('id', 'type', 'severity', 'issued', 'updated', 'title')
+# what errata can be counted per; the sql for each, and its name in output
+GROUPS = {
+	'type': ('e.type', 'Type'),
+	'severity': ('e.severity', 'Severity'),
+	'year': ('substr(e.issued, 1, 4)', 'Year'),
+	'month': ('substr(e.issued, 1, 7)', 'Month'),
+	'repo': ('r.label', 'Repo'),
+	}
+
+# every update in updateinfo.xml, as a row for the errata table
+class ErrataRecordConsumer(Consumer):
+    NAME = 'errata_records'
+    # these go to the database, not to the result cache
+    CACHED = False
+    PATHS = {
+	    '/updates/update': { 'start': 'onUpdate', 'end': 'onUpdateEnd' },
+	    '/updates/update/id': { 'text': 'onId' },
+	    '/updates/update/title': { 'text': 'onTitle' },
+	    '/updates/update/severity': { 'text': 'onSeverity' },
+	    '/updates/update/issued': { 'start': 'onIssued' },
+	    '/updates/update/updated': { 'start': 'onUpdated' },
+	    }
+
+    def __init__(self):
+	self.records = []
+	self.record = None
+
+    def onUpdate(self, attrs):
+	self.record = dict.fromkeys(COLUMNS)
+	self.record['type'] = attrs.get('type')
+
+    def onId(self, text):
+	self.record['id'] = text.strip()
+
+    def onTitle(self, text):
+	self.record['title'] = text.strip()
+
+    def onSeverity(self, text):
+	self.record['severity'] = text.strip() or None
+
+    def onIssued(self, attrs):
+	self.record['issued'] = errataDate(attrs.get('date', ''))
+
+    def onUpdated(self, attrs):
+	self.record['updated'] = errataDate(attrs.get('date', ''))
+
+    def onUpdateEnd(self):
+	r = self.record
+	# an erratum that was never updated counts as updated when issued
+	r['updated'] = r['updated'] or r['issued']
+	self.records.append(tuple(r[k] for k in COLUMNS))
+
+# Every erratum of every repo refreshed into it, in sqlite under the cache
+# dir. A repo is only refreshed when its updateinfo.xml changed, and then only
+# the rows of errata that were added, changed or dropped are written; the
+# rest of the history questions are answered from the indexes.
+class ErrataDb(object):
+    def __init__(self, path=None):
+	self.path = path or os.path.join(defaultCacheDir(), 'errata.sqlite')
+	d = os.path.dirname(self.path)
+	if not os.path.isdir(d):
+	    os.makedirs(d)
+	with closing(self._connect()) as conn:
+	    with conn:
+		self._init(conn)
+
+    # sqlite connections stay on the thread that made them, so every call
+    # makes its own
+    def _connect(self):
+	return sqlite3.connect(self.path, TIMEOUT)
+
+    def _init(self, conn):
+	try:
+	    version = conn.execute('select version from info').fetchone()[0]
+	except sqlite3.OperationalError:
+	    version = None
+	if version == VERSION:
+	    return
+	if version is not None:
+	    log.warn('Starting over %s, made by another version', self.path)
+	    for table in ('info', 'repos', 'errata'):
+		conn.execute('drop table if exists {}'.format(table))
+	conn.executescript(SCHEMA)
+	conn.execute('insert into info (version) values (?)', (VERSION,))
+
+    # True if the updateinfo.xml with checksum is not in yet
+    def wants(self, url, checksum):
+	with closing(self._connect()) as conn:
+	    row = conn.execute('select checksum from repos where url = ?', (url,)).fetchone()
+	return row is None or row[0] != checksum
+
+    # bring the errata of url up to what records, from ErrataRecordConsumer,
+    # says; (added, changed, removed)
+    def refresh(self, url, label, checksum, records):
+	ts = time.time()
+	with closing(self._connect()) as conn:
+	    with conn:
+		c = conn.cursor()
+		row = c.execute('select repo from repos where url = ?', (url,)).fetchone()
+		if row is None:
+		    c.execute('insert into repos (url, label) values (?, ?)', (url, label))
+		    repo = c.lastrowid
+		else:
+		    repo = row[0]
+		existing = dict((r[0], r) for r in c.execute('select {} from errata where repo = ?'.format(', '.join(COLUMNS)), (repo,)))
+		(added, changed, seen) = ([], [], set())
+		for r in records:
+		    seen.add(r[0])
+		    old = existing.get(r[0])
+		    if old is None:
+			added.append((repo,) + r)
+		    elif old != r:
+			changed.append(r[1:] + (repo, r[0]))
+		removed = [ (repo, i) for i in existing if i not in seen ]
+		c.executemany('insert or replace into errata (repo, {}) values (?, {})'.format(', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), added)
+		c.executemany('update errata set {} where repo = ? and id = ?'.format(', '.join('{} = ?'.format(k) for k in COLUMNS[1:])), changed)
+		c.executemany('delete from errata where repo = ? and id = ?', removed)
+		c.execute('update repos set label = ?, checksum = ?, refreshed = ? where repo = ?', (label, checksum, time.time(), repo))
+	log.info('Refreshed errata of %s in %.3f seconds: %d added, %d changed, %d removed, %d unchanged', label,
+		time.time() - ts, len(added), len(changed), len(removed), len(seen) - len(added) - len(changed))
+	return (len(added), len(changed), len(removed))
+
+    def labels(self):
+	with closing(self._connect()) as conn:
+	    return [ r[0] for r in conn.execute('select distinct label from repos order by label') ]
+
+    # [ (group values, count) ] of distinct errata per groups, of the repos
+    # labelled labels, or of all; since is inclusive and until is not, both
+    # compared as text with the issued date, so 2016 or 2016-03 work too
+    def count(self, groups=(), labels=None, types=None, severities=None, since=None, until=None):
+	(where, params) = self._where(labels, types, severities, since, until)
+	columns = [ GROUPS[g][0] for g in groups ]
+	sql = 'select {} count(distinct e.id) from errata e join repos r on r.repo = e.repo {}'.format(
+		''.join(c + ', ' for c in columns), where)
+	if columns:
+	    sql += ' group by {0} order by {0}'.format(', '.join(columns))
+	with closing(self._connect()) as conn:
+	    return [ (row[:-1], row[-1]) for row in conn.execute(sql, params) ]
+
+    # the errata themselves, newest first: (id, type, severity, issued, updated, title)
+    def list(self, labels=None, types=None, severities=None, since=None, until=None):
+	(where, params) = self._where(labels, types, severities, since, until)
+	sql = 'select distinct {} from errata e join repos r on r.repo = e.repo {} order by e.issued desc, e.id'.format(
+		', '.join('e.' + k for k in COLUMNS), where)
+	with closing(self._connect()) as conn:
+	    for row in conn.execute(sql, params):
+		yield row
+
+    def _where(self, labels, types, severities, since, until):
+	(clauses, params) = ([], [])
+	for (column, values) in (('r.label', labels), ('e.type', types), ('e.severity', severities)):
+	    if values:
+		clauses.append('{} in ({})'.format(column, ', '.join('?' * len(values))))
+		params.extend(values)
+	if since:
+	    clauses.append('e.issued >= ?')
+	    params.append(since)
+	if until:
+	    clauses.append('e.issued < ?')
+	    params.append(until)
+	return ('where ' + ' and '.join(clauses) if clauses else '', params)
@@ -0,0 +1,598 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Fetch from many repos at once on one thread: a poll() loop drives every
+download on a non-blocking socket, with a TLS context per client cert, and
+streams each body straight into its handler like CdnBrowser does.
+
+Every download is a generator that yields the poll events it waits for, so
+the HTTP exchange reads top to bottom. LoopBrowser has the CdnBrowser
+methods; each blocking call runs the loop until it has what it asked for,
+moving every other download along while it waits. To fetch from a lot of
+repos, start() what they all need first and run() the loop once.
+"""
+import os, sys, ssl, time, errno, socket, select, logging, threading, collections, heapq, itertools
+from urlparse import urlparse
+from repostats.cdnbrowser import CdnBrowser, CHUNK_SIZE
+from repostats.retry import HttpError
+from repostats.limiter import PRIORITY_REPOMD
+
+log = logging.getLogger(__name__)
+
+MAX_CONNECTIONS = 64
+# seconds to wait on a socket before giving up on its download
+TIMEOUT = 60
+# reads one download gets before the others get a turn
+READS_PER_TURN = 8
+MAX_HEAD = 65536
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+# one TLS context per client cert, shared by every connection made with it
+def tlsContext(cert, key, cacert):
+    with _contexts_lock:
+	ctx = _contexts.get((cert, key, cacert))
+	if ctx is None:
+	    ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+	    ctx.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+	    ctx.verify_mode = ssl.CERT_REQUIRED
+	    ctx.check_hostname = True
+	    if cacert:
+		ctx.load_verify_locations(cacert)
+	    else:
+		ctx.load_default_certs()
+	    if cert:
+		ctx.load_cert_chain(cert, key)
+	    _contexts[(cert, key, cacert)] = ctx
+	return ctx
+
+# the connection went away before the response started; safe to retry
+class ConnectionClosed(IOError):
+    pass
+
+class Connection(object):
+    def __init__(self, host, port, ctx):
+	(self.host, self.port, self.ctx) = (host, port, ctx)
+	self.sock = None
+	self.ready = False
+	self.reused = False
+	self.t_connect = None
+	self.data = None
+
+    def fileno(self):
+	return self.sock.fileno()
+
+    # these are generators that yield the poll events they wait for
+    def open(self):
+	ts = time.time()
+	# name lookups still block; they are few and usually cached
+	(family, socktype, proto, name, addr) = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+	self.sock = socket.socket(family, socktype, proto)
+	self.sock.setblocking(0)
+	err = self.sock.connect_ex(addr)
+	if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+	    yield select.POLLOUT
+	    err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+	if err:
+	    raise socket.error(err, '{}:{}: {}'.format(self.host, self.port, os.strerror(err)))
+	if self.ctx is not None:
+	    self.sock = self.ctx.wrap_socket(self.sock, server_hostname=self.host, do_handshake_on_connect=False)
+	    while True:
+		try:
+		    self.sock.do_handshake()
+		    break
+		except ssl.SSLWantReadError:
+		    yield select.POLLIN
+		except ssl.SSLWantWriteError:
+		    yield select.POLLOUT
+	self.t_connect = time.time() - ts
+	self.ready = True
+
+    def send(self, data):
+	while data:
+	    try:
+		data = data[self.sock.send(data):]
+	    except ssl.SSLWantWriteError:
+		yield select.POLLOUT
+	    except ssl.SSLWantReadError:
+		yield select.POLLIN
+	    except socket.error, ex:
+		if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+		    raise
+		yield select.POLLOUT
+
+    # leaves what it read in data, '' once the other end closed
+    def recv(self):
+	while True:
+	    try:
+		self.data = self.sock.recv(CHUNK_SIZE)
+		return
+	    except ssl.SSLZeroReturnError:
+		self.data = ''
+		return
+	    except ssl.SSLWantReadError:
+		yield select.POLLIN
+	    except ssl.SSLWantWriteError:
+		yield select.POLLOUT
+	    except socket.error, ex:
+		if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+		    raise
+		yield select.POLLIN
+
+    def close(self):
+	if self.sock is not None:
+	    try:
+		self.sock.close()
+	    except socket.error:
+		pass
+	    self.sock = None
+	self.ready = False
+
+class Response(object):
+    def __init__(self, head):
+	lines = head.split('\r\n')
+	parts = lines[0].split(' ', 2)
+	if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+	    raise IOError('Malformed status line: {!r}'.format(lines[0][:100]))
+	self.version = parts[0]
+	self.status = int(parts[1])
+	self.reason = parts[2] if len(parts) > 2 else ''
+	self.headers = {}
+	for line in lines[1:]:
+	    (name, sep, value) = line.partition(':')
+	    if sep:
+		self.headers[name.strip().lower()] = value.strip()
+
+    @property
+    def ok(self):
+	return 200 <= self.status < 400
+
+# One GET, on a connection of its own or a kept-alive one. The sink gets
+# onHeaders(fetch) and onData(data) as the response comes in; onData
+# returns True when it needs no more. Then the loop calls onDone(), or
+# onError(exc_info) if anything along the way raised.
+class HttpFetch(object):
+    def __init__(self, url, sink, headers, ctx, tls):
+	u = urlparse(url)
+	self.url = url
+	self.host = u.hostname
+	self.port = u.port or (443 if u.scheme == 'https' else 80)
+	self.path = (u.path or '/') + ('?' + u.query if u.query else '')
+	self.ctx = ctx
+	self.key = (self.host, self.port, tls)
+	self.sink = sink
+	self.headers = { 'host': u.netloc, 'accept-encoding': 'identity', 'user-agent': 'repostats' }
+	self.headers.update(headers or {})
+	(self.conn, self.gen, self.response) = (None, None, None)
+	self.reusable = False
+	# the sink wants no more, and reads so far for taking turns
+	(self.stopped, self.reads) = (False, 0)
+	self.deadline = None
+	(self.t_connect, self.t_ttfb) = (None, None)
+
+    def run(self):
+	try:
+	    for w in self._exchange():
+		yield w
+	except ConnectionClosed:
+	    # the server may have dropped a kept-alive connection while it sat idle
+	    if not self.conn.reused:
+		raise
+	    log.debug('Kept-alive connection to %s went away, reconnecting', self.host)
+	    self.conn.close()
+	    self.conn = Connection(self.host, self.port, self.ctx)
+	    for w in self._exchange():
+		yield w
+
+    def _exchange(self):
+	conn = self.conn
+	if not conn.ready:
+	    for w in conn.open():
+		yield w
+	    self.t_connect = conn.t_connect
+	ts = time.time()
+	request = 'GET {} HTTP/1.1\r\n'.format(self.path) + ''.join('{}: {}\r\n'.format(k, v) for (k, v) in self.headers.items()) + '\r\n'
+	for w in conn.send(request):
+	    yield w
+	buf = ''
+	while True:
+	    for w in conn.recv():
+		yield w
+	    if not conn.data:
+		if not buf:
+		    raise ConnectionClosed('{}: connection closed before a response'.format(self.url))
+		raise IOError('{}: connection closed in the middle of the response head'.format(self.url))
+	    buf += conn.data
+	    end = buf.find('\r\n\r\n')
+	    if end >= 0:
+		break
+	    if len(buf) > MAX_HEAD:
+		raise IOError('{}: response head is too long'.format(self.url))
+	self.t_ttfb = time.time() - ts
+	self.response = Response(buf[:end])
+	self.sink.onHeaders(self)
+	body = buf[end + 4:]
+	headers = self.response.headers
+	keep = self.response.version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+	if self.response.status in (204, 304) or self.response.status < 200:
+	    body = None
+	elif 'chunked' in headers.get('transfer-encoding', '').lower():
+	    for w in self._chunked(body):
+		yield w
+	elif 'content-length' in headers:
+	    for w in self._sized(body, int(headers['content-length'])):
+		yield w
+	else:
+	    keep = False
+	    for w in self._untilClose(body):
+		yield w
+	self.reusable = keep and not self.stopped
+
+    def _deliver(self, data):
+	if data and not self.stopped:
+	    self.stopped = bool(self.sink.onData(data))
+	return self.stopped
+
+    # yields None now and then, so a fast connection does not starve the others
+    def _read(self):
+	for w in self.conn.recv():
+	    yield w
+	self.reads += 1
+	if self.reads % READS_PER_TURN == 0:
+	    yield None
+
+    def _sized(self, body, length):
+	left = length - len(body)
+	if self._deliver(body):
+	    return
+	while left > 0:
+	    for w in self._read():
+		yield w
+	    if not self.conn.data:
+		raise IOError('{}: connection closed with {} of {} bytes to go'.format(self.url, left, length))
+	    left -= len(self.conn.data)
+	    if self._deliver(self.conn.data):
+		return
+
+    def _untilClose(self, body):
+	if self._deliver(body):
+	    return
+	while True:
+	    for w in self._read():
+		yield w
+	    if not self.conn.data or self._deliver(self.conn.data):
+		return
+
+    def _chunked(self, buf):
+	while True:
+	    # chunk size line
+	    while '\r\n' not in buf:
+		for w in self._more():
+		    yield w
+		buf += self.conn.data
+	    (line, buf) = buf.split('\r\n', 1)
+	    size = int(line.split(';', 1)[0].strip(), 16)
+	    if size == 0:
+		# skip any trailers up to the blank line that ends them
+		while not (buf.startswith('\r\n') or '\r\n\r\n' in buf):
+		    for w in self._more():
+			yield w
+		    buf += self.conn.data
+		return
+	    while size > 0:
+		if not buf:
+		    for w in self._more():
+			yield w
+		    buf = self.conn.data
+		(data, buf) = (buf[:size], buf[size:])
+		size -= len(data)
+		if self._deliver(data):
+		    return
+	    while len(buf) < 2:
+		for w in self._more():
+		    yield w
+		buf += self.conn.data
+	    buf = buf[2:]
+
+    def _more(self):
+	for w in self._read():
+	    yield w
+	if not self.conn.data:
+	    raise IOError('{}: connection closed in the middle of a chunked response'.format(self.url))
+
+# Drives any number of HttpFetch on one thread, at most max_connections at
+# a time, and keeps finished connections alive for the next fetch to the
+# same host with the same client cert.
+class FetchLoop(object):
+    def __init__(self, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT, idle_per_host=None):
+	self.max_connections = max_connections
+	self.timeout = timeout
+	# idle keep-alive connections to keep per host and client cert
+	self.idle_per_host = idle_per_host or max_connections
+	self.poller = select.poll()
+	self.waiting = {}
+	self.ready = collections.deque()
+	# fetches waiting for a connection, by priority and then in order
+	self.queue = []
+	self.seq = itertools.count()
+	self.active = 0
+	self.idle = {}
+	(self.opened, self.reused) = (0, 0)
+
+    def fetch(self, url, sink, headers=None, cert=None, key=None, cacert=None, priority=PRIORITY_REPOMD):
+	(ctx, tls) = (None, None)
+	if url.startswith('https:'):
+	    tls = (cert, key, cacert)
+	    ctx = tlsContext(*tls)
+	fetch = HttpFetch(url, sink, headers, ctx, tls)
+	heapq.heappush(self.queue, (priority, next(self.seq), fetch))
+	return fetch
+
+    def busy(self):
+	return self.active > 0 or len(self.queue) > 0
+
+    # run until every fetch is done, or until() says so
+    def run(self, until=None):
+	while self.busy() and not (until is not None and until()):
+	    self._admit()
+	    for i in range(len(self.ready)):
+		self._resume(self.ready.popleft())
+	    timeout = 0 if self.ready else 1000
+	    if not self.waiting:
+		continue
+	    for (fd, events) in self.poller.poll(timeout):
+		fetch = self.waiting.pop(fd, None)
+		if fetch is not None:
+		    self.poller.unregister(fd)
+		    self._resume(fetch)
+	    self._expire()
+
+    def _admit(self):
+	while self.queue and self.active < self.max_connections:
+	    fetch = heapq.heappop(self.queue)[2]
+	    idle = self.idle.get(fetch.key)
+	    if idle:
+		fetch.conn = idle.pop()
+		fetch.conn.reused = True
+		self.reused += 1
+	    else:
+		fetch.conn = Connection(fetch.host, fetch.port, fetch.ctx)
+		self.opened += 1
+	    self.active += 1
+	    log.debug('Fetching %s on a %s connection', fetch.url, 'kept-alive' if fetch.conn.reused else 'new')
+	    fetch.gen = fetch.run()
+	    self.ready.append(fetch)
+
+    def _resume(self, fetch):
+	try:
+	    w = fetch.gen.next()
+	except StopIteration:
+	    self._finish(fetch, None)
+	    return
+	except Exception:
+	    self._finish(fetch, sys.exc_info())
+	    return
+	if w is None:
+	    self.ready.append(fetch)
+	    return
+	fd = fetch.conn.fileno()
+	self.waiting[fd] = fetch
+	self.poller.register(fd, w)
+	fetch.deadline = time.time() + self.timeout
+
+    def _expire(self):
+	now = time.time()
+	for (fd, fetch) in self.waiting.items():
+	    if fetch.deadline < now:
+		del self.waiting[fd]
+		self.poller.unregister(fd)
+		fetch.gen.close()
+		try:
+		    raise socket.timeout('{}: no progress in {} seconds'.format(fetch.url, self.timeout))
+		except socket.timeout:
+		    self._finish(fetch, sys.exc_info())
+
+    def _finish(self, fetch, exc):
+	self.active -= 1
+	conn = fetch.conn
+	idle = self.idle.setdefault(fetch.key, [])
+	if exc is None and fetch.reusable and len(idle) < self.idle_per_host:
+	    conn.reused = False
+	    idle.append(conn)
+	else:
+	    conn.close()
+	if exc is None:
+	    try:
+		fetch.sink.onDone()
+		return
+	    except Exception:
+		exc = sys.exc_info()
+	try:
+	    fetch.sink.onError(exc)
+	except Exception:
+	    log.exception('Error handler for %s failed', fetch.url)
+
+    def close(self):
+	for idle in self.idle.values():
+	    for conn in idle:
+		conn.close()
+	self.idle = {}
+
+class _RepomdSink(object):
+    def __init__(self, browser, cached):
+	self.browser = browser
+	self.cached = cached
+	self.chunks = []
+
+    def onHeaders(self, fetch):
+	self.browser._observe(fetch, 'repomd')
+	if fetch.response.status != 304 and not fetch.response.ok:
+	    raise HttpError('{} {}: {}'.format(fetch.url, fetch.response.status, fetch.response.reason), fetch.response.status)
+	self.fetch = fetch
+	self.ts = time.time()
+
+    def onData(self, data):
+	self.chunks.append(data)
+
+    def onDone(self):
+	(browser, response) = (self.browser, self.fetch.response)
+	body = ''.join(self.chunks)
+	if response.status != 304:
+	    browser.tracer.record(browser.url, 'repomd', 'download', time.time() - self.ts, bytes=len(body))
+	browser._repomdResponse(self.cached, response.status, response.headers.get('etag'), response.headers.get('last-modified'), body)
+	for key in browser.pending:
+	    browser.start(key)
+	browser.pending = []
+
+    def onError(self, exc):
+	self.browser.errors['repomd'] = exc
+	for key in self.browser.pending:
+	    self.browser.errors[key] = exc
+
+class _TransferSink(object):
+    def __init__(self, browser, transfer):
+	self.browser = browser
+	self.transfer = transfer
+	self.t_busy = 0
+
+    def onHeaders(self, fetch):
+	self.browser._observe(fetch, self.transfer.key)
+	if fetch.response.status not in (200, 206):
+	    raise HttpError('{} {}: {}'.format(fetch.url, fetch.response.status, fetch.response.reason), fetch.response.status)
+	self.ts = time.time()
+	self.transfer.accept(fetch.response.status, fetch.response.headers)
+
+    def onData(self, data):
+	ts = time.time()
+	done = self.transfer.feed(data)
+	self.t_busy += time.time() - ts
+	return done
+
+    def onDone(self):
+	transfer = self.transfer
+	# what the loop spent on anything but this transfer counts as waiting on the network
+	transfer.t_read = time.time() - self.ts - self.t_busy
+	try:
+	    transfer.finish()
+	finally:
+	    transfer.close()
+	transfer.complete()
+
+    def onError(self, exc):
+	try:
+	    self.transfer.fail(exc)
+	except Exception:
+	    self.browser.errors[self.transfer.key] = sys.exc_info()
+	finally:
+	    self.transfer.close()
+
+# CdnBrowser on a FetchLoop; several of them can share one loop
+class LoopBrowser(CdnBrowser):
+    def __init__(self, loop, url, cert, key, cacert, *args, **kwargs):
+	super(LoopBrowser, self).__init__(url, cert, key, cacert, *args, **kwargs)
+	self.loop = loop
+	# keys waiting on repomd.xml, and what went wrong fetching any key
+	self.pending = []
+	self.errors = {}
+	self.started = set()
+
+    def reset(self):
+	super(LoopBrowser, self).reset()
+	self.errors = {}
+	self.started = set()
+
+    def refresh(self):
+	self.errors.pop('repomd', None)
+	self.started.discard('repomd')
+	return super(LoopBrowser, self).refresh()
+
+    def _observe(self, fetch, name):
+	if fetch.t_connect is not None:
+	    self.tracer.record(self.url, name, 'connect', fetch.t_connect)
+	self.tracer.record(self.url, name, 'ttfb', fetch.t_ttfb, status=fetch.response.status)
+	self.model.observeLatency((fetch.t_connect or 0) + fetch.t_ttfb)
+
+    def _fetch(self, partial_url, sink, headers=None, priority=PRIORITY_REPOMD):
+	full_url = '/'.join((self.url, partial_url))
+	log.info('Queueing url: %s', full_url)
+	return self.loop.fetch(full_url, sink, headers, self.cert, self.key, self.cacert, priority)
+
+    def _finished(self, key):
+	if key in self.errors:
+	    return True
+	if key == 'repomd':
+	    return self.repomd.initialized
+	return getattr(self, key).initialized
+
+    # queue up the downloads for the given keys without waiting for them
+    def start(self, *keys):
+	for key in keys:
+	    if self._finished(key) or key in self.started:
+		continue
+	    if key != 'repomd' and not self.repomd.initialized:
+		self.pending.append(key)
+		key = 'repomd'
+		if key in self.started:
+		    continue
+	    self.started.add(key)
+	    try:
+		self._start(key)
+	    except Exception:
+		self.errors[key] = sys.exc_info()
+
+    def _start(self, key):
+	if key == 'repomd':
+	    (cached, headers) = self._repomdRequest()
+	    self._fetch('/repodata/repomd.xml', _RepomdSink(self, cached), headers)
+	    return
+	if self._restore(key):
+	    return
+	# waiting for the store would hold up the loop, and with it whoever
+	# holds the blob if that is another browser on this loop
+	transfer = self._transfer(key, False)
+	if transfer.stored:
+	    # local disk, no point in going through the loop
+	    log.info('Using stored %s for %s', transfer.blob.path, transfer.href)
+	    self._stream(transfer, transfer.blob.open())
+	    return
+	self._fetch(transfer.href, _TransferSink(self, transfer), transfer.resumeHeaders(), transfer.priority)
+
+    def _wait(self, *keys):
+	self.start(*keys)
+	self.loop.run(lambda: all(self._finished(k) for k in keys))
+	for k in keys:
+	    if k in self.errors:
+		exc = self.errors[k]
+		raise exc[0], exc[1], exc[2]
+	    if not self._finished(k):
+		raise IOError('{}: {} never finished'.format(self.url, k))
+
+    def getRepomd(self):
+	if not self.repomd.initialized:
+	    self._wait('repomd')
+	return self.repomd
+
+    def getHandler(self, key):
+	if not getattr(self, key).initialized:
+	    self._wait(key)
+	return getattr(self, key)
+
+    def prefetch(self, *keys):
+	self._wait(*keys)
+	return [ getattr(self, k) for k in keys ]
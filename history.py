@@ -0,0 +1,257 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import os, re, mmap, time, fcntl, struct, hashlib, logging, tempfile
+from repostats.cache import defaultCacheDir, readJson, writeJson
+from repostats.repomd import Consumer
+
+log = logging.getLogger(__name__)
+
+# A revision file is a header, a table of sections, and per section: its
+# hashes, sorted, as little endian uint64; count + 1 offsets into its strings,
+# in the same order, as uint64 too; and the strings, utf-8, one after another.
+# Offsets in the header and the table are from the start of the file.
+MAGIC = 'RSHIST\x00\x01'
+HEADER = struct.Struct('<8sI4x')
+# name, count, and where the hashes, offsets and strings start
+SECTION = struct.Struct('<8sQQQQ')
+# hashes read at once while comparing two revisions
+BLOCK = 4096
+SAFE = re.compile('[^A-Za-z0-9._-]')
+
+def nevra(name, epoch, version, release, arch):
+    if epoch and epoch != '0':
+	return u'{}-{}:{}-{}.{}'.format(name, epoch, version, release, arch)
+    return u'{}-{}-{}.{}'.format(name, version, release, arch)
+
+def hash64(text):
+    return struct.unpack('<Q', hashlib.md5(text.encode('utf-8')).digest()[:8])[0]
+
+# the packages of a revision, as their NEVRA strings, from primary.xml
+class PackageListConsumer(Consumer):
+    NAME = 'history_packages'
+    CACHED = False
+    PATHS = {
+	    '/metadata/package': { 'start': 'onPackage', 'end': 'onPackageEnd' },
+	    '/metadata/package/name': { 'text': 'onName' },
+	    '/metadata/package/arch': { 'text': 'onArch' },
+	    '/metadata/package/version': { 'start': 'onVersion' },
+	    }
+
+    def __init__(self):
+	self.entries = []
+	(self.name, self.arch, self.version) = (None, None, None)
+
+    def onPackage(self, attrs):
+	(self.name, self.arch, self.version) = (None, None, None)
+
+    def onName(self, text):
+	self.name = text
+
+    def onArch(self, text):
+	self.arch = text
+
+    def onVersion(self, attrs):
+	self.version = (attrs.get('epoch'), attrs.get('ver'), attrs.get('rel'))
+
+    def onPackageEnd(self):
+	(epoch, version, release) = self.version or (None, None, None)
+	self.entries.append(nevra(self.name, epoch, version, release, self.arch))
+
+# the update ids of a revision, from updateinfo.xml
+class ErrataListConsumer(Consumer):
+    NAME = 'history_errata'
+    CACHED = False
+    PATHS = { '/updates/update/id': { 'text': 'onId' } }
+
+    def __init__(self):
+	self.entries = []
+
+    def onId(self, text):
+	self.entries.append(text.strip())
+
+# Writes entries per section as a revision file. Entries with the same hash
+# are kept once. Goes through a temp file and a rename, like writeJson.
+def writeRevision(path, sections):
+    d = os.path.dirname(path)
+    (fd, tmp) = tempfile.mkstemp(dir=d, prefix='.' + os.path.basename(path))
+    try:
+	with os.fdopen(fd, 'wb') as f_out:
+	    at = HEADER.size + SECTION.size * len(sections)
+	    (table, bodies) = ([], [])
+	    for (name, entries) in sections:
+		pairs = sorted(dict((hash64(e), e.encode('utf-8')) for e in entries).items())
+		strings = ''.join(s for (h, s) in pairs)
+		offsets = [0]
+		for (h, s) in pairs:
+		    offsets.append(offsets[-1] + len(s))
+		hashes_at = at
+		offsets_at = hashes_at + 8 * len(pairs)
+		strings_at = offsets_at + 8 * len(offsets)
+		table.append(SECTION.pack(name, len(pairs), hashes_at, offsets_at, strings_at))
+		bodies.append(([ h for (h, s) in pairs ], offsets, strings))
+		at = strings_at + len(strings)
+	    f_out.write(HEADER.pack(MAGIC, len(sections)))
+	    f_out.write(''.join(table))
+	    for (hashes, offsets, strings) in bodies:
+		for values in (hashes, offsets):
+		    for i in range(0, len(values), BLOCK):
+			chunk = values[i:i + BLOCK]
+			f_out.write(struct.pack('<{}Q'.format(len(chunk)), *chunk))
+		f_out.write(strings)
+	os.rename(tmp, path)
+    except:
+	os.remove(tmp)
+	raise
+
+# one section of a mapped revision file
+class Section(object):
+    def __init__(self, mm, count, hashes_at, offsets_at, strings_at):
+	self.mm = mm
+	self.count = count
+	(self.hashes_at, self.offsets_at, self.strings_at) = (hashes_at, offsets_at, strings_at)
+
+    # (index, hash) in hash order, a block at a time
+    def hashes(self):
+	for start in xrange(0, self.count, BLOCK):
+	    n = min(BLOCK, self.count - start)
+	    for (i, h) in enumerate(struct.unpack_from('<{}Q'.format(n), self.mm, self.hashes_at + 8 * start), start):
+		yield (i, h)
+
+    def string(self, i):
+	(first, last) = struct.unpack_from('<QQ', self.mm, self.offsets_at + 8 * i)
+	return self.mm[self.strings_at + first:self.strings_at + last].decode('utf-8')
+
+# a revision file, mapped rather than read; only what is looked at is paged in
+class Revision(object):
+    def __init__(self, path):
+	self.path = path
+	with open(path, 'rb') as f_in:
+	    self.mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+	(magic, count) = HEADER.unpack_from(self.mm, 0)
+	if magic != MAGIC:
+	    self.mm.close()
+	    raise ValueError('{} is not a revision file'.format(path))
+	self.sections = {}
+	for i in range(count):
+	    fields = SECTION.unpack_from(self.mm, HEADER.size + SECTION.size * i)
+	    self.sections[fields[0].rstrip('\0')] = Section(self.mm, *fields[1:])
+
+    def section(self, name):
+	return self.sections.get(name) or Section(self.mm, 0, 0, 0, 0)
+
+    def close(self):
+	self.mm.close()
+
+# (added, removed) entries of section name from old to new; walks both hash
+# lists once side by side, so only what changed is ever held in memory
+def diffSection(old, new, name):
+    (old, new) = (old.section(name), new.section(name))
+    (added, removed) = ([], [])
+    (a, b) = (old.hashes(), new.hashes())
+    (x, y) = (next(a, None), next(b, None))
+    while x is not None or y is not None:
+	if y is None or (x is not None and x[1] < y[1]):
+	    removed.append(old.string(x[0]))
+	    x = next(a, None)
+	elif x is None or y[1] < x[1]:
+	    added.append(new.string(y[0]))
+	    y = next(b, None)
+	else:
+	    (x, y) = (next(a, None), next(b, None))
+    return (sorted(added), sorted(removed))
+
+# Packages and errata of every revision of every repo seen, under the cache
+# dir. Each repo has a directory of revision files, and an index.json of
+# them in the order they were recorded.
+class History(object):
+    def __init__(self, root=None):
+	self.root = root or os.path.join(defaultCacheDir(), 'history')
+	if not os.path.isdir(self.root):
+	    os.makedirs(self.root)
+
+    def _dir(self, url, label):
+	return os.path.join(self.root, '{}-{}'.format(SAFE.sub('_', label), hashlib.sha1(url).hexdigest()[:8]))
+
+    def _index(self, d):
+	return readJson(os.path.join(d, 'index.json'), { 'revisions': [] })
+
+    # True if the revision repomd describes is not recorded yet
+    def wants(self, url, label, repomd):
+	index = self._index(self._dir(url, label))
+	return not any(r['checksums'] == repomd.checksums for r in index['revisions'])
+
+    # record the revision repomd describes, from consumers that parsed it;
+    # errata is None for repos without updateinfo
+    def record(self, url, label, repomd, packages, errata=None):
+	d = self._dir(url, label)
+	if not os.path.isdir(d):
+	    os.makedirs(d)
+	# another process may be recording the same repo
+	with open(os.path.join(d, 'index.lock'), 'a') as f_lock:
+	    fcntl.flock(f_lock, fcntl.LOCK_EX)
+	    index = self._index(d)
+	    if any(r['checksums'] == repomd.checksums for r in index['revisions']):
+		return
+	    name = '{}-{}.hist'.format(repomd.revision or 0, hashlib.sha1(repr(sorted(repomd.checksums.items()))).hexdigest()[:10])
+	    ts = time.time()
+	    writeRevision(os.path.join(d, name), [ ('packages', packages.entries), ('errata', errata.entries if errata is not None else []) ])
+	    index.update({ 'url': url, 'label': label })
+	    index['revisions'].append({ 'file': name, 'revision': repomd.revision, 'recorded': time.time(),
+		'checksums': repomd.checksums, 'packages': len(packages.entries),
+		'errata': len(errata.entries) if errata is not None else 0 })
+	    writeJson(os.path.join(d, 'index.json'), index)
+	log.info('Recorded revision %s of %s in %.3f seconds', repomd.revision, label, time.time() - ts)
+
+    # the index of label; releasever and basearch pick one if it was
+    # recorded for more than one
+    def find(self, label, releasever=None, basearch=None):
+	found = []
+	for name in sorted(os.listdir(self.root)):
+	    d = os.path.join(self.root, name)
+	    if not name.startswith(SAFE.sub('_', label) + '-') or not os.path.isdir(d):
+		continue
+	    index = self._index(d)
+	    if index.get('label') != label:
+		continue
+	    if any(v is not None and '/{}/'.format(v) not in index['url'] + '/' for v in (releasever, basearch)):
+		continue
+	    index['dir'] = d
+	    found.append(index)
+	if not found:
+	    raise LookupError('No revisions of {} recorded; run stats or serve with --history first'.format(label))
+	if len(found) > 1:
+	    raise LookupError('{} was recorded for more than one repo, pick one with --releasever and --basearch: {}'.format(
+		label, ', '.join(i['url'] for i in found)))
+	return found[0]
+
+    # a revision of index, by its repomd revision, or -N for the Nth most recent
+    def select(self, index, which):
+	revisions = index['revisions']
+	n = int(which)
+	if n < 0:
+	    if -n > len(revisions):
+		raise LookupError('Only {} revisions of {} recorded'.format(len(revisions), index['label']))
+	    return revisions[n]
+	for r in reversed(revisions):
+	    if r['revision'] == n:
+		return r
+	raise LookupError('Revision {} of {} not recorded; there are {}'.format(which, index['label'],
+	    ', '.join(str(r['revision']) for r in revisions)))
+
+    def open(self, index, revision):
+	return Revision(os.path.join(index['dir'], revision['file']))
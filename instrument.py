@@ -0,0 +1,103 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import json, time, resource, threading, logging
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+log = logging.getLogger(__name__)
+
+# phases a span can be for, in the order a file goes through them
+PHASES = ('connect', 'ttfb', 'download', 'checksum', 'decompress', 'parse', 'sqlite', 'cache')
+
+def peakRss():
+    # in KB on linux; children covers the processes of a parallel parse
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+	    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+# Timing spans for every repo and file a run touches. Each span is a plain
+# dict, kept in spans for callers to look at and written as a JSON line to
+# out if one was given, as soon as it is recorded.
+class Tracer(object):
+    def __init__(self, out=None, keep=True):
+	self.out = out
+	self.keep = keep
+	self.spans = []
+	self.lock = threading.Lock()
+
+    def record(self, repo, name, phase, seconds, **fields):
+	span = { 'ts': time.time(), 'repo': repo, 'file': name, 'phase': phase,
+		'seconds': round(seconds, 6), 'rss_kb': peakRss() }
+	span.update(fields)
+	with self.lock:
+	    if self.keep:
+		self.spans.append(span)
+	    if self.out is not None:
+		self.out.write(json.dumps(span, sort_keys=True) + '\n')
+		self.out.flush()
+	return span
+
+    def find(self, repo=None, name=None, phase=None):
+	with self.lock:
+	    return [ s for s in self.spans if (repo is None or s['repo'] == repo)
+		    and (name is None or s['file'] == name) and (phase is None or s['phase'] == phase) ]
+
+    # total seconds per phase, for a quick look at where a run went
+    def totals(self):
+	totals = {}
+	with self.lock:
+	    for s in self.spans:
+		totals[s['phase']] = totals.get(s['phase'], 0) + s['seconds']
+	return totals
+
+# requests does not tell how long a connection took to set up, so the
+# connections it makes time their own connect() into this thread's slot
+_connects = threading.local()
+
+def takeConnectTime():
+    # seconds spent connecting since the last call on this thread, None if
+    # the request went out on a connection that was already open
+    elapsed = getattr(_connects, 'elapsed', None)
+    _connects.elapsed = None
+    return elapsed
+
+class _TimedConnect(object):
+    def connect(self):
+	ts = time.time()
+	try:
+	    super(_TimedConnect, self).connect()
+	finally:
+	    _connects.elapsed = (getattr(_connects, 'elapsed', None) or 0) + time.time() - ts
+
+class TimedHTTPConnection(_TimedConnect, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(_TimedConnect, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+# mount on a session to have takeConnectTime() report TCP and TLS set up
+class TimedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+	super(TimedAdapter, self).init_poolmanager(*args, **kwargs)
+	self.poolmanager.pool_classes_by_scheme = { 'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool }
@@ -0,0 +1,157 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import time, heapq, itertools, threading, logging
+
+log = logging.getLogger(__name__)
+
+# requests to a host at once before anything is known about it
+INITIAL = 4
+MIN_LIMIT = 1
+# how much of the limit is left after a throttle, and after a latency spike
+THROTTLE_DECREASE = 0.5
+LATENCY_DECREASE = 0.8
+# an answer this many times slower than the best one means a queue is building
+LATENCY_SLACK = 3.0
+# best latencies below this are mostly noise to compare with
+MIN_LATENCY = 0.05
+# a burst of bad answers only counts once per this many seconds
+COOLDOWN = 1.0
+# seconds to back off a throttled host that did not say how long to
+THROTTLE_PAUSE = 1.0
+# throughput is compared between windows this many seconds long
+RATE_WINDOW = 2.0
+# a raised limit has to buy this much more throughput to be kept
+RATE_GAIN = 1.05
+
+# repomd.xml goes before any data file; those go smallest first
+PRIORITY_REPOMD = 0
+
+# a request that holds a place in the limit until it is released
+class Slot(object):
+    def __init__(self, limiter):
+	self.limiter = limiter
+	self.ts = time.time()
+	self.released = False
+
+    # the response headers came in
+    def answered(self):
+	self.limiter._answered(time.time() - self.ts)
+
+    def throttled(self, retry_after=None):
+	self.limiter._throttled(retry_after)
+
+    def release(self, nbytes=0):
+	if self.released:
+	    return
+	self.released = True
+	self.limiter._release(nbytes)
+
+# How many requests may go to one CDN host at once. The limit grows by one
+# per limit's worth of requests that went through while others were waiting
+# for a place, and shrinks by a factor when the host throttles or answers
+# much slower than it can, or when the last increase bought no throughput.
+# Waiting requests get their place in order of priority, lowest first. A
+# host that throttles at a limit of one gets no requests for as long as its
+# Retry-After asked.
+class HostLimiter(object):
+    def __init__(self, host, max_limit, initial=INITIAL):
+	self.host = host
+	self.max_limit = max(MIN_LIMIT, max_limit)
+	self.limit = float(max(MIN_LIMIT, min(initial, self.max_limit)))
+	self.active = 0
+	self.waiting = []
+	self.seq = itertools.count()
+	self.cond = threading.Condition()
+	# no requests before this, after a throttle
+	self.resume_at = 0
+	(self.best, self.decreased_at) = (None, 0)
+	# throughput of the last window, and the limit it was had at
+	(self.window_ts, self.window_bytes) = (time.time(), 0)
+	(self.rate, self.rate_limit) = (None, None)
+	(self.requests, self.throttles) = (0, 0)
+
+    def acquire(self, priority=PRIORITY_REPOMD):
+	with self.cond:
+	    entry = (priority, next(self.seq))
+	    heapq.heappush(self.waiting, entry)
+	    try:
+		while True:
+		    pause = self.resume_at - time.time()
+		    if pause <= 0 and self.waiting[0] == entry and self.active < int(self.limit):
+			break
+		    # wait in short steps so a KeyboardInterrupt still gets through
+		    self.cond.wait(min(pause, 1) if pause > 0 else 1)
+	    except:
+		self.waiting.remove(entry)
+		heapq.heapify(self.waiting)
+		self.cond.notify_all()
+		raise
+	    heapq.heappop(self.waiting)
+	    self.active += 1
+	    self.requests += 1
+	    # the next in line may fit too
+	    self.cond.notify_all()
+	return Slot(self)
+
+    def _decrease(self, factor, why):
+	now = time.time()
+	if now - self.decreased_at < COOLDOWN:
+	    return
+	self.decreased_at = now
+	limit = max(MIN_LIMIT, self.limit * factor)
+	if int(limit) < int(self.limit):
+	    log.info('%s: %s, down to %d requests at once', self.host, why, int(limit))
+	self.limit = limit
+
+    def _answered(self, latency):
+	with self.cond:
+	    if self.best is None or latency < self.best:
+		self.best = latency
+	    if latency > LATENCY_SLACK * max(self.best, MIN_LATENCY):
+		self._decrease(LATENCY_DECREASE, 'answer took {:.3f} seconds'.format(latency))
+
+    # the throttled request waits out retry_after on its own; the rest of
+    # the host's only do once fewer of them at once can not help any more
+    def _throttled(self, retry_after):
+	with self.cond:
+	    self.throttles += 1
+	    pause = retry_after if retry_after is not None else THROTTLE_PAUSE
+	    if int(self.limit) <= MIN_LIMIT:
+		self.resume_at = max(self.resume_at, time.time() + pause)
+	    self._decrease(THROTTLE_DECREASE, 'throttled for {:.1f} seconds'.format(pause))
+
+    def _release(self, nbytes):
+	with self.cond:
+	    self.active -= 1
+	    self.window_bytes += nbytes
+	    # a limit nobody is waiting on says nothing about the host
+	    if self.waiting:
+		self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+		self._measure()
+	    self.cond.notify_all()
+
+    def _measure(self):
+	now = time.time()
+	if now - self.window_ts < RATE_WINDOW:
+	    return
+	rate = self.window_bytes / (now - self.window_ts)
+	if self.rate is not None and int(self.limit) > self.rate_limit and rate < self.rate * RATE_GAIN:
+	    log.debug('%s: %d requests at once are no faster than %d', self.host, int(self.limit), self.rate_limit)
+	    self.limit = float(self.rate_limit)
+	(self.window_ts, self.window_bytes) = (now, 0)
+	(self.rate, self.rate_limit) = (rate, int(self.limit))
@@ -0,0 +1,520 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A stand-in for the CDN, to run stats against offline. setup makes repos
+with repostats.bench, a CA, a server cert, and a cert dir of entitlement
+certs whose content points at the repos. serve serves them over https to
+clients with one of those certs, with as much latency, as little bandwidth
+and as many errors as asked for. load runs stats on the repos again and
+again and reports throughput and latency percentiles from its trace.
+
+usage:
+
+$ python -mrepostats.mockcdn setup /tmp/cdn --repos 40 --packages 5000
+$ python -mrepostats.mockcdn serve /tmp/cdn --latency 0.05 --bandwidth 2000000 --errors 0.02 &
+$ python -mrepostats.mockcdn load /tmp/cdn --jobs 8 --rounds 3 -- --hedge 95
+$ python -mrepostats.tool stats --certdir /tmp/cdn/certs --cacert /tmp/cdn/ca.pem --cdn https://localhost:8443/ --filter mock-
+
+load --serve runs the mock CDN itself for as long as it takes.
+"""
+import os, sys, re, ssl, json, time, random, shutil, socket, logging, tempfile, threading, subprocess
+import email.utils, BaseHTTPServer, SocketServer
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+log = logging.getLogger(__name__)
+
+# where Red Hat keeps what an entitlement cert entitles to; see python-rhsm
+RH_OID = '1.3.6.1.4.1.2312.9'
+PRODUCT_ID = 69
+# content urls the certs hand out, and labels of the repos at them
+CONTENT_URL = '/content/dist/mock/$releasever/$basearch/repo-{}'
+LABEL = 'mock-repo-{}-rpms'
+DAYS = 3650
+STATS_PATH = '/_stats'
+CHUNK_SIZE = 16384
+# how far a bandwidth cap lets a transfer get ahead, in seconds
+BURST = 0.1
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# the same repos keep the same numbers, so a cert dir can be made again
+def _serial(i):
+    return 4000000000000000000 + i
+
+def _openssl(openssl, *args):
+    proc = subprocess.Popen((openssl,) + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+	raise RuntimeError('openssl {} failed: {}'.format(args[0], out.strip()))
+
+# a new key, and a cert for it signed by the CA with extensions
+def _sign(openssl, base, subject, serial, root, extensions):
+    conf = base + '.cnf'
+    with open(conf, 'w') as f_out:
+	# content urls have $ in them, which openssl would take for variables
+	f_out.write('[ext]\n' + ''.join('{} = {}\n'.format(k, v.replace('$', '\\$')) for (k, v) in extensions))
+    try:
+	_openssl(openssl, 'req', '-new', '-newkey', 'rsa:2048', '-nodes', '-keyout', base + '-key.pem',
+		'-out', base + '.csr', '-subj', subject)
+	_openssl(openssl, 'x509', '-req', '-in', base + '.csr', '-CA', os.path.join(root, 'ca.pem'),
+		'-CAkey', os.path.join(root, 'ca-key.pem'), '-set_serial', str(serial),
+		'-days', str(DAYS), '-sha256', '-extfile', conf, '-extensions', 'ext', '-out', base + '.pem')
+    finally:
+	for tmp in (conf, base + '.csr'):
+	    if os.path.exists(tmp):
+		os.remove(tmp)
+
+# the extensions of a version 1 entitlement cert, the kind python-rhsm reads
+# content from oids; one product, one order, and a content set per repo
+def entitlementExtensions(repos, order):
+    ext = [ ('basicConstraints', 'CA:FALSE'), ('keyUsage', 'digitalSignature, keyEncipherment, dataEncipherment'),
+	    ('extendedKeyUsage', 'clientAuth') ]
+    def utf8(oid, value):
+	ext.append(('{}.{}'.format(RH_OID, oid), 'ASN1:UTF8String:{}'.format(value)))
+    utf8(6, '1.0')
+    for (n, value) in ((1, 'Mock Enterprise Linux Server'), (2, '7'), (3, 'x86_64'), (4, 'mock-server-7')):
+	utf8('1.{}.{}'.format(PRODUCT_ID, n), value)
+    # valid for as long as the cert itself
+    now = time.time()
+    (start, end) = [ time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t)) for t in (now, now + DAYS * 86400) ]
+    for (n, value) in ((1, 'Mock Subscription'), (2, order), (3, 'MCK0001'), (5, 1), (6, start), (7, end)):
+	utf8('4.{}'.format(n), value)
+    for i in repos:
+	content = 10000 + i
+	utf8('2.{}.1'.format(content), 'yum')
+	for (n, value) in ((1, 'Mock Repo {}'.format(i)), (2, LABEL.format(i)), (5, 'repostats'), (6, CONTENT_URL.format(i)), (8, 1)):
+	    utf8('2.{}.1.{}'.format(content, n), value)
+    return ext
+
+# repos at root/content, the CA and a server cert for localhost, and a cert
+# dir at root/certs with per_cert repos on every entitlement cert
+def setup(root, repos, packages, errata, per_cert=10, releasever='7Server', basearch='x86_64', openssl='openssl'):
+    certs = os.path.join(root, 'certs')
+    for d in (root, certs):
+	if not os.path.isdir(d):
+	    os.makedirs(d)
+    from repostats.bench import makeRepo
+    for i in range(repos):
+	path = os.path.join(root, CONTENT_URL.format(i).lstrip('/').replace('$releasever', releasever).replace('$basearch', basearch))
+	if os.path.exists(os.path.join(path, 'repodata', 'repomd.xml')):
+	    continue
+	# a few big repos and a lot of small ones, every one different
+	count = max(100, packages // (1 + i % 4))
+	log.warn('Generating %s with %d packages', LABEL.format(i), count)
+	makeRepo(path, count, errata // (1 + i % 3), seed=i)
+    if not os.path.exists(os.path.join(root, 'ca.pem')):
+	_openssl(openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', os.path.join(root, 'ca-key.pem'),
+		'-out', os.path.join(root, 'ca.pem'), '-subj', '/CN=repostats mock CDN CA', '-days', str(DAYS), '-sha256')
+	_sign(openssl, os.path.join(root, 'server'), '/CN=localhost', _serial(0), root, [
+	    ('basicConstraints', 'CA:FALSE'), ('extendedKeyUsage', 'serverAuth'),
+	    ('subjectAltName', 'DNS:localhost,IP:127.0.0.1') ])
+    for old in os.listdir(certs):
+	os.remove(os.path.join(certs, old))
+    for first in range(0, repos, per_cert):
+	serial = _serial(first + 1)
+	_sign(openssl, os.path.join(certs, str(serial)), '/CN={}'.format(serial), serial, root,
+		entitlementExtensions(range(first, min(first + per_cert, repos)), serial))
+    with open(os.path.join(root, 'mock.json'), 'w') as f_out:
+	json.dump({ 'repos': repos, 'releasever': releasever, 'basearch': basearch }, f_out)
+
+# hands out rate bytes a second to whoever shares it
+class Bucket(object):
+    def __init__(self, rate):
+	self.rate = float(rate)
+	self.tokens = 0
+	self.ts = time.time()
+	self.lock = threading.Lock()
+
+    def take(self, n):
+	with self.lock:
+	    now = time.time()
+	    self.tokens = min(self.rate * BURST, self.tokens + (now - self.ts) * self.rate)
+	    self.ts = now
+	    # go into debt, and pay it off before anyone else gets any
+	    self.tokens -= n
+	    wait = -self.tokens / self.rate
+	if wait > 0:
+	    time.sleep(wait)
+
+class MockCdnHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+	self._serve(True)
+
+    def do_HEAD(self):
+	self._serve(False)
+
+    def log_message(self, format, *args):
+	log.debug('%s %s', self.address_string(), format % args)
+
+    def _send(self, status, headers, body=''):
+	self.send_response(status)
+	headers.setdefault('content-length', str(len(body)))
+	for (k, v) in sorted(headers.items()):
+	    self.send_header(k, v)
+	self.end_headers()
+	if body and self.command != 'HEAD':
+	    self.wfile.write(body)
+	self.server.count(status, len(body))
+
+    def _serve(self, with_body):
+	server = self.server
+	if self.path.split('?')[0] == STATS_PATH:
+	    self._send(200, { 'content-type': 'application/json' }, json.dumps(server.stats()))
+	    return
+	server.delay()
+	if not server.enter():
+	    self._send(429, { 'retry-after': str(server.retry_after) })
+	    return
+	try:
+	    self._file(with_body)
+	finally:
+	    server.leave()
+
+    def _file(self, with_body):
+	server = self.server
+	roll = random.random()
+	if roll < server.errors:
+	    self._send(random.choice((500, 502, 503)), {})
+	    return
+	path = server.resolve(self.path)
+	if path is None:
+	    self._send(404, {})
+	    return
+	st = os.stat(path)
+	size = st.st_size
+	etag = '"{:x}-{:x}"'.format(int(st.st_mtime), size)
+	if server.weak_etags:
+	    etag = 'W/' + etag
+	modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+	headers = { 'etag': etag, 'last-modified': modified, 'accept-ranges': 'bytes' if server.ranges else 'none' }
+	match = self.headers.get('if-none-match')
+	if (match is not None and etag in [ m.strip() for m in match.split(',') ]) or (match is None and self.headers.get('if-modified-since') == modified):
+	    self._send(304, headers)
+	    return
+	(start, end, status) = (0, size - 1, 200)
+	m = RANGE.match(self.headers.get('range') or '')
+	if server.ranges and m is not None and (m.group(1) or m.group(2)) and self._ifRange(etag, modified):
+	    if not m.group(1):
+		start = max(0, size - int(m.group(2)))
+	    else:
+		(start, end) = (int(m.group(1)), min(end, int(m.group(2) or end)))
+	    if start > end:
+		headers['content-range'] = 'bytes */{}'.format(size)
+		self._send(416, headers)
+		return
+	    status = 206
+	    headers['content-range'] = 'bytes {}-{}/{}'.format(start, end, size)
+	length = end - start + 1
+	headers['content-length'] = str(length)
+	self.send_response(status)
+	for (k, v) in sorted(headers.items()):
+	    self.send_header(k, v)
+	self.end_headers()
+	if not with_body:
+	    server.count(status, 0)
+	    return
+	# cut a body short half way
+	drop = length // 2 if random.random() < server.drops else None
+	sent = self._copy(path, start, length, drop)
+	server.count(status, sent, sent < length)
+
+    # strong validators only, like a range request needs
+    def _ifRange(self, etag, modified):
+	value = self.headers.get('if-range')
+	if value is None:
+	    return True
+	if value.startswith('"') or value.startswith('W/'):
+	    return value == etag and not etag.startswith('W/')
+	return value == modified
+
+    def _copy(self, path, start, length, drop):
+	server = self.server
+	buckets = [ b for b in (Bucket(server.bandwidth) if server.bandwidth else None, server.link) if b is not None ]
+	sent = 0
+	with open(path, 'rb') as f_in:
+	    f_in.seek(start)
+	    while sent < length:
+		n = min(CHUNK_SIZE, length - sent)
+		if drop is not None:
+		    n = min(n, drop - sent)
+		    if n <= 0:
+			self.close_connection = True
+			self.wfile.flush()
+			self.connection.shutdown(socket.SHUT_RDWR)
+			break
+		data = f_in.read(n)
+		for b in buckets:
+		    b.take(len(data))
+		self.wfile.write(data)
+		sent += len(data)
+	return sent
+
+# Serves root, like the CDN does, to clients with a cert cacert signed.
+#
+# latency: seconds every request waits before it is answered, plus an
+#   exponential tail that averages jitter seconds
+# bandwidth: bytes a second per connection; link: bytes a second for all of
+#   them together; 0 for as fast as it goes
+# errors: fraction of requests that get a 5xx; drops: fraction of bodies
+#   cut off half way
+# max_active: requests at once before the rest get a 429 with Retry-After
+# ranges: honor Range and If-Range; weak_etags: hand out W/ etags, which
+#   If-Range never matches
+class MockCdn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root, cert=None, key=None, cacert=None, latency=0, jitter=0, bandwidth=0, link=0,
+	    errors=0, drops=0, max_active=0, retry_after=1, ranges=True, weak_etags=False):
+	BaseHTTPServer.HTTPServer.__init__(self, address, MockCdnHandler)
+	self.root = os.path.realpath(root)
+	self.context = None
+	if cert is not None:
+	    self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+	    self.context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+	    self.context.load_cert_chain(cert, key)
+	    if cacert is not None:
+		self.context.verify_mode = ssl.CERT_REQUIRED
+		self.context.load_verify_locations(cacert)
+	(self.latency, self.jitter) = (latency, jitter)
+	self.bandwidth = bandwidth
+	self.link = Bucket(link) if link else None
+	(self.errors, self.drops) = (errors, drops)
+	(self.max_active, self.retry_after) = (max_active, retry_after)
+	(self.ranges, self.weak_etags) = (ranges, weak_etags)
+	self.lock = threading.Lock()
+	self.active = 0
+	self.counts = { 'requests': 0, 'bytes': 0, 'dropped': 0, 'rejected': 0, 'status': {} }
+
+    @property
+    def url(self):
+	(host, port) = self.server_address[:2]
+	# the trailing slash is a path, which CertFinder wants a cdn to have
+	return '{}://{}:{}/'.format('https' if self.context is not None else 'http', 'localhost' if host in ('127.0.0.1', '0.0.0.0') else host, port)
+
+    # the handshake happens on the request's own thread, so a slow client
+    # does not hold up accept()
+    def finish_request(self, request, client_address):
+	if self.context is not None:
+	    try:
+		request = self.context.wrap_socket(request, server_side=True)
+	    except (ssl.SSLError, socket.error), ex:
+		log.info('Rejected %s: %s', client_address[0], ex)
+		with self.lock:
+		    self.counts['rejected'] += 1
+		return
+	BaseHTTPServer.HTTPServer.finish_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+	log.debug('Error serving %s', client_address[0], exc_info=True)
+
+    def resolve(self, url_path):
+	path = os.path.realpath(os.path.join(self.root, url_path.split('?')[0].lstrip('/')))
+	if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+	    return None
+	return path
+
+    def delay(self):
+	wait = self.latency + (random.expovariate(1.0 / self.jitter) if self.jitter else 0)
+	if wait > 0:
+	    time.sleep(wait)
+
+    def enter(self):
+	with self.lock:
+	    if self.max_active and self.active >= self.max_active:
+		return False
+	    self.active += 1
+	    return True
+
+    def leave(self):
+	with self.lock:
+	    self.active -= 1
+
+    def count(self, status, nbytes, dropped=False):
+	with self.lock:
+	    self.counts['requests'] += 1
+	    self.counts['bytes'] += nbytes
+	    self.counts['dropped'] += dropped
+	    self.counts['status'][str(status)] = self.counts['status'].get(str(status), 0) + 1
+
+    def stats(self):
+	with self.lock:
+	    return json.loads(json.dumps(self.counts))
+
+def newServer(args):
+    root = args.root
+    return MockCdn((args.bind, args.port), root, os.path.join(root, 'server.pem'), os.path.join(root, 'server-key.pem'),
+	    os.path.join(root, 'ca.pem'), args.latency, args.jitter, args.bandwidth, args.link, args.errors, args.drops,
+	    args.max_active, args.retry_after, not args.no_ranges, args.weak_etags)
+
+def _percentile(values, p):
+    if not values:
+	return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+def _line(what, values, unit='s'):
+    return '  {:<18} p50 {:8.3f}{u} p90 {:8.3f}{u} p99 {:8.3f}{u} max {:8.3f}{u}  ({} samples)'.format(what,
+	    _percentile(values, 50), _percentile(values, 90), _percentile(values, 99), max(values or [0]), len(values), u=unit)
+
+# what a stats run did, from the spans in its trace
+def summarize(spans, elapsed, failed, repos):
+    (starts, ends) = ({}, {})
+    for s in spans:
+	starts[s['repo']] = min(starts.get(s['repo'], s['ts']), s['ts'] - s['seconds'])
+	ends[s['repo']] = max(ends.get(s['repo'], 0), s['ts'])
+    downloaded = sum(s.get('bytes', 0) for s in spans if s['phase'] == 'download' and not s.get('stored'))
+    requests = [ s for s in spans if s['phase'] == 'ttfb' ]
+    lines = [ '{} repos in {:.2f}s, {} failed: {:.1f} repos/s, {:.2f} MB at {:.2f} MB/s, {} requests at {:.1f}/s'.format(
+	repos, elapsed, failed, repos / elapsed, downloaded / 1048576.0, downloaded / 1048576.0 / elapsed, len(requests), len(requests) / elapsed) ]
+    lines.append(_line('time to 1st byte', [ s['seconds'] for s in requests ]))
+    lines.append(_line('connect', [ s['seconds'] for s in spans if s['phase'] == 'connect' ]))
+    lines.append(_line('repo', [ ends[r] - starts[r] for r in starts ]))
+    return lines
+
+def _serverStats(root, url, cert):
+    import requests
+    try:
+	resp = requests.get(url.rstrip('/') + STATS_PATH, cert=cert, verify=os.path.join(root, 'ca.pem'), timeout=10)
+	return resp.json()
+    except Exception, ex:
+	log.warn('Unable to get stats from %s: %s', url, ex)
+	return None
+
+# runs stats on the first repos repos of the mock CDN at url, rounds times,
+# and prints what each run did; stats_args go to every run as they are
+def load(root, url, jobs=8, rounds=3, repos=None, warm=False, stats_args=()):
+    with open(os.path.join(root, 'mock.json')) as f_in:
+	meta = json.load(f_in)
+    repos = min(repos or meta['repos'], meta['repos'])
+    certs = os.path.join(root, 'certs')
+    cert = sorted(f for f in os.listdir(certs) if not f.endswith('-key.pem'))[0]
+    cert = (os.path.join(certs, cert), os.path.join(certs, cert.replace('.pem', '-key.pem')))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+    work = tempfile.mkdtemp(prefix='repostats-load-')
+    try:
+	for r in range(rounds):
+	    cache_dir = os.path.join(work, 'cache' if warm else 'cache-{}'.format(r))
+	    trace = os.path.join(work, 'trace-{}.json'.format(r))
+	    argv = [ sys.executable, '-m', 'repostats.tool', 'stats', '--certdir', certs, '--cacert', os.path.join(root, 'ca.pem'),
+		    '--cdn', url, '-r', meta['releasever'], '-b', meta['basearch'], '-j', str(jobs), '--cache-dir', cache_dir,
+		    '--trace', trace, '--filter', '^mock-repo-({})-rpms$'.format('|'.join(str(i) for i in range(repos))) ] + list(stats_args)
+	    before = _serverStats(root, url, cert)
+	    with open(os.devnull, 'w') as devnull:
+		ts = time.time()
+		failed = subprocess.call(argv, stdout=devnull, env=env)
+		elapsed = time.time() - ts
+	    if not os.path.exists(trace):
+		raise RuntimeError('stats exited with {} before it started on any repo'.format(failed))
+	    with open(trace) as f_in:
+		spans = [ json.loads(l) for l in f_in ]
+	    print 'round {}:'.format(r + 1),
+	    print '\n'.join(summarize(spans, elapsed, failed, repos))
+	    after = _serverStats(root, url, cert)
+	    if before is not None and after is not None:
+		status = dict((k, v - before['status'].get(k, 0)) for (k, v) in after['status'].items() if v != before['status'].get(k, 0))
+		print '  server: {} requests, {} cut short, {} handshakes rejected, status {}'.format(after['requests'] - before['requests'],
+			after['dropped'] - before['dropped'], after['rejected'] - before['rejected'],
+			' '.join('{}={}'.format(k, v) for (k, v) in sorted(status.items())))
+	    sys.stdout.flush()
+    finally:
+	shutil.rmtree(work, True)
+
+def serverOptions(parser):
+    parser.add_argument('--bind', default='127.0.0.1', help='Address to serve on')
+    parser.add_argument('--port', type=int, default=8443, help='Port to serve on')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds every request waits before it is answered')
+    parser.add_argument('--jitter', type=float, default=0, help='Average of an exponential tail of more seconds to wait on top of --latency')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Bytes a second per connection; 0 for no cap')
+    parser.add_argument('--link', type=int, default=0, help='Bytes a second for all connections together; 0 for no cap')
+    parser.add_argument('--errors', type=float, default=0, help='Fraction of requests to answer with a 5xx')
+    parser.add_argument('--drops', type=float, default=0, help='Fraction of bodies to cut off half way')
+    parser.add_argument('--max-active', type=int, default=0, help='Requests at once before the rest get a 429; 0 for no limit')
+    parser.add_argument('--retry-after', type=int, default=1, help='Seconds a 429 asks the client to wait')
+    parser.add_argument('--no-ranges', action='store_true', help='Ignore Range requests and always send the whole file')
+    parser.add_argument('--weak-etags', action='store_true', help='Hand out weak etags, which If-Range never matches')
+
+def main():
+    parser = ArgumentParser(description='A local stand-in for the CDN', formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+    sub_parser = parser.add_subparsers(help='commands to invoke')
+
+    parser_sub = sub_parser.add_parser('setup', help='Generate repos, a CA, a server cert and a cert dir of entitlement certs', formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_sub.add_argument('root', help='Directory to put it all in')
+    parser_sub.add_argument('--repos', type=int, default=20, help='Repos to make')
+    parser_sub.add_argument('--packages', type=int, default=2000, help='Packages in the biggest repos; others get a half, a third or a quarter of that')
+    parser_sub.add_argument('--errata', type=int, default=500, help='Errata in the repos with the most')
+    parser_sub.add_argument('--per-cert', type=int, default=10, help='Repos per entitlement cert')
+    parser_sub.add_argument('-r', '--releasever', default='7Server', help='Release version to put the repos under')
+    parser_sub.add_argument('-b', '--basearch', default='x86_64', help='Base Architecture to put the repos under')
+    parser_sub.add_argument('--openssl', default='openssl', help='openssl binary to make the certs with')
+    parser_sub.set_defaults(section='setup')
+
+    parser_sub = sub_parser.add_parser('serve', help='Serve the repos over https to clients with an entitlement cert', formatter_class=ArgumentDefaultsHelpFormatter)
+    parser_sub.add_argument('root', help='Directory setup made')
+    serverOptions(parser_sub)
+    parser_sub.set_defaults(section='serve')
+
+    parser_sub = sub_parser.add_parser('load', help='Run stats on the repos again and again and report how it went', formatter_class=ArgumentDefaultsHelpFormatter,
+	    epilog='Options after -- go to every stats run as they are.')
+    parser_sub.add_argument('root', help='Directory setup made')
+    parser_sub.add_argument('--url', help='Mock CDN to run against; default the one --serve starts, or https://localhost:PORT')
+    parser_sub.add_argument('--serve', action='store_true', help='Serve the mock CDN from this process while the load runs')
+    parser_sub.add_argument('-j', '--jobs', type=int, default=8, help='Repos to process at the same time')
+    parser_sub.add_argument('--rounds', type=int, default=3, help='Stats runs to make')
+    parser_sub.add_argument('--repos', type=int, help='Only run on this many of the repos; default all')
+    parser_sub.add_argument('--warm', action='store_true', help='Keep the cache between rounds, like a cron job would')
+    serverOptions(parser_sub)
+    parser_sub.set_defaults(section='load')
+    # argparse would take options meant for stats for its own
+    argv = sys.argv[1:]
+    stats_args = []
+    if '--' in argv:
+	(argv, stats_args) = (argv[:argv.index('--')], argv[argv.index('--') + 1:])
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARN, format='%(message)s')
+
+    if args.section == 'setup':
+	setup(args.root, args.repos, args.packages, args.errata, args.per_cert, args.releasever, args.basearch, args.openssl)
+	print 'Made {} repos; run stats with --certdir {} --cacert {}'.format(args.repos, os.path.join(args.root, 'certs'), os.path.join(args.root, 'ca.pem'))
+	return 0
+    server = None
+    if args.section == 'serve' or args.serve:
+	server = newServer(args)
+	log.warn('Serving %s on %s', args.root, server.url)
+	if args.section == 'serve':
+	    try:
+		server.serve_forever()
+	    finally:
+		server.server_close()
+	    return 0
+	t = threading.Thread(target=server.serve_forever, name='mockcdn')
+	t.daemon = True
+	t.start()
+    try:
+	url = args.url or (server.url if server is not None else 'https://localhost:{}/'.format(args.port))
+	load(args.root, url, args.jobs, args.rounds, args.repos, args.warm, stats_args)
+    finally:
+	if server is not None:
+	    server.shutdown()
+	    server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
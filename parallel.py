@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+# 
+# This file is part of repostats
+# 
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Parse a primary.xml on several processes: the file is split into byte
+ranges that start on a <package> element, every range is parsed by its
+own handler wrapped in a bare <metadata> root, and the partial results are
+merged into the handler that parsed the prologue and epilogue of the file.
+
+usage to time it against the serial parse:
+
+$ python -mrepostats.parallel primary.xml -p 1 2 4 8
+"""
+import os, sys, mmap, time, logging, multiprocessing
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from repostats.repomd import SpoolHandler, PrimaryStatsHandler, PrimaryDetailHandler
+
+log = logging.getLogger(__name__)
+
+# a package element always has a type attribute, which tells it from <packager>
+TAG = '<package '
+ROOT_END = '</metadata>'
+FEED_SIZE = 1048576
+
+def splitRanges(mm, parts):
+    first = mm.find(TAG)
+    last = mm.rfind(ROOT_END)
+    if first == -1 or last < first:
+	return []
+    bounds = [ first ]
+    for i in range(1, parts):
+	pos = mm.find(TAG, first + (last - first) * i / parts)
+	if pos == -1 or pos >= last:
+	    break
+	if pos > bounds[-1]:
+	    bounds.append(pos)
+    bounds.append(last)
+    return zip(bounds[:-1], bounds[1:])
+
+def feedRange(handler, mm, start, end):
+    for pos in xrange(start, end, FEED_SIZE):
+	handler.feed(mm[pos:min(pos + FEED_SIZE, end)])
+
+# runs in a worker process
+def parseRange(args):
+    (cls, path, start, end) = args
+    handler = cls()
+    with open(path, 'rb') as f_in:
+	mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+	    handler.begin()
+	    handler.feed('<metadata>')
+	    feedRange(handler, mm, start, end)
+	    handler.feed(ROOT_END)
+	    handler.finish()
+	finally:
+	    mm.close()
+    return handler.partial()
+
+# The processes every parallel parse of a run shares. Make it on the main
+# thread before any other thread starts: a process forked while another
+# thread holds a lock starts with that lock held for good.
+class ParsePool(object):
+    def __init__(self, processes):
+	self.processes = processes
+	self.pool = multiprocessing.Pool(processes)
+
+    def map(self, func, items):
+	return self.pool.map(func, items)
+
+    def close(self):
+	self.pool.close()
+	self.pool.join()
+
+def parseParallel(handler, path, pool):
+    handler.begin()
+    if os.path.getsize(path) == 0:
+	handler.finish()
+	return handler
+    with open(path, 'rb') as f_in:
+	mm = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+	    ranges = splitRanges(mm, pool.processes)
+	    if not ranges:
+		feedRange(handler, mm, 0, len(mm))
+		handler.finish()
+		return handler
+	    feedRange(handler, mm, 0, ranges[0][0])
+	    # the prologue may have been all the handler needed
+	    if not handler.done:
+		log.info('%s: parsing %d ranges on %d processes', handler.cls, len(ranges), pool.processes)
+		partials = pool.map(parseRange, [ (handler.__class__, path, s, e) for (s, e) in ranges ])
+		for p in partials:
+		    handler.merge(p)
+		feedRange(handler, mm, ranges[-1][1], len(mm))
+	    handler.finish()
+	finally:
+	    mm.close()
+    return handler
+
+# stands in for handler while the download is spooled, then parses it in parallel
+class ParallelSpool(SpoolHandler):
+    SUFFIX = '.xml'
+
+    def __init__(self, handler, pool):
+	super(ParallelSpool, self).__init__()
+	self.handler = handler
+	self.pool = pool
+	self.value = 0
+
+    def _do(self, path):
+	parseParallel(self.handler, path, self.pool)
+	self.value = self.handler.value
+
+    def check(self):
+	self.failed = self.handler.failed
+
+def main():
+    parser = ArgumentParser(description='Time parallel parsing of an uncompressed primary.xml', formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', help='uncompressed primary.xml')
+    parser.add_argument('-p', '--processes', type=int, nargs='+', default=[1, 2, 4, 8], help='process counts to try')
+    parser.add_argument('--detail', action='store_true', help='use the --detail handler instead of the package count')
+    args = parser.parse_args()
+    factory = PrimaryDetailHandler if args.detail else lambda: PrimaryStatsHandler(fast=False)
+
+    ts = time.time()
+    serial = factory()
+    serial.parse(args.path)
+    base = time.time() - ts
+    print 'serial: {:.3f} seconds, {} packages'.format(base, serial.value)
+    for n in args.processes:
+	ts = time.time()
+	pool = ParsePool(n)
+	try:
+	    handler = parseParallel(factory(), args.path, pool)
+	finally:
+	    pool.close()
+	elapsed = time.time() - ts
+	print '{:2d} processes: {:.3f} seconds, {:.2f}x, {}'.format(n, elapsed, base / elapsed,
+		'identical' if handler.result() == serial.result() else 'MISMATCH')
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+# 
+# This file is part of repostats
+# 
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import threading, logging, Queue
+
+log = logging.getLogger(__name__)
+
+def runPool(func, items, workers):
+    # call func(item) for every item on at most workers threads
+    queue = Queue.Queue()
+    for item in items:
+	queue.put(item)
+
+    def worker():
+	while True:
+	    try:
+		item = queue.get_nowait()
+	    except Queue.Empty:
+		return
+	    func(item)
+
+    threads = [ threading.Thread(target=worker) for i in range(max(1, min(workers, len(items)))) ]
+    log.debug('Starting %d workers for %d items', len(threads), len(items))
+    for t in threads:
+	t.daemon = True
+	t.start()
+    for t in threads:
+	# join with a timeout so a KeyboardInterrupt still reaches the main thread
+	while t.is_alive():
+	    t.join(1)
@@ -21,6 +21,8 @@ from datetime import timedelta, tzinfo, datetime
 import tempfile
 
 ZERO = timedelta(0)
+# how many entries between progress messages
+PROGRESS = 50000
 
 # A UTC class.
 class UTC(tzinfo):
@@ -36,51 +38,313 @@ utc = UTC()
 log = logging.getLogger(__name__)
 _log = logging.getLogger('_.' + __name__)
 
+# raised from a callback once a handler has everything it needs
+class ParseComplete(Exception):
+    pass
+
 class Handler(object):
+    # attributes that make up the result of a parse; see result() and restore()
+    RESULT = ()
+
     def __init__(self):
 	self.initialized = False
 	self.failed = False
+	self.done = False
 	self.cls = self.__class__.__name__
 
     def parse(self, fileobj):
-	log.info('%s: Starting parse', self.cls)
-	ts = time.time()
+	self.begin()
 	self._do(fileobj)
+	self._complete()
+
+    # streaming interface: begin(), feed() for every chunk, then finish()
+    def begin(self):
+	log.info('%s: Starting parse', self.cls)
+	self.ts_begin = time.time()
+
+    def feed(self, data):
+	pass
+
+    def finish(self):
+	self._flush()
+	self._complete()
+
+    def abort(self):
+	pass
+
+    def _flush(self):
+	pass
+
+    # called once the whole input went through, from parse() or finish()
+    def _finalize(self):
+	pass
+
+    def _complete(self):
+	self._finalize()
 	self.check()
 	self.initialized = True
-	_log.info('%s: Completed parse: failed=%s in %.3f seconds', self.cls, self.failed, time.time() - ts)
+	_log.info('%s: Completed parse: failed=%s in %.3f seconds', self.cls, self.failed, time.time() - self.ts_begin)
 
     def check(self):
 	self.failed = True
 
+    # everything result() hands out, to tell if a cached result is complete
+    def resultKeys(self):
+	return tuple(self.RESULT)
+
+    def result(self):
+	return dict((k, getattr(self, k)) for k in self.RESULT)
+
+    # load a previous result() instead of parsing anything
+    def restore(self, result):
+	for k in self.RESULT:
+	    setattr(self, k, result[k])
+	self.check()
+	self.initialized = True
+	_log.info('%s: Restored previous result: failed=%s', self.cls, self.failed)
+
     def _do(self, fileobj):
 	pass
 
-class PrimaryDbSqlHandler(Handler):
+# package aggregates that --detail reports, from either primary variant
+class PackageDetail(object):
+    DETAIL = ('value', 'arches', 'names', 'latest', 'size_package', 'size_installed', 'size_archive', 'newest_build')
+
+    def initDetail(self):
+	self.arches = {}
+	# unique names, and unique name.arch pairs: each pair has one latest version
+	(self.names, self.latest) = (0, 0)
+	(self.size_package, self.size_installed, self.size_archive) = (0, 0, 0)
+	self.newest_build = None
+
+# collects the open payload in a temp file and hands its path to _do()
+class SpoolHandler(Handler):
+    SUFFIX = ''
+
     def __init__(self):
+	super(SpoolHandler, self).__init__()
+	self.tmp = None
+
+    # a file already on disk needs no spooling
+    def parse(self, path):
+	super(SpoolHandler, self).begin()
+	self._do(path)
+	self._complete()
+
+    def begin(self):
+	super(SpoolHandler, self).begin()
+	self.tmp = tempfile.mkstemp(suffix=self.SUFFIX)
+
+    def feed(self, data):
+	os.write(self.tmp[0], data)
+
+    def _flush(self):
+	try:
+	    os.close(self.tmp[0])
+	    # closing it twice could close a file another thread just opened
+	    self.tmp = (None, self.tmp[1])
+	    self._do(self.tmp[1])
+	finally:
+	    self.abort()
+
+    def abort(self):
+	if self.tmp is None:
+	    return
+	try:
+	    if self.tmp[0] is not None:
+		os.close(self.tmp[0])
+	except OSError:
+	    pass
+	try:
+	    os.remove(self.tmp[1])
+	except OSError:
+	    pass
+	self.tmp = None
+
+# sqlite can only open a real file, so the open payload is spooled to disk
+class PrimaryDbSqlHandler(SpoolHandler, PackageDetail):
+    RESULT = ('value',)
+    DETAIL_QUERIES = (
+	    'select count(*), count(distinct name), count(distinct name || \'.\' || arch),'
+	    ' sum(size_package), sum(size_installed), sum(size_archive), max(time_build) from packages',
+	    'select arch, count(*) from packages group by arch',
+	    )
+    SUFFIX = '.sqlite'
+
+    def __init__(self, detail=False):
 	super(PrimaryDbSqlHandler, self).__init__()
 	self.value = 0
+	self.t_query = 0
+	self.detail = detail
+	if detail:
+	    self.RESULT = self.DETAIL
+	    self.initDetail()
 
     def _do(self, fileobj):
 	import sqlite3
-	with sqlite3.connect(fileobj) as conn:
-	    c = conn.cursor()
-	    for row in c.execute('select count(*) as cnt from packages'):
-		self.value = row[0]
+	ts = time.time()
+	try:
+	    with sqlite3.connect(fileobj) as conn:
+		c = conn.cursor()
+		if self.detail:
+		    self._doDetail(c)
+		    return
+		for row in c.execute('select count(*) as cnt from packages'):
+		    self.value = row[0]
+	finally:
+	    self.t_query = time.time() - ts
+
+    def _doDetail(self, c):
+	(totals, per_arch) = self.DETAIL_QUERIES
+	for row in c.execute(totals):
+	    (self.value, self.names, self.latest) = row[0:3]
+	    (self.size_package, self.size_installed, self.size_archive) = [ v or 0 for v in row[3:6] ]
+	    self.newest_build = row[6]
+	for (arch, cnt) in c.execute(per_arch):
+	    self.arches[arch] = cnt
 
     def check(self):
 	self.failed = self.value < 1
 
+# Something that wants its own view of a file an XmlHandler is parsing anyway.
+# Like a handler it declares PATHS, but its methods are subscribed next to the
+# handler's own, so any number of consumers share one download and one parse.
+class Consumer(object):
+    NAME = None
+    PATHS = {}
+    RESULT = ()
+    # False if the result is too big to keep in the result cache; a handler
+    # with such a consumer is parsed every time
+    CACHED = True
+
+    def finish(self):
+	pass
+
+    def result(self):
+	return dict((k, getattr(self, k)) for k in self.RESULT)
+
+    def restore(self, result):
+	for k in self.RESULT:
+	    setattr(self, k, result[k])
+
+# one element of a subscribed path, with the callbacks for it
+class PathNode(object):
+    __slots__ = ('children', 'start', 'end', 'text')
+
+    def __init__(self):
+	self.children = {}
+	self.start = []
+	self.end = []
+	self.text = []
+
 class XmlHandler(Handler):
+    # element paths a subclass cares about, and the methods to call for them:
+    #   '/repomd/data': { 'start': 'onData', 'end': ..., 'text': ... }
+    # start callbacks get the attributes, text callbacks the joined character
+    # data of the element (meant for leaf elements), end callbacks nothing.
+    #
+    # Below an element that is not subscribed, or that has nothing subscribed
+    # under it, the start handler is switched off and the end handler only
+    # waits for that element's name to close again; so the repodata formats'
+    # rule that an element never contains one of its own name is relied on.
+    PATHS = {}
+
     def __init__(self):
 	super(XmlHandler, self).__init__()
 	self.state = []
 	self.attrs = []
 	self.path = '/'
 	self.parser = xml.parsers.expat.ParserCreate()
-	self.parser.StartElementHandler = self.start
-	self.parser.EndElementHandler = self.end
-	self.parser.CharacterDataHandler = self.data
+	self.parser.buffer_text = True
+	self.root = PathNode()
+	self.node = self.root
+	self.nodes = []
+	self.skip = None
+	self.skip_matched = False
+	self.text = None
+	self.consumers = []
+	self._subscribeAll(self)
+	if not self.PATHS:
+	    self.parser.StartElementHandler = self.start
+	    self.parser.EndElementHandler = self.end
+	    self.parser.CharacterDataHandler = self.data
+
+    def _subscribeAll(self, obj):
+	for (path, events) in obj.PATHS.items():
+	    self.subscribe(path, **dict((e, getattr(obj, m)) for (e, m) in events.items()))
+	if obj.PATHS:
+	    self.parser.StartElementHandler = self._start
+	    self.parser.EndElementHandler = self._end
+	    self.parser.CharacterDataHandler = None
+
+    # consumers have to be added before the parse starts
+    def addConsumer(self, consumer):
+	self._subscribeAll(consumer)
+	self.consumers.append(consumer)
+	return consumer
+
+    def resultKeys(self):
+	return super(XmlHandler, self).resultKeys() + tuple(c.NAME for c in self.consumers)
+
+    def result(self):
+	result = super(XmlHandler, self).result()
+	for c in self.consumers:
+	    if c.CACHED:
+		result[c.NAME] = c.result()
+	return result
+
+    def restore(self, result):
+	for c in self.consumers:
+	    c.restore(result[c.NAME])
+	super(XmlHandler, self).restore(result)
+
+    def subscribe(self, path, start=None, end=None, text=None):
+	node = self.root
+	for name in path.strip('/').split('/'):
+	    node = node.children.setdefault(name, PathNode())
+	for (callbacks, cb) in ((node.start, start), (node.end, end), (node.text, text)):
+	    if cb is not None:
+		callbacks.append(cb)
+
+    def _skipTo(self, name, matched):
+	self.skip = name
+	self.skip_matched = matched
+	self.parser.StartElementHandler = None
+	self.parser.EndElementHandler = self._endSkip
+
+    def _endSkip(self, name):
+	if name != self.skip:
+	    return
+	self.parser.StartElementHandler = self._start
+	self.parser.EndElementHandler = self._end
+	if self.skip_matched:
+	    self._end(name)
+
+    def _start(self, name, attrs):
+	node = self.node.children.get(name)
+	if node is None:
+	    self._skipTo(name, False)
+	    return
+	self.nodes.append(self.node)
+	self.node = node
+	for cb in node.start:
+	    cb(attrs)
+	if node.text:
+	    self.text = []
+	    self.parser.CharacterDataHandler = self.text.append
+	if not node.children:
+	    self._skipTo(name, True)
+
+    def _end(self, name):
+	node = self.node
+	if node.text:
+	    self.parser.CharacterDataHandler = None
+	    text = ''.join(self.text)
+	    for cb in node.text:
+		cb(text)
+	for cb in node.end:
+	    cb()
+	self.node = self.nodes.pop()
 
     def _push(self,name,attrs):
 	self.state.append(name)
@@ -96,11 +360,33 @@ class XmlHandler(Handler):
 	return self.attrs[len(self.attrs)-offset-1]
 
     def _do(self, fileobj):
-	if getattr(fileobj, 'read', None) is None:
-	    with open(fileobj, 'r') as f_in:
-		self.parser.ParseFile(f_in)
-	else:
-	    self.parser.ParseFile(fileobj)
+	try:
+	    if getattr(fileobj, 'read', None) is None:
+		with open(fileobj, 'r') as f_in:
+		    self.parser.ParseFile(f_in)
+	    else:
+		self.parser.ParseFile(fileobj)
+	except ParseComplete:
+	    self._stop()
+
+    # once done is set the caller can stop feeding and drop the rest of the stream
+    def feed(self, data):
+	try:
+	    self.parser.Parse(data, False)
+	except ParseComplete:
+	    self._stop()
+
+    def _stop(self):
+	_log.info('%s: Stopped parsing early', self.cls)
+	self.done = True
+
+    def _flush(self):
+	if not self.done:
+	    self.parser.Parse('', True)
+
+    def _finalize(self):
+	for c in self.consumers:
+	    c.finish()
 
     def start(self, name, attrs):
 	pass
@@ -111,7 +397,37 @@ class XmlHandler(Handler):
     def data(self, data):
 	pass
 
+# everything repomd.xml says about one of its data files
+class RepoData(object):
+    def __init__(self, type):
+	self.type = type
+	self.href = None
+	self.timestamp = None
+	(self.checksum, self.checksum_type) = (None, None)
+	(self.open_checksum, self.open_checksum_type) = (None, None)
+	(self.size, self.open_size) = (None, None)
+
+    def __str__(self):
+	return '{}({}, {}, size={}, open-size={})'.format(self.__class__.__name__,
+		self.type,
+		self.href,
+		self.size,
+		self.open_size)
+
 class RepomdHandler(XmlHandler):
+    # repomd data type to the attribute name we use for it
+    KEYS = { 'primary': 'primary', 'primary_db': 'primary_db', 'updateinfo': 'errata' }
+    PATHS = {
+	    '/repomd/revision': { 'text': 'onRevision' },
+	    '/repomd/data': { 'start': 'onData' },
+	    '/repomd/data/checksum': { 'start': 'onChecksum', 'text': 'onChecksumText' },
+	    '/repomd/data/open-checksum': { 'start': 'onOpenChecksum', 'text': 'onOpenChecksumText' },
+	    '/repomd/data/location': { 'start': 'onLocation' },
+	    '/repomd/data/timestamp': { 'text': 'onTimestamp' },
+	    '/repomd/data/size': { 'text': 'onSize' },
+	    '/repomd/data/open-size': { 'text': 'onOpenSize' },
+	    }
+
     def __init__(self):
 	super(RepomdHandler, self).__init__()
 	self.release = 0
@@ -122,69 +438,186 @@ class RepomdHandler(XmlHandler):
 	self.primary_timestamp = None
 	self.errata_timestamp = None
 	self.primary_db_timestamp = None
+	self.checksum = None
+	self.checksums = {}
+	# RepoData for every data file, by repomd type and by our attribute name
+	self.files = {}
+	self.keys = {}
+	self.data_key = None
+	self.data_file = None
 
     def check(self):
 	self.failed = self.primary is None or self.errata is None or self.primary_timestamp is None or self.errata_timestamp is None
 
-    def start(self, name, attrs):
-	self._push(name, attrs)
-	log.debug('%s: processing %s, %s', self.cls, self.path, attrs)
-	if self.path == '/repomd/data/checksum' and self._last()['type'] == 'primary':
+    def onRevision(self, text):
+	self.revision = int(text)
+
+    def onData(self, attrs):
+	self.data_file = RepoData(attrs['type'])
+	self.files[self.data_file.type] = self.data_file
+	self.data_key = self.KEYS.get(self.data_file.type)
+	if self.data_key is not None:
+	    self.keys[self.data_key] = self.data_file
+
+    def onChecksum(self, attrs):
+	self.data_file.checksum_type = attrs.get('type')
+	if self.data_key == 'primary':
 	    log.debug('%s: found primary checksum', self.cls)
 	    self.checksum = attrs['type']
-	if self.path == '/repomd/data/location':
-	    if self._last()['type'] == 'primary':
-		_log.info('%s: found primary location', self.cls)
-		self.primary = attrs['href']
-	    if self._last()['type'] == 'primary_db':
-		_log.info('%s: found primary_db location', self.cls)
-		self.primary_db = attrs['href']
-	    if self._last()['type'] == 'updateinfo':
-		_log.info('%s: found errata location', self.cls)
-		self.errata = attrs['href']
 
-    def end(self, name):
-	self._pop()
+    def onChecksumText(self, text):
+	self.data_file.checksum = text.strip()
+	if self.data_key is not None:
+	    self.checksums[self.data_key] = self.data_file.checksum
 
-    def data(self, data):
-	if self.path == '/repomd/revision':
-	    self.revision = int(data)
-	    return
-	if self.path == '/repomd/data/timestamp':
-	    ts = float(int(data))
-	    dt = datetime.fromtimestamp(ts, utc)
-	    if self._last()['type'] == 'primary':
-		_log.debug('%s: found primary timestamp', self.cls)
-		self.primary_timestamp = dt
-	    if self._last()['type'] == 'primary_db':
-		_log.debug('%s: found primary_db timestamp', self.cls)
-		self.primary_db_timestamp = dt
-	    if self._last()['type'] == 'updateinfo':
-		_log.debug('%s: found errata timestamp', self.cls)
-		self.errata_timestamp = dt
+    def onOpenChecksum(self, attrs):
+	self.data_file.open_checksum_type = attrs.get('type')
+
+    def onOpenChecksumText(self, text):
+	self.data_file.open_checksum = text.strip()
+
+    def onLocation(self, attrs):
+	self.data_file.href = attrs['href']
+	if self.data_key is not None:
+	    _log.info('%s: found %s location', self.cls, self.data_key)
+	    setattr(self, self.data_key, attrs['href'])
+
+    def onTimestamp(self, text):
+	self.data_file.timestamp = datetime.fromtimestamp(float(text), utc)
+	if self.data_key is not None:
+	    _log.debug('%s: found %s timestamp', self.cls, self.data_key)
+	    setattr(self, self.data_key + '_timestamp', self.data_file.timestamp)
+
+    def onSize(self, text):
+	self.data_file.size = int(text)
+
+    def onOpenSize(self, text):
+	self.data_file.open_size = int(text)
 
 class PrimaryStatsHandler(XmlHandler):
-    def __init__(self):
+    RESULT = ('value',)
+    PATHS = {
+	    '/metadata': { 'start': 'onMetadata' },
+	    '/metadata/package': { 'start': 'onPackage' },
+	    }
+
+    # fast: trust the packages attribute createrepo puts on <metadata> and
+    # stop right there; verify: count every package anyway and compare
+    def __init__(self, fast=True, verify=False):
 	super(PrimaryStatsHandler, self).__init__()
 	self.value=0
-	self.ts = 0
+	self.header = None
+	self.fast = fast
+	self.verify = verify
 
     def check(self):
 	self.failed = self.value < 1
+	if self.verify and self.header is not None and self.header != self.value:
+	    log.error('%s: metadata header claims %d packages, but counted %d', self.cls, self.header, self.value)
+	    self.failed = True
 
-    def start(self, name, attrs):
-	if self.ts == 0:
-	    self.ts = time.time()
-	if name == 'package':
-	    self.value+=1
-	    if (time.time() - self.ts) >= 1:
-		self.ts = time.time()
-		_log.debug('%s: processed %d packages so far', self.cls, self.value)
+    # state of a parse over part of the file, see repostats.parallel
+    def partial(self):
+	return self.value
 
-    def end(self, name):
-	pass
+    def merge(self, partial):
+	self.value += partial
+
+    def onMetadata(self, attrs):
+	if 'packages' not in attrs:
+	    _log.info('%s: no packages attribute in metadata header, counting them all', self.cls)
+	    return
+	self.header = int(attrs['packages'])
+	# consumers want every package, so those get counted anyway
+	if self.fast and not self.verify and not self.consumers:
+	    self.value = self.header
+	    raise ParseComplete()
+
+    def onPackage(self, attrs):
+	self.value+=1
+	if self.value % PROGRESS == 0:
+	    _log.debug('%s: processed %d packages so far', self.cls, self.value)
+
+class PrimaryDetailHandler(XmlHandler, PackageDetail):
+    RESULT = PackageDetail.DETAIL
+    PATHS = {
+	    '/metadata': { 'start': 'onMetadata' },
+	    '/metadata/package': { 'start': 'onPackage', 'end': 'onPackageEnd' },
+	    '/metadata/package/name': { 'text': 'onName' },
+	    '/metadata/package/arch': { 'text': 'onArch' },
+	    '/metadata/package/time': { 'start': 'onTime' },
+	    '/metadata/package/size': { 'start': 'onSize' },
+	    }
+
+    def __init__(self):
+	super(PrimaryDetailHandler, self).__init__()
+	self.value = 0
+	# the packages attribute of <metadata>, for --verify
+	self.header = None
+	self.initDetail()
+	self.name_set = set()
+	self.pair_set = set()
+	(self.name, self.arch) = (None, None)
+
+    def check(self):
+	self.failed = self.value < 1
+
+    def _finalize(self):
+	super(PrimaryDetailHandler, self)._finalize()
+	(self.names, self.latest) = (len(self.name_set), len(self.pair_set))
+
+    def partial(self):
+	return (self.value, self.arches, self.name_set, self.pair_set,
+		self.size_package, self.size_installed, self.size_archive, self.newest_build)
+
+    def merge(self, partial):
+	(value, arches, name_set, pair_set, size_package, size_installed, size_archive, newest_build) = partial
+	self.value += value
+	for (k, v) in arches.items():
+	    self.arches[k] = self.arches.get(k, 0) + v
+	self.name_set.update(name_set)
+	self.pair_set.update(pair_set)
+	self.size_package += size_package
+	self.size_installed += size_installed
+	self.size_archive += size_archive
+	if newest_build is not None and (self.newest_build is None or newest_build > self.newest_build):
+	    self.newest_build = newest_build
+
+    def onMetadata(self, attrs):
+	if 'packages' in attrs:
+	    self.header = int(attrs['packages'])
+
+    def onPackage(self, attrs):
+	(self.name, self.arch) = (None, None)
+
+    def onName(self, text):
+	self.name = text
+
+    def onArch(self, text):
+	self.arch = text
+
+    def onTime(self, attrs):
+	build = int(attrs['build'])
+	if self.newest_build is None or build > self.newest_build:
+	    self.newest_build = build
+
+    def onSize(self, attrs):
+	self.size_package += int(attrs.get('package', 0))
+	self.size_installed += int(attrs.get('installed', 0))
+	self.size_archive += int(attrs.get('archive', 0))
+
+    def onPackageEnd(self):
+	self.value+=1
+	self.arches[self.arch] = self.arches.get(self.arch, 0) + 1
+	self.name_set.add(self.name)
+	self.pair_set.add((self.name, self.arch))
+	if self.value % PROGRESS == 0:
+	    _log.debug('%s: processed %d packages so far', self.cls, self.value)
 
 class ErrataStatsHandler(XmlHandler):
+    RESULT = ('value', 'types')
+    PATHS = { '/updates/update': { 'start': 'onUpdate' } }
+
     def __init__(self):
 	super(ErrataStatsHandler, self).__init__()
 	self.value = 0
@@ -193,17 +626,7 @@ class ErrataStatsHandler(XmlHandler):
     def check(self):
 	self.failed = self.value < 1 or len(self.types) == 0
 
-    def start(self, name, attrs):
-	if name == 'updates':
-	    self.state = 1
-	if self.state == 1 and name == 'update':
-	    self.value+=1
-	    t = attrs['type']
-	    if t in self.types:
-		self.types[t]+=1
-	    else:
-		self.types[t]=0
-
-    def end(self, name):
-	if name == 'updates':
-	    self.state=0
+    def onUpdate(self, attrs):
+	self.value+=1
+	t = attrs['type']
+	self.types[t] = self.types.get(t, 0) + 1
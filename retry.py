@@ -0,0 +1,170 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import sys, time, random, socket, threading, collections, logging, Queue, email.utils
+import requests
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+log = logging.getLogger(__name__)
+
+# seconds to wait for a connection, and for each read on one
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+RETRIES = 3
+# the first retry waits up to this many seconds, each one after twice as long
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+# answers that say to try again later rather than that the request was wrong
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# answers that say the host has more requests than it wants
+THROTTLE_STATUS = (429, 503)
+# a host that wants to be left alone longer than this is not waited for
+MAX_RETRY_AFTER = 300
+# latencies of recent requests to a host to learn when to hedge from
+WINDOW = 100
+# too few of those and the percentile says nothing
+MIN_SAMPLES = 10
+# never send a second request sooner than this, whatever the percentile
+MIN_HEDGE_DELAY = 0.05
+
+# a response that was not ok, with its status for whoever decides to retry,
+# and the seconds its Retry-After header asked to wait if it had one
+class HttpError(IOError):
+    def __init__(self, message, status, retry_after=None):
+	super(HttpError, self).__init__(message)
+	self.status = status
+	self.retry_after = retry_after
+
+# seconds a Retry-After header asks for, either as such or as an http date
+def retryAfter(value):
+    if not value:
+	return None
+    try:
+	return max(0, int(value))
+    except ValueError:
+	pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+	return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+# a failed TLS handshake will fail the same way next time
+_TRANSIENT = (requests.exceptions.Timeout, ProtocolError, ReadTimeoutError, socket.error)
+
+def retryable(exc):
+    if isinstance(exc, HttpError):
+	return exc.status in RETRY_STATUS
+    if isinstance(exc, requests.exceptions.SSLError):
+	return False
+    return isinstance(exc, (requests.exceptions.ConnectionError,) + _TRANSIENT)
+
+# how long to wait on the CDN, how often to ask again, and whether to hedge
+# requests for small files; hedge is the percentile of recent latencies, 0-1,
+# after which a second request goes out, or None to never send one
+class RetryPolicy(object):
+    def __init__(self, retries=RETRIES, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, backoff=BACKOFF, max_backoff=MAX_BACKOFF, hedge=None):
+	self.retries = retries
+	(self.connect_timeout, self.read_timeout) = (connect_timeout, read_timeout)
+	(self.backoff, self.max_backoff) = (backoff, max_backoff)
+	self.hedge = hedge
+
+    @property
+    def timeout(self):
+	return (self.connect_timeout, self.read_timeout)
+
+    # full jitter, so repos that failed together do not all come back together
+    def delay(self, attempt):
+	return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    # fn(), called again after a while as long as it fails in a way that may pass
+    def call(self, fn, what):
+	attempt = 0
+	while True:
+	    try:
+		return fn()
+	    except Exception, ex:
+		if attempt >= self.retries or not retryable(ex):
+		    raise
+		wait = self.delay(attempt)
+		retry_after = getattr(ex, 'retry_after', None)
+		if retry_after is not None:
+		    if retry_after > MAX_RETRY_AFTER:
+			raise
+		    wait = max(wait, retry_after)
+		attempt += 1
+		log.warn('%s failed: %s: %s; retry %d of %d in %.1f seconds', what, ex.__class__.__name__, ex, attempt, self.retries, wait)
+		time.sleep(wait)
+
+# latencies of the most recent requests to one host
+class LatencyWindow(object):
+    def __init__(self, size=WINDOW):
+	self.samples = collections.deque(maxlen=size)
+	self.lock = threading.Lock()
+	(self.hedged, self.won) = (0, 0)
+
+    def observe(self, seconds):
+	with self.lock:
+	    self.samples.append(seconds)
+
+    # None until there are enough samples to tell
+    def percentile(self, p):
+	with self.lock:
+	    if len(self.samples) < MIN_SAMPLES:
+		return None
+	    ordered = sorted(self.samples)
+	return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def count(self, won):
+	with self.lock:
+	    self.hedged += 1
+	    if won:
+		self.won += 1
+
+# fn() on a thread, and on a second one if the first has not returned after
+# delay seconds; the first to return wins, and it only fails once every call
+# that was started failed. The loser runs to the end on its own. Hands back
+# the result, and whether the second call was started and whether it won.
+def hedge(fn, delay, what):
+    results = Queue.Queue()
+    def run(i):
+	try:
+	    results.put((i, fn(), None))
+	except Exception:
+	    results.put((i, None, sys.exc_info()))
+    def spawn(i):
+	t = threading.Thread(target=run, args=(i,), name='hedge-{}'.format(i))
+	t.daemon = True
+	t.start()
+    spawn(0)
+    (started, failed) = (1, None)
+    deadline = time.time() + delay
+    while True:
+	# wait in short steps so a KeyboardInterrupt still gets through
+	wait = deadline - time.time() if started == 1 else 1
+	try:
+	    (i, value, exc) = results.get(True, max(0.001, min(wait, 1)))
+	except Queue.Empty:
+	    if started == 1 and time.time() >= deadline:
+		log.info('No answer for %s after %.3f seconds, sending another request', what, delay)
+		spawn(1)
+		started = 2
+	    continue
+	if exc is None:
+	    return (value, started > 1, i == 1)
+	if started == 1 or failed is not None:
+	    raise exc[0], exc[1], exc[2]
+	failed = exc
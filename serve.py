@@ -0,0 +1,211 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import re, time, heapq, calendar, threading, logging, BaseHTTPServer, SocketServer
+from repostats.stats import statLines
+
+log = logging.getLogger(__name__)
+
+INTERVAL = 300
+MIN_INTERVAL = 60
+MAX_INTERVAL = 3600
+# poll this many times per typical gap between two revisions of a repo
+POLLS_PER_CHANGE = 4
+# how fast polls back off while a repo does not change
+BACKOFF = 1.5
+# weight of the newest gap in the running average, like the cost model
+WEIGHT = 0.3
+
+STAT_LINE = re.compile(r'^([A-Za-z_]+)(?:-(.+))?=(-?[0-9.]+)$')
+
+# One repo the daemon keeps an eye on: polls its repomd.xml, recomputes the
+# stats when the revision changes, and works out when to poll next from how
+# often that happens.
+class RepoPoller(object):
+    def __init__(self, label, browser, detail=False, interval=INTERVAL, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, history=None, errata_db=None):
+	self.label = label
+	self.browser = browser
+	self.detail = detail
+	self.history = history
+	self.errata_db = errata_db
+	(self.interval, self.min_interval, self.max_interval) = (interval, min_interval, max_interval)
+	self.lines = None
+	# the stats have to be worked out again, after a change or a failed attempt
+	self.stale = True
+	self.due = 0
+	(self.polls, self.changes, self.errors) = (0, 0, 0)
+	(self.up, self.poll_seconds) = (False, 0)
+	# when the current revision was made, and the average time between revisions
+	(self.changed_at, self.change_gap) = (None, None)
+
+    # when the files of the current revision were made, per repomd.xml
+    def _changeTime(self):
+	stamps = [ calendar.timegm(f.timestamp.utctimetuple()) for f in self.browser.repomd.files.values() if f.timestamp is not None ]
+	return max(stamps) if stamps else time.time()
+
+    def poll(self):
+	ts = time.time()
+	changed = False
+	try:
+	    if self.browser.refresh():
+		changed = True
+		self.stale = True
+	    if self.stale:
+		self.lines = statLines(self.browser, not self.detail, self.detail, history=self.history, label=self.label, errata_db=self.errata_db)
+		self.stale = False
+	    self.up = True
+	except Exception, ex:
+	    log.error('Unable to poll %s: %s: %s', self.label, ex.__class__.__name__, ex)
+	    self.errors += 1
+	    self.up = False
+	    # handlers may be half way through, so start them over next time
+	    self.browser.reset()
+	    self.stale = True
+	self.polls += 1
+	self.poll_seconds = time.time() - ts
+	self._schedule(changed)
+	return changed
+
+    def _schedule(self, changed):
+	now = time.time()
+	if changed:
+	    changed_at = self._changeTime()
+	    # the first poll has nothing to compare with
+	    if self.changed_at is not None:
+		self.changes += 1
+		gap = max(changed_at - self.changed_at, 0)
+		self.change_gap = gap if self.change_gap is None else WEIGHT * gap + (1 - WEIGHT) * self.change_gap
+	    self.changed_at = changed_at
+	if self.change_gap is not None:
+	    # a repo that has not changed for longer than usual is likely slowing down
+	    gap = max(self.change_gap, now - self.changed_at)
+	    interval = gap / POLLS_PER_CHANGE
+	    if not changed:
+		interval = min(interval, self.interval * BACKOFF)
+	elif changed:
+	    interval = self.interval
+	else:
+	    interval = self.interval * BACKOFF
+	if not self.up:
+	    interval = self.min_interval
+	self.interval = max(self.min_interval, min(self.max_interval, interval))
+	self.due = now + self.interval
+	log.debug('Next poll of %s in %.0f seconds', self.label, self.interval)
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Polls the repos on a few worker threads, each as soon as it is due, and
+# renders what they found in the Prometheus text format.
+class Exporter(object):
+    def __init__(self, pollers, jobs=4, cache=None, sessions=None):
+	self.pollers = pollers
+	self.jobs = jobs
+	self.cache = cache
+	self.sessions = sessions
+	self.cond = threading.Condition()
+	self.queue = [ (p.due, i, p) for (i, p) in enumerate(pollers) ]
+	heapq.heapify(self.queue)
+
+    def start(self):
+	for i in range(max(1, min(self.jobs, len(self.pollers)))):
+	    t = threading.Thread(target=self._work, name='poller-{}'.format(i))
+	    t.daemon = True
+	    t.start()
+
+    def _next(self):
+	with self.cond:
+	    while True:
+		wait = None
+		if self.queue:
+		    wait = self.queue[0][0] - time.time()
+		    if wait <= 0:
+			return heapq.heappop(self.queue)
+		self.cond.wait(wait)
+
+    def _work(self):
+	while True:
+	    (due, i, poller) = self._next()
+	    changed = poller.poll()
+	    with self.cond:
+		heapq.heappush(self.queue, (poller.due, i, poller))
+		self.cond.notify()
+	    if changed and self.cache is not None:
+		try:
+		    self.cache.save()
+		except (IOError, OSError), ex:
+		    log.warn('Unable to save cache: %s', ex)
+
+    def metrics(self):
+	# every sample of a metric has to come together, under one TYPE line
+	samples = {}
+	def add(name, labels, value, kind='gauge'):
+	    samples.setdefault((name, kind), []).append((labels, value))
+	if self.sessions is not None:
+	    add('repostats_connections_opened_total', [], self.sessions.opened, 'counter')
+	    add('repostats_connections_reused_total', [], self.sessions.reused, 'counter')
+	    for (host, window) in sorted(self.sessions.latencies.items()):
+		add('repostats_hedged_requests_total', [ ('host', host) ], window.hedged, 'counter')
+		add('repostats_hedge_wins_total', [ ('host', host) ], window.won, 'counter')
+	    for (host, limiter) in sorted(self.sessions.limiters.items()):
+		add('repostats_host_concurrency_limit', [ ('host', host) ], int(limiter.limit))
+		add('repostats_host_throttled_total', [ ('host', host) ], limiter.throttles, 'counter')
+	for p in self.pollers:
+	    repo = [ ('repo', p.label) ]
+	    add('repostats_up', repo, int(p.up))
+	    add('repostats_polls_total', repo, p.polls, 'counter')
+	    add('repostats_poll_errors_total', repo, p.errors, 'counter')
+	    add('repostats_revision_changes_total', repo, p.changes, 'counter')
+	    add('repostats_poll_duration_seconds', repo, p.poll_seconds)
+	    add('repostats_poll_interval_seconds', repo, p.interval)
+	    if p.changed_at is not None:
+		add('repostats_revision_timestamp_seconds', repo, p.changed_at)
+	    for line in p.lines or ():
+		m = STAT_LINE.match(line)
+		if m is None:
+		    continue
+		labels = repo + [ ('name', m.group(2)) ] if m.group(2) is not None else repo
+		add('repostats_' + m.group(1).lower(), labels, m.group(3))
+	out = []
+	for (name, kind) in sorted(samples.keys()):
+	    out.append('# TYPE {} {}'.format(name, kind))
+	    for (labels, value) in samples[(name, kind)]:
+		labels = ','.join('{}="{}"'.format(k, _label(v)) for (k, v) in labels)
+		out.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', value))
+	return '\n'.join(out) + '\n'
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+	if self.path.split('?')[0] not in ('/', '/metrics'):
+	    self.send_error(404)
+	    return
+	body = self.server.exporter.metrics()
+	self.send_response(200)
+	self.send_header('Content-Type', 'text/plain; version=0.0.4')
+	self.send_header('Content-Length', str(len(body)))
+	self.end_headers()
+	self.wfile.write(body)
+
+    def log_message(self, format, *args):
+	log.debug('%s %s', self.address_string(), format % args)
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, exporter):
+	BaseHTTPServer.HTTPServer.__init__(self, address, MetricsRequestHandler)
+	self.exporter = exporter
@@ -0,0 +1,100 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import threading, logging, requests
+from urlparse import urlparse
+from repostats.instrument import TimedAdapter
+from repostats.retry import LatencyWindow
+from repostats.limiter import HostLimiter
+
+log = logging.getLogger(__name__)
+
+# hosts a session keeps connections to; every CDN repo of a cert is on one host
+POOL_CONNECTIONS = 4
+# connections kept alive per host, enough for every thread to have one
+POOL_MAXSIZE = 16
+
+# requests sessions shared by every CdnBrowser in the process, one per CDN
+# host and client cert, so repos that share an entitlement cert also share
+# its kept-alive connections instead of each doing its own TLS handshake.
+# host_limit is the most requests to have out to one host at once, where an
+# adaptive HostLimiter finds how many work best; 0 to not limit them
+class SessionPool(object):
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, host_limit=0):
+	self.pool_connections = pool_connections
+	self.pool_maxsize = pool_maxsize
+	self.host_limit = host_limit
+	self.sessions = {}
+	# recent latencies per host, to hedge requests after
+	self.latencies = {}
+	self.limiters = {}
+	self.lock = threading.Lock()
+	(self.opened, self.reused) = (0, 0)
+
+    def get(self, url, cert, key, cacert):
+	u = urlparse(url)
+	k = (u.scheme, u.netloc, cert, key, cacert)
+	with self.lock:
+	    session = self.sessions.get(k)
+	    if session is None:
+		log.debug('New session for %s://%s with cert %s', u.scheme, u.netloc, cert)
+		session = requests.Session()
+		for prefix in ('https://', 'http://'):
+		    session.mount(prefix, TimedAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize))
+		self.sessions[k] = session
+	    return session
+
+    def latency(self, url):
+	host = urlparse(url).netloc
+	with self.lock:
+	    return self.latencies.setdefault(host, LatencyWindow())
+
+    # None if requests to the host of url are not limited
+    def limiter(self, url):
+	if self.host_limit <= 0:
+	    return None
+	host = urlparse(url).netloc
+	with self.lock:
+	    limiter = self.limiters.get(host)
+	    if limiter is None:
+		limiter = self.limiters[host] = HostLimiter(host, self.host_limit)
+	    return limiter
+
+    # count a request, by whether it had to open a new connection
+    def count(self, opened):
+	with self.lock:
+	    if opened:
+		self.opened += 1
+	    else:
+		self.reused += 1
+
+    def close(self):
+	with self.lock:
+	    for session in self.sessions.values():
+		session.close()
+	    self.sessions = {}
+	log.info('Made %d requests on %d new and %d kept-alive connections', self.opened + self.reused, self.opened, self.reused)
+
+_default = None
+_default_lock = threading.Lock()
+
+def defaultPool():
+    global _default
+    with _default_lock:
+	if _default is None:
+	    _default = SessionPool()
+	return _default
@@ -0,0 +1,113 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+from datetime import datetime
+import repostats.repomd as repomd
+
+# The name=value lines of a repo's stats, as stats prints them and serve
+# exports them.
+
+def detailLines(handler):
+    lines = []
+    lines.append('Packages_Names={}'.format(handler.names))
+    lines.append('Packages_Latest={}'.format(handler.latest))
+    for (k,v) in sorted(handler.arches.items()):
+	lines.append('Packages_Arch-{}={}'.format(k, v))
+    lines.append('Packages_SizePackage={}'.format(handler.size_package))
+    lines.append('Packages_SizeInstalled={}'.format(handler.size_installed))
+    lines.append('Packages_SizeArchive={}'.format(handler.size_archive))
+    if handler.newest_build is not None:
+	lines.append('Packages_NewestBuild="{}"'.format(datetime.fromtimestamp(handler.newest_build, repomd.utc)))
+    return lines
+
+def errataDetailLines(severities, years, cves):
+    lines = []
+    for (k,v) in sorted(severities.severities.items()):
+	lines.append('Errata_Severity-{}={}'.format(k, v))
+    for (k,v) in sorted(years.years.items()):
+	lines.append('Errata_Year-{}={}'.format(k, v))
+    lines.append('Errata_CVEs={}'.format(cves.cves))
+    lines.append('Errata_WithCVEs={}'.format(cves.errata_with_cves))
+    return lines
+
+# what statLines needs fetched: (keys, primary_key, errata_detail, record,
+# errata_records); record is what history needs to record the revision, and
+# errata_records what errata_db needs to refresh, if they do not have it
+def statKeys(browser, fast=True, detail=False, history=None, label=None, errata_db=None):
+    primary_key = browser.choosePrimary(fast and not detail)
+    if browser.verify:
+	# only primary.xml has a header to check the count against
+	primary_key = 'primary'
+    errata_detail = None
+    has_errata = browser.getRepomd().errata is not None
+    if detail and has_errata:
+	# all of these come out of the one parse of updateinfo.xml
+	import repostats.consumers as consumers
+	errata_detail = [ browser.addConsumer('errata', c) for c in
+		(consumers.ErrataSeverityConsumer(), consumers.ErrataYearConsumer(), consumers.CveConsumer()) ]
+    record = None
+    if history is not None and history.wants(browser.url, label, browser.getRepomd()):
+	import repostats.history
+	# the package list only comes out of primary.xml
+	primary_key = 'primary'
+	record = (browser.addConsumer('primary', repostats.history.PackageListConsumer()),
+		browser.addConsumer('errata', repostats.history.ErrataListConsumer()) if has_errata else None)
+    errata_records = None
+    if errata_db is not None and has_errata and errata_db.wants(browser.url, browser.getRepomd().checksums.get('errata')):
+	import repostats.erratadb
+	errata_records = browser.addConsumer('errata', repostats.erratadb.ErrataRecordConsumer())
+    if has_errata:
+	return (('errata', primary_key), primary_key, errata_detail, record, errata_records)
+    return ((primary_key,), primary_key, errata_detail, record, errata_records)
+
+# plan is what statKeys() returned, if the keys were fetched some other way
+def statLines(browser, fast=True, detail=False, plan=None, history=None, label=None, errata_db=None):
+    if plan is None:
+	plan = statKeys(browser, fast, detail, history, label, errata_db)
+	browser.prefetch(*plan[0])
+    (keys, primary_key, errata_detail, record, errata_records) = plan
+    lines = []
+    lines.append('Packages_Updated="{}"'.format(browser.getRepomd().primary_timestamp))
+    lines.append('Pakcages_ChecksumType="{}"'.format(browser.getRepomd().checksum))
+    if browser.getRepomd().primary_db is not None:
+	lines.append('Packages_db_Update="{}"'.format(browser.getRepomd().primary_db_timestamp))
+    # not all repos have errata
+    if browser.getRepomd().errata is not None:
+	lines.append('Errata_Updated="{}"'.format(browser.getRepomd().errata_timestamp))
+	lines.append('Errata_Total={}'.format(browser.getErrata().value))
+	for (k,v) in browser.getErrata().types.items():
+	    lines.append('Errata_Type-{}={}'.format(k, v))
+	if detail:
+	    lines.extend(errataDetailLines(*errata_detail))
+
+    lines.append('Packages_Variant="{}"'.format(primary_key))
+    handler = browser.getHandler(primary_key)
+    # a count --verify can not check, or found wrong, fails the repo rather
+    # than getting printed
+    if browser.verify:
+	if getattr(handler, 'header', None) is None:
+	    raise ValueError('{}: no packages header to verify the count against'.format(primary_key))
+	if handler.header != handler.value:
+	    raise ValueError('{}: metadata header claims {} packages, but counted {}'.format(primary_key, handler.header, handler.value))
+    lines.append('Packages_Total={}'.format(handler.value))
+    if detail:
+	lines.extend(detailLines(handler))
+    if record is not None:
+	history.record(browser.url, label, browser.getRepomd(), *record)
+    if errata_records is not None:
+	errata_db.refresh(browser.url, label, browser.getRepomd().checksums.get('errata'), errata_records.records)
+    return lines
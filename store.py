@@ -0,0 +1,268 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+# 
+# This file is part of repostats
+# 
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import os, re, time, fcntl, logging
+from repostats.cache import defaultCacheDir, readJson, writeJson
+
+log = logging.getLogger(__name__)
+
+MAX_BYTES = 1024 * 1048576
+# partial downloads nobody resumed for this long are dropped
+PART_AGE = 7 * 86400
+# checksums are hex, anything else should never end up in a path
+CHECKSUM = re.compile('^[0-9a-fA-F]+$')
+
+# whether f is still the file at path. Lock files are unlinked while held
+# once there is nothing left to lock, so whoever was waiting on one has to
+# look again and lock the file that is there now instead.
+def _sameFile(f, path):
+    try:
+	st = os.stat(path)
+    except OSError:
+	return False
+    fst = os.fstat(f.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+# the lock for path held exclusively, None if someone else holds it
+def _lockNb(path):
+    while True:
+	f_lock = open(path + '.lock', 'a')
+	try:
+	    fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except IOError:
+	    f_lock.close()
+	    return None
+	if _sameFile(f_lock, path + '.lock'):
+	    return f_lock
+	f_lock.close()
+
+# drops the lock for path, held as f_lock; unlinked first when nothing is
+# left for it to guard
+def _unlock(f_lock, path):
+    if not (os.path.exists(path) or os.path.exists(path + '.part')):
+	try:
+	    os.remove(path + '.lock')
+	except OSError:
+	    pass
+    fcntl.flock(f_lock, fcntl.LOCK_UN)
+    f_lock.close()
+
+# One metadata file in the store, locked for as long as we hold it: shared
+# once it exists, exclusively until then. The first process to acquire a
+# missing blob downloads it through write() and commit(); everybody else
+# blocks in acquire() until then, and finds it exists.
+# A download that fails half way keeps its .part, with the validators the
+# server gave for it, so the next one can pick up where it left off.
+class Blob(object):
+    def __init__(self, store, checksum, wait=True):
+	self.path = os.path.join(store.root, checksum)
+	self.part = self.path + '.part'
+	self.part_meta = self.part + '.json'
+	self.f_part = None
+	self.f_lock = None
+	self.locked = False
+	ts = time.time()
+	# readers share the lock, only a download needs it to itself
+	mode = fcntl.LOCK_SH
+	while True:
+	    if self.f_lock is None:
+		self.f_lock = open(self.path + '.lock', 'a')
+	    try:
+		fcntl.flock(self.f_lock, mode if wait else mode | fcntl.LOCK_NB)
+	    except IOError:
+		self.f_lock.close()
+		if wait:
+		    raise
+		return
+	    if not _sameFile(self.f_lock, self.path + '.lock'):
+		self.f_lock.close()
+		self.f_lock = None
+		continue
+	    self.exists = os.path.exists(self.path)
+	    if self.exists == (mode == fcntl.LOCK_SH):
+		break
+	    # switching is not atomic, another process may store or evict
+	    # it in between, so look again once switched
+	    mode = fcntl.LOCK_EX if mode == fcntl.LOCK_SH else fcntl.LOCK_SH
+	self.locked = True
+	ts = time.time() - ts
+	if ts > 0.1:
+	    log.info('Waited %.3f seconds for another process to store %s', ts, checksum)
+	if self.exists:
+	    # the mtime is what LRU eviction goes by
+	    os.utime(self.path, None)
+
+    def open(self):
+	return open(self.path, 'rb')
+
+    # (bytes, validators) of what a previous download left behind
+    def partial(self):
+	try:
+	    size = os.path.getsize(self.part)
+	except OSError:
+	    return (0, {})
+	return (size, readJson(self.part_meta, {}))
+
+    def openPart(self):
+	return open(self.part, 'rb')
+
+    # start writing at offset, which is 0 or the end of the partial download
+    def start(self, offset=0, validators=None):
+	if self.f_part is not None:
+	    self.f_part.close()
+	self.f_part = open(self.part, 'ab' if offset else 'wb')
+	writeJson(self.part_meta, validators or {})
+
+    def write(self, data):
+	if self.f_part is None:
+	    self.start()
+	self.f_part.write(data)
+
+    def commit(self):
+	if self.f_part is None:
+	    self.start()
+	self.f_part.close()
+	self.f_part = None
+	os.rename(self.part, self.path)
+	self._removePart()
+	self.exists = True
+	log.debug('Stored %s', self.path)
+
+    def remove(self):
+	# others may be about to read it
+	fcntl.flock(self.f_lock, fcntl.LOCK_EX)
+	# if it was evicted while we switched, what is there now, if
+	# anything, belongs to whoever stored it since
+	if _sameFile(self.f_lock, self.path + '.lock'):
+	    try:
+		os.remove(self.path)
+	    except OSError:
+		pass
+	self.exists = False
+
+    def _removePart(self):
+	for path in (self.part, self.part_meta):
+	    try:
+		os.remove(path)
+	    except OSError:
+		pass
+
+    # drops whatever was written but not committed, or left by an earlier
+    # download, unless keep, and unlocks
+    def release(self, keep=False):
+	if self.f_part is not None:
+	    self.f_part.close()
+	    self.f_part = None
+	# after remove() lost it to evict(), nothing there is ours to drop
+	owner = _sameFile(self.f_lock, self.path + '.lock')
+	if keep:
+	    log.debug('Keeping %s to resume from', self.part)
+	elif owner and not self.exists:
+	    self._removePart()
+	if owner:
+	    _unlock(self.f_lock, self.path)
+	else:
+	    fcntl.flock(self.f_lock, fcntl.LOCK_UN)
+	    self.f_lock.close()
+
+# compressed metadata files shared by every process on the host, named by the
+# checksum repomd.xml gives for them
+class BlobStore(object):
+    def __init__(self, root=None, max_bytes=MAX_BYTES):
+	self.root = root or os.path.join(defaultCacheDir(), 'blobs')
+	self.max_bytes = max_bytes
+	if not os.path.isdir(self.root):
+	    os.makedirs(self.root)
+
+    # None if there is no blob for checksum, or without wait if someone
+    # else, another process or this one, holds it
+    def acquire(self, checksum, wait=True):
+	if checksum is None or not CHECKSUM.match(checksum):
+	    return None
+	blob = Blob(self, checksum, wait)
+	if not blob.locked:
+	    log.debug('%s is busy, going without it', blob.path)
+	    return None
+	return blob
+
+    def evict(self):
+	blobs = []
+	now = time.time()
+	names = os.listdir(self.root)
+	for name in names:
+	    if name.endswith('.part'):
+		self._evictPart(os.path.join(self.root, name), now)
+	    elif name.endswith('.lock') or name.endswith('.part.json'):
+		self._evictOrphan(os.path.join(self.root, name.split('.', 1)[0]), names)
+	    if not CHECKSUM.match(name):
+		continue
+	    try:
+		st = os.stat(os.path.join(self.root, name))
+	    except OSError:
+		continue
+	    blobs.append((st.st_mtime, st.st_size, name))
+	total = sum(b[1] for b in blobs)
+	blobs.sort()
+	while total > self.max_bytes and blobs:
+	    (mtime, size, name) = blobs.pop(0)
+	    path = os.path.join(self.root, name)
+	    # skip blobs another process is busy with; readers that already
+	    # have it open keep their copy after the unlink anyway
+	    f_lock = _lockNb(path)
+	    if f_lock is None:
+		continue
+	    try:
+		log.debug('Evicting %s from store', path)
+		os.remove(path)
+		total -= size
+	    except OSError:
+		pass
+	    _unlock(f_lock, path)
+
+    def _evictPart(self, part, now):
+	try:
+	    if now - os.path.getmtime(part) < PART_AGE:
+		return
+	except OSError:
+	    return
+	path = part[:-len('.part')]
+	f_lock = _lockNb(path)
+	if f_lock is None:
+	    return
+	log.debug('Dropping stale partial download %s', part)
+	for p in (part, part + '.json'):
+	    try:
+		os.remove(p)
+	    except OSError:
+		pass
+	_unlock(f_lock, path)
+
+    # a lock or validators left without a blob or a partial download to
+    # go with them
+    def _evictOrphan(self, path, names):
+	name = os.path.basename(path)
+	if not CHECKSUM.match(name) or name in names or name + '.part' in names:
+	    return
+	f_lock = _lockNb(path)
+	if f_lock is None:
+	    return
+	if not os.path.exists(path + '.part'):
+	    try:
+		os.remove(path + '.part.json')
+	    except OSError:
+		pass
+	_unlock(f_lock, path)
@@ -0,0 +1,100 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+"""
+LoopBrowser against a mock CDN that asks for a client cert, the way the
+real one does. Needs openssl to make the certs; set OPENSSL if it is not on
+the path.
+
+$ python -m unittest discover -s repostats/tests -t .
+"""
+import os, glob, time, shutil, tempfile, threading, unittest
+from distutils.spawn import find_executable
+import repostats.mockcdn as mockcdn
+from repostats.fetchloop import FetchLoop, LoopBrowser
+
+OPENSSL = os.environ.get('OPENSSL', 'openssl')
+PACKAGES = 200
+ERRATA = 20
+
+class LoopBrowserTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+	if find_executable(OPENSSL) is None:
+	    raise unittest.SkipTest('{} not found, set OPENSSL'.format(OPENSSL))
+	cls.root = tempfile.mkdtemp(prefix='repostats-test-')
+	mockcdn.setup(cls.root, 1, PACKAGES, ERRATA, openssl=OPENSSL)
+	cls.cacert = os.path.join(cls.root, 'ca.pem')
+	cls.server = mockcdn.MockCdn(('127.0.0.1', 0), cls.root, os.path.join(cls.root, 'server.pem'),
+		os.path.join(cls.root, 'server-key.pem'), cls.cacert)
+	cls.thread = threading.Thread(target=cls.server.serve_forever)
+	cls.thread.daemon = True
+	cls.thread.start()
+	cls.key = glob.glob(os.path.join(cls.root, 'certs', '*-key.pem'))[0]
+	cls.cert = cls.key[:-len('-key.pem')] + '.pem'
+	cls.url = cls.server.url + mockcdn.CONTENT_URL.format(0).lstrip('/').replace('$releasever', '7Server').replace('$basearch', 'x86_64')
+
+    @classmethod
+    def tearDownClass(cls):
+	cls.server.shutdown()
+	cls.server.server_close()
+	shutil.rmtree(cls.root, True)
+
+    def setUp(self):
+	self.loop = FetchLoop()
+
+    def tearDown(self):
+	self.loop.close()
+
+    def browser(self, cert, key, **kwargs):
+	return LoopBrowser(self.loop, self.url, cert, key, self.cacert, **kwargs)
+
+    def testRepomd(self):
+	repomd = self.browser(self.cert, self.key).getRepomd()
+	self.assertTrue(repomd.initialized)
+	self.assertFalse(repomd.failed)
+	self.assertIsNotNone(repomd.primary)
+	self.assertIsNotNone(repomd.errata)
+
+    def testPrimary(self):
+	self.assertEqual(self.browser(self.cert, self.key).getPrimary().value, PACKAGES)
+
+    def testPrimaryCounted(self):
+	primary = self.browser(self.cert, self.key, fast=False).getPrimary()
+	self.assertEqual(primary.value, PACKAGES)
+	self.assertEqual(primary.header, PACKAGES)
+
+    def testRepomdThenPrimaryOnOneLoop(self):
+	browsers = [ self.browser(self.cert, self.key) for i in range(3) ]
+	for b in browsers:
+	    b.start('repomd', 'primary')
+	self.loop.run()
+	for b in browsers:
+	    self.assertEqual(b.getPrimary().value, PACKAGES)
+
+    def testNoCertRejected(self):
+	rejected = self.server.stats()['rejected']
+	self.assertRaises(IOError, self.browser(None, None).getRepomd)
+	# under TLS 1.3 the client can give up before the server thread
+	# has counted the failed handshake
+	deadline = time.time() + 5
+	while self.server.stats()['rejected'] == rejected and time.time() < deadline:
+	    time.sleep(0.01)
+	self.assertGreater(self.server.stats()['rejected'], rejected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import os, shutil, tempfile, unittest
+from repostats.bench import writePrimaryDb
+from repostats.repomd import PrimaryDbSqlHandler
+
+PACKAGES = 50
+
+class SpoolHandlerTest(unittest.TestCase):
+    def setUp(self):
+	self.root = tempfile.mkdtemp(prefix='repostats-test-')
+	self.spool = os.path.join(self.root, 'spool')
+	os.mkdir(self.spool)
+	# anything spooled lands where it can be seen
+	(self.tempdir, tempfile.tempdir) = (tempfile.tempdir, self.spool)
+	self.path = os.path.join(self.root, 'primary.sqlite')
+	writePrimaryDb(self.path, PACKAGES)
+
+    def tearDown(self):
+	tempfile.tempdir = self.tempdir
+	shutil.rmtree(self.root, True)
+
+    def testParsePathLeavesNoSpool(self):
+	handler = PrimaryDbSqlHandler()
+	handler.parse(self.path)
+	self.assertEqual(handler.value, PACKAGES)
+	self.assertFalse(handler.failed)
+	self.assertIsNone(handler.tmp)
+	self.assertEqual(os.listdir(self.spool), [])
+
+    def testStreamRemovesSpool(self):
+	handler = PrimaryDbSqlHandler(detail=True)
+	handler.begin()
+	with open(self.path, 'rb') as f_in:
+	    handler.feed(f_in.read())
+	handler.finish()
+	self.assertEqual(handler.value, PACKAGES)
+	self.assertIsNone(handler.tmp)
+	self.assertEqual(os.listdir(self.spool), [])
+
+if __name__ == '__main__':
+    unittest.main()
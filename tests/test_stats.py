@@ -0,0 +1,90 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+from StringIO import StringIO
+from repostats.bench import writePrimary
+from repostats.repomd import PrimaryStatsHandler, PrimaryDetailHandler
+from repostats.stats import statKeys, statLines
+
+PACKAGES = 499
+
+# primary.xml with count packages whose header claims header of them
+def primaryXml(count, header):
+    f = StringIO()
+    writePrimary(f, count, header is not None)
+    return StringIO(f.getvalue().replace(' packages="{}"'.format(count), ' packages="{}"'.format(header), 1))
+
+class StubRepomd(object):
+    (primary_timestamp, primary_db_timestamp, checksum) = (0, 0, 'sha256')
+    primary_db = 'repodata/primary.sqlite.bz2'
+    errata = None
+
+# a repo with both primary variants, where the cost model picks primary_db
+class StubBrowser(object):
+    url = 'https://cdn.example.com/content/repo'
+
+    def __init__(self, handlers, verify):
+	self.handlers = handlers
+	self.verify = verify
+	self.repomd = StubRepomd()
+
+    def choosePrimary(self, fast=True):
+	return 'primary_db'
+
+    def getRepomd(self):
+	return self.repomd
+
+    def prefetch(self, *keys):
+	for k in keys:
+	    self.getHandler(k)
+
+    def getHandler(self, key):
+	return self.handlers[key]
+
+class VerifyTest(unittest.TestCase):
+    def browser(self, handler, verify=True):
+	return StubBrowser({ 'primary': handler, 'primary_db': None }, verify)
+
+    def parsed(self, handler, count, header):
+	handler.parse(primaryXml(count, header))
+	return handler
+
+    def testVerifyReadsPrimary(self):
+	self.assertEqual(statKeys(self.browser(None), fast=False)[1], 'primary')
+	self.assertEqual(statKeys(self.browser(None, False), fast=False)[1], 'primary_db')
+
+    def testHeaderMismatchFails(self):
+	handler = self.parsed(PrimaryStatsHandler(False, True), PACKAGES, PACKAGES + 1)
+	self.assertRaisesRegexp(ValueError, 'claims 500 packages, but counted 499', statLines, self.browser(handler), False)
+
+    def testHeaderMismatchFailsWithDetail(self):
+	handler = self.parsed(PrimaryDetailHandler(), PACKAGES, PACKAGES + 1)
+	self.assertRaisesRegexp(ValueError, 'claims 500 packages, but counted 499', statLines, self.browser(handler), False, True)
+
+    def testNoHeaderFails(self):
+	handler = self.parsed(PrimaryStatsHandler(False, True), PACKAGES, None)
+	self.assertRaisesRegexp(ValueError, 'no packages header', statLines, self.browser(handler), False)
+
+    def testHeaderMatchPrints(self):
+	handler = self.parsed(PrimaryStatsHandler(False, True), PACKAGES, PACKAGES)
+	lines = statLines(self.browser(handler), False)
+	self.assertIn('Packages_Variant="primary"', lines)
+	self.assertIn('Packages_Total={}'.format(PACKAGES), lines)
+
+if __name__ == '__main__':
+    unittest.main()
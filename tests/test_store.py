@@ -0,0 +1,69 @@
+# vim: sw=4 cindent
+# Copyright (C) 2016  Billy Holmes <billy@gonoph.net>
+#
+# This file is part of repostats
+#
+# repostats is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# repostats is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# repostats.  If not, see <http://www.gnu.org/licenses/>.
+import os, shutil, tempfile, unittest
+from repostats.store import BlobStore
+
+class BlobStoreTest(unittest.TestCase):
+    def setUp(self):
+	self.root = tempfile.mkdtemp(prefix='repostats-test-')
+	self.store = BlobStore(self.root, 10)
+
+    def tearDown(self):
+	shutil.rmtree(self.root, True)
+
+    def put(self, checksum, data):
+	blob = self.store.acquire(checksum)
+	blob.write(data)
+	blob.commit()
+	blob.release()
+
+    def testEvictLeavesNothing(self):
+	for checksum in ('aa', 'bb', 'cc'):
+	    self.put(checksum, 'x' * 8)
+	self.store.evict()
+	self.assertEqual(sorted(os.listdir(self.root)), [ 'cc', 'cc.lock' ])
+
+    def testFailedDownloadLeavesNothing(self):
+	blob = self.store.acquire('aa')
+	blob.start(0, { 'etag': 'x' })
+	blob.write('x')
+	blob.release()
+	self.assertEqual(os.listdir(self.root), [])
+
+    def testEvictSweepsOrphans(self):
+	for name in ('aa.lock', 'bb.part.json'):
+	    open(os.path.join(self.root, name), 'w').close()
+	self.store.evict()
+	self.assertEqual(os.listdir(self.root), [])
+
+    def testBusyLockKept(self):
+	blob = self.store.acquire('aa')
+	self.store.evict()
+	self.assertEqual(os.listdir(self.root), [ 'aa.lock' ])
+	blob.release()
+	self.assertEqual(os.listdir(self.root), [])
+
+    def testRemoveLeavesNothing(self):
+	self.put('aa', 'x')
+	blob = self.store.acquire('aa')
+	blob.remove()
+	blob.release()
+	self.assertEqual(os.listdir(self.root), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,10 +15,13 @@
 # 
 # You should have received a copy of the GNU General Public License along with
 # repostats.  If not, see <http://www.gnu.org/licenses/>.
-import sys, logging
+import sys, os, logging, threading
+from datetime import datetime
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import repostats
+import repostats.repomd as repomd
 import repostats.logger as logger
+from repostats.stats import statKeys, statLines
 
 VERBOSE_STATES = {
 	0: [logging.WARN, None],
@@ -37,18 +40,95 @@ def main():
     sub_parser = parser.add_subparsers(help='commands to invoke')
 
     parser_sub = sub_parser.add_parser('stats', help='Obtain stats for a repolabel: ex rhel-7-server-extras-rpms', description='Parser repo and print stats via its repolabel')
-    parser_sub.add_argument('repolabel', help='The Repository label to process')
+    parser_sub.add_argument('repolabel', nargs='*', help='The Repository labels to process')
+    parser_sub.add_argument('--filter', help='Also process every repolabel matching this regex')
+    parser_sub.add_argument('-j', '--jobs', type=int, default=8, help='Number of repos to process at the same time; connections to keep open with --engine loop')
+    parser_sub.add_argument('--engine', choices=('threads', 'loop'), default='threads', help='Fetch on a thread per repo, or every download at once on a single poll loop')
+    parser_sub.add_argument('--no-fast-count', dest='fast', action='store_false', help='Count every package in primary.xml instead of trusting its packages header')
+    parser_sub.add_argument('--verify', action='store_true', help='Count every package in primary.xml and check it against its packages header')
+    parser_sub.add_argument('--parallel', type=int, default=0, help='Parse primary.xml on this many processes when every package has to be read')
+    parser_sub.add_argument('--detail', action='store_true', help='Also print per arch counts, unique names, latest versions, sizes and newest build time, and errata per severity, per year and CVE counts')
     parser_sub.add_argument('-r', '--releasever', help='Release version', default='7Server')
     parser_sub.add_argument('-b', '--basearch', help='Base Architecture', default='x86_64')
     parser_sub.add_argument('--cdn', help='Override CDN url; default use rhsm.conf')
     parser_sub.add_argument('--cacert', help='Override location to public ca certifcate file; default use rhsm.conf')
     parser_sub.add_argument('--certdir', help='Override entitlement certifcate directory; default use rhsm.conf')
+    parser_sub.add_argument('--cache-dir', help='Directory to keep results of previous runs and the entitlement index in; default ~/.cache/repostats')
+    parser_sub.add_argument('--no-cache', action='store_true', help='Do not use or update results of previous runs or the entitlement index')
+    parser_sub.add_argument('--store-size', type=int, default=1024, help='MB of downloaded metadata to share between runs in the cache dir; 0 to not keep any')
+    parser_sub.add_argument('--trace', help='Append timing spans for every phase of every file, one JSON object per line, to this file')
+    parser_sub.add_argument('--pool-size', type=int, default=16, help='Connections to keep alive per CDN host and entitlement cert')
+    parser_sub.add_argument('--connect-timeout', type=float, default=10, help='Seconds to wait for a connection to the CDN')
+    parser_sub.add_argument('--read-timeout', type=float, default=60, help='Seconds to wait for the CDN to send anything on a connection')
+    parser_sub.add_argument('--retries', type=int, default=3, help='Times to ask again, after a jittered backoff, when the CDN times out or has a server error')
+    parser_sub.add_argument('--host-limit', type=int, default=16, help='Most requests to have out to one CDN host at once, with fewer while it throttles or slows down; 0 to not limit them')
+    parser_sub.add_argument('--hedge', type=float, default=0, help='Send a second request for repomd.xml when the first takes longer than this percentile of recent ones, ex 95; 0 to never')
+    parser_sub.add_argument('--ranges', type=int, default=0, help='Download large metadata files as this many byte ranges at once; threads engine only')
+    parser_sub.add_argument('--history', action='store_true', help='Record the packages and errata of every new repo revision in the cache dir, to diff them later')
+    parser_sub.add_argument('--errata-db', action='store_true', help='Keep every erratum in an sqlite database in the cache dir, for the errata command; only changes are written')
     parser_sub.add_argument('-v', '--verbose', action='count', help='increase output verbosity')
     parser_sub.set_defaults(section=runStats)
 
+    parser_sub = sub_parser.add_parser('serve', help='Keep polling repos and serve their stats over http for Prometheus', description='Poll repos and export their stats')
+    parser_sub.add_argument('repolabel', nargs='*', help='The Repository labels to watch')
+    parser_sub.add_argument('--filter', help='Also watch every repolabel matching this regex')
+    parser_sub.add_argument('--bind', default='127.0.0.1', help='Address to serve the metrics on')
+    parser_sub.add_argument('--port', type=int, default=9477, help='Port to serve the metrics on')
+    parser_sub.add_argument('--interval', type=int, default=300, help='Seconds between polls of a repo until it is known how often it changes')
+    parser_sub.add_argument('--min-interval', type=int, default=60, help='Never poll a repo more often than this many seconds')
+    parser_sub.add_argument('--max-interval', type=int, default=3600, help='Never poll a repo less often than this many seconds')
+    parser_sub.add_argument('-j', '--jobs', type=int, default=4, help='Number of repos to poll at the same time')
+    parser_sub.add_argument('--parallel', type=int, default=0, help='Parse primary.xml on this many processes when every package has to be read')
+    parser_sub.add_argument('--detail', action='store_true', help='Also export per arch counts, unique names, latest versions, sizes, and errata per severity, per year and CVE counts')
+    parser_sub.add_argument('-r', '--releasever', help='Release version', default='7Server')
+    parser_sub.add_argument('-b', '--basearch', help='Base Architecture', default='x86_64')
+    parser_sub.add_argument('--cdn', help='Override CDN url; default use rhsm.conf')
+    parser_sub.add_argument('--cacert', help='Override location to public ca certifcate file; default use rhsm.conf')
+    parser_sub.add_argument('--certdir', help='Override entitlement certifcate directory; default use rhsm.conf')
+    parser_sub.add_argument('--cache-dir', help='Directory to keep results of previous runs and the entitlement index in; default ~/.cache/repostats')
+    parser_sub.add_argument('--no-cache', action='store_true', help='Do not use or update results of previous runs or the entitlement index')
+    parser_sub.add_argument('--store-size', type=int, default=1024, help='MB of downloaded metadata to share between runs in the cache dir; 0 to not keep any')
+    parser_sub.add_argument('--trace', help='Append timing spans for every phase of every file, one JSON object per line, to this file')
+    parser_sub.add_argument('--pool-size', type=int, default=16, help='Connections to keep alive per CDN host and entitlement cert')
+    parser_sub.add_argument('--connect-timeout', type=float, default=10, help='Seconds to wait for a connection to the CDN')
+    parser_sub.add_argument('--read-timeout', type=float, default=60, help='Seconds to wait for the CDN to send anything on a connection')
+    parser_sub.add_argument('--retries', type=int, default=3, help='Times to ask again, after a jittered backoff, when the CDN times out or has a server error')
+    parser_sub.add_argument('--host-limit', type=int, default=16, help='Most requests to have out to one CDN host at once, with fewer while it throttles or slows down; 0 to not limit them')
+    parser_sub.add_argument('--hedge', type=float, default=0, help='Send a second request for repomd.xml when the first takes longer than this percentile of recent ones, ex 95; 0 to never')
+    parser_sub.add_argument('--history', action='store_true', help='Record the packages and errata of every new repo revision in the cache dir, to diff them later')
+    parser_sub.add_argument('--errata-db', action='store_true', help='Keep every erratum in an sqlite database in the cache dir, for the errata command; only changes are written')
+    parser_sub.add_argument('-v', '--verbose', action='count', help='increase output verbosity')
+    parser_sub.set_defaults(section=runServe)
+
+    parser_sub = sub_parser.add_parser('diff', help='Show packages and errata added and removed between two recorded revisions of a repo', description='Compare revisions stats or serve recorded with --history')
+    parser_sub.add_argument('repolabel', help='The Repository label to compare revisions of')
+    parser_sub.add_argument('old', nargs='?', default='-2', help='Revision to compare from: its repomd revision, or -N for the Nth most recent')
+    parser_sub.add_argument('new', nargs='?', default='-1', help='Revision to compare to: its repomd revision, or -N for the Nth most recent')
+    parser_sub.add_argument('-r', '--releasever', help='Release version, if the label was recorded for more than one')
+    parser_sub.add_argument('-b', '--basearch', help='Base Architecture, if the label was recorded for more than one')
+    parser_sub.add_argument('--list', action='store_true', help='List the recorded revisions instead')
+    parser_sub.add_argument('--counts', action='store_true', help='Only print how many were added and removed')
+    parser_sub.add_argument('--cache-dir', help='Directory the history was recorded in; default ~/.cache/repostats')
+    parser_sub.add_argument('-v', '--verbose', action='count', help='increase output verbosity')
+    parser_sub.set_defaults(section=runDiff)
+
+    parser_sub = sub_parser.add_parser('errata', help='Count or list errata of the repos kept with --errata-db, without going to the CDN', description='Query the errata stats or serve kept with --errata-db')
+    parser_sub.add_argument('repolabel', nargs='*', help='The Repository labels to look at; default all of them')
+    parser_sub.add_argument('--filter', help='Also look at every repolabel matching this regex')
+    parser_sub.add_argument('--per', action='append', choices=('type', 'severity', 'year', 'month', 'repo'), help='Count errata per this; give it more than once to count per combination, ex --per month --per type')
+    parser_sub.add_argument('--type', action='append', dest='types', help='Only errata of this type, ex security; may be given more than once')
+    parser_sub.add_argument('--severity', action='append', dest='severities', help='Only errata of this severity, ex Critical; may be given more than once')
+    parser_sub.add_argument('--since', help='Only errata issued on or after this date, ex 2016-03-01, 2016-03 or 2016')
+    parser_sub.add_argument('--until', help='Only errata issued before this date')
+    parser_sub.add_argument('--list', action='store_true', help='List the errata instead of counting them')
+    parser_sub.add_argument('--cache-dir', help='Directory the errata database was kept in; default ~/.cache/repostats')
+    parser_sub.add_argument('-v', '--verbose', action='count', help='increase output verbosity')
+    parser_sub.set_defaults(section=runErrata)
+
     parser_sub = sub_parser.add_parser('list', help='List all repolabels that all found entitlements provide', description='List all repolabels')
     parser_sub.add_argument('--certdir', help='Override entitlement certifcate directory; default use rhsm.conf')
     parser_sub.add_argument('--filter', help='Filter repo list with this text')
+    parser_sub.add_argument('--cache-dir', help='Directory to keep the entitlement index in; default ~/.cache/repostats')
     parser_sub.add_argument('-v', '--verbose', action='count', help='increase output verbosity')
     parser_sub.set_defaults(section=runList)
 
@@ -66,9 +146,10 @@ def main():
 	repostats.log.setLevel(vs[0])
 	repostats.log.info('Set more verbose state')
 
-    args.section(args)
+    return args.section(args)
 
-def runStats(args):
+# certs for the repolabels given and matched by --filter
+def findCerts(args):
     import repostats.certfinder as certfinder
     override_map = {}
     args_var = vars(args)
@@ -76,33 +157,197 @@ def runStats(args):
 	if ovr in args_var and args_var[ovr] is not None:
 	    override_map[ovr]=args_var[ovr]
 
-    finder = certfinder.CertFinder(args.releasever, args.basearch, args.repolabel, **override_map)
-    cert = finder.get()
+    finder = certfinder.CertFinder(args.releasever, args.basearch, None, args.cache_dir, index=not args.no_cache, **override_map)
+    labels = list(args.repolabel)
+    if args.filter is not None:
+	labels.extend([ l for l in finder.filter(args.filter) if l not in labels ])
+    if not labels:
+	raise LookupError('No repolabel given or matched by --filter')
+    return [ finder.get(l) for l in labels ]
+
+# the result cache, blob store and tracer the stats and serve options ask for
+def runState(args):
+    cache = None
+    if not args.no_cache:
+	import repostats.cache
+	cache = repostats.cache.StatsCache(args.cache_dir)
+    store = None
+    if args.store_size > 0:
+	import repostats.store
+	store_dir = os.path.join(args.cache_dir, 'blobs') if args.cache_dir else None
+	store = repostats.store.BlobStore(store_dir, args.store_size * 1048576)
+    import repostats.instrument
+    trace_out = open(args.trace, 'a') if args.trace else None
+    # spans only go to the trace file, nobody looks at them afterwards
+    tracer = repostats.instrument.Tracer(trace_out, keep=False)
+    import repostats.sessions
+    sessions = repostats.sessions.SessionPool(pool_maxsize=args.pool_size, host_limit=args.host_limit)
+    import repostats.retry
+    retry = repostats.retry.RetryPolicy(args.retries, args.connect_timeout, args.read_timeout, hedge=args.hedge / 100.0 or None)
+    history = None
+    if args.history:
+	import repostats.history
+	history = repostats.history.History(os.path.join(args.cache_dir, 'history') if args.cache_dir else None)
+    errata_db = None
+    if args.errata_db:
+	import repostats.erratadb
+	errata_db = repostats.erratadb.ErrataDb(os.path.join(args.cache_dir, 'errata.sqlite') if args.cache_dir else None)
+    # one pool for every repo, forked here while this is the only thread
+    parse_pool = None
+    if args.parallel > 1:
+	import repostats.parallel
+	parse_pool = repostats.parallel.ParsePool(args.parallel)
+    return (cache, store, tracer, trace_out, sessions, retry, history, errata_db, parse_pool)
+
+def runStats(args):
+    certs = findCerts(args)
+    # with more than one repo, label each block of output and carry on past failures
+    batch = len(certs) > 1 or args.filter is not None
 
     import  repostats.cdnbrowser
-    browser = None
+    (cache, store, tracer, trace_out, sessions, retry, history, errata_db, parse_pool) = runState(args)
+    output_lock = threading.Lock()
+    failed = []
+    fast = args.fast and not args.verify
+    loop = None
+    if args.engine == 'loop':
+	import repostats.fetchloop
+	loop = repostats.fetchloop.FetchLoop(args.jobs, args.read_timeout)
+    plans = {}
+
+    def newBrowser(cert):
+	if loop is not None:
+	    return repostats.fetchloop.LoopBrowser(loop, cert.cdn, cert.cert, cert.key, cert.cacert, cache, args.fast, args.verify, args.detail, parse_pool, store, tracer, sessions, retry=retry)
+	return repostats.cdnbrowser.CdnBrowser(cert.cdn, cert.cert, cert.key, cert.cacert, cache, args.fast, args.verify, args.detail, parse_pool, store, tracer, sessions, args.ranges, retry)
+
+    def processCert(cert, browser=None):
+	try:
+	    if browser is None:
+		browser = newBrowser(cert)
+	    lines = statLines(browser, fast, args.detail, plans.get(cert.repolabel), history, cert.repolabel, errata_db)
+	except Exception, ex:
+	    if not batch:
+		raise
+	    repostats.log.error('Unable to obtain stats for %s: %s: %s', cert.repolabel, ex.__class__.__name__, ex)
+	    failed.append(cert.repolabel)
+	    return
+	with output_lock:
+	    if batch:
+		print 'Repo_Label="{}"'.format(cert.repolabel)
+	    for l in lines:
+		print l
+	    if batch:
+		print
+	    sys.stdout.flush()
+
     try:
-	browser=repostats.cdnbrowser.CdnBrowser(cert.cdn, cert.cert, cert.key, cert.cacert)
-
-	print 'Packages_Updated="{}"'.format(browser.getRepomd().primary_timestamp)
-	print 'Pakcages_ChecksumType="{}"'.format(browser.getRepomd().checksum)
-	if browser.getRepomd().primary_db is not None:
-	    print 'Packages_db_Update="{}"'.format(browser.getRepomd().primary_db_timestamp)
-	# not all repos have errata
-	if browser.getRepomd().errata is not None:
-	    print 'Errata_Updated="{}"'.format(browser.getRepomd().errata_timestamp)
-	    print 'Errata_Total={}'.format(browser.getErrata().value)
-	    for (k,v) in browser.getErrata().types.items():
-		print 'Errata_Type-{}={}'.format(k, v)
-
-	if browser.getRepomd().primary_db is not None:
-	    repostats.log.info("Using primary_db since it's available!")
-	    print 'Packages_Total={}'.format(browser.getPrimaryDb().value)
+	if loop is not None:
+	    # queue up what every repo needs and fetch it all at once, first
+	    # the repomd.xml files and then the files they point at
+	    browsers = [ newBrowser(c) for c in certs ]
+	    for b in browsers:
+		b.start('repomd')
+	    loop.run()
+	    for (c, b) in zip(certs, browsers):
+		try:
+		    plans[c.repolabel] = statKeys(b, fast, args.detail, history, c.repolabel, errata_db)
+		    b.start(*plans[c.repolabel][0])
+		except Exception:
+		    # statLines runs into it again and reports it
+		    pass
+	    loop.run()
+	    for (c, b) in zip(certs, browsers):
+		processCert(c, b)
+	elif batch:
+	    import repostats.pool
+	    repostats.pool.runPool(processCert, certs, args.jobs)
 	else:
-	    print 'Packages_Total={}'.format(browser.getPrimary().value)
+	    processCert(certs[0])
     finally:
-	if browser is not None:
-	    browser.session.close()
+	if cache is not None:
+	    cache.save()
+	if trace_out is not None:
+	    trace_out.close()
+	sessions.close()
+	if parse_pool is not None:
+	    parse_pool.close()
+	if loop is not None:
+	    loop.close()
+    # an exit status is taken mod 256, so a count of failures could wrap to 0
+    return 1 if failed else 0
+
+def runServe(args):
+    certs = findCerts(args)
+    import repostats.cdnbrowser
+    import repostats.serve as serve
+    (cache, store, tracer, trace_out, sessions, retry, history, errata_db, parse_pool) = runState(args)
+    pollers = []
+    for cert in certs:
+	browser = repostats.cdnbrowser.CdnBrowser(cert.cdn, cert.cert, cert.key, cert.cacert, cache, True, False, args.detail, parse_pool, store, tracer, sessions, retry=retry)
+	pollers.append(serve.RepoPoller(cert.repolabel, browser, args.detail, args.interval, args.min_interval, args.max_interval, history, errata_db))
+    exporter = serve.Exporter(pollers, args.jobs, cache, sessions)
+    server = serve.MetricsServer((args.bind, args.port), exporter)
+    exporter.start()
+    repostats.log.warn('Serving stats of %d repos on http://%s:%d/metrics', len(pollers), args.bind, args.port)
+    try:
+	server.serve_forever()
+    finally:
+	server.server_close()
+	if cache is not None:
+	    cache.save()
+	if trace_out is not None:
+	    trace_out.close()
+	sessions.close()
+	if parse_pool is not None:
+	    parse_pool.close()
+
+def runDiff(args):
+    import repostats.history
+    history = repostats.history.History(os.path.join(args.cache_dir, 'history') if args.cache_dir else None)
+    index = history.find(args.repolabel, args.releasever, args.basearch)
+    if args.list:
+	for r in index['revisions']:
+	    print 'Revision={} Recorded="{}" Packages={} Errata={}'.format(r['revision'],
+		    datetime.fromtimestamp(int(r['recorded']), repomd.utc), r['packages'], r['errata'])
+	return
+    (old, new) = (history.select(index, args.old), history.select(index, args.new))
+    (old_rev, new_rev) = (history.open(index, old), history.open(index, new))
+    try:
+	print 'Repo_Label="{}"'.format(args.repolabel)
+	print 'From_Revision={}'.format(old['revision'])
+	print 'To_Revision={}'.format(new['revision'])
+	changes = []
+	for (section, what, one) in (('packages', 'Packages', 'Package'), ('errata', 'Errata', 'Errata')):
+	    (added, removed) = repostats.history.diffSection(old_rev, new_rev, section)
+	    print '{}_Added={}'.format(what, len(added))
+	    print '{}_Removed={}'.format(what, len(removed))
+	    changes.extend([ ('Added_' + one, e) for e in added ] + [ ('Removed_' + one, e) for e in removed ])
+	if not args.counts:
+	    for (k, e) in changes:
+		print u'{}="{}"'.format(k, e).encode('utf-8')
+    finally:
+	old_rev.close()
+	new_rev.close()
+
+def runErrata(args):
+    import re
+    import repostats.erratadb
+    db = repostats.erratadb.ErrataDb(os.path.join(args.cache_dir, 'errata.sqlite') if args.cache_dir else None)
+    labels = list(args.repolabel)
+    if args.filter is not None:
+	labels.extend([ l for l in db.labels() if re.search(args.filter, l) and l not in labels ])
+	if not labels:
+	    raise LookupError('No repolabel in the errata database matched by --filter')
+    query = (labels or None, args.types, args.severities, args.since, args.until)
+    if args.list:
+	for (id, type, severity, issued, updated, title) in db.list(*query):
+	    print u'Errata="{}" Type="{}" Severity="{}" Issued="{}" Updated="{}" Title="{}"'.format(id, type, severity, issued, updated, title).encode('utf-8')
+	return
+    groups = args.per or []
+    name = 'Errata_' + '_'.join(repostats.erratadb.GROUPS[g][1] for g in groups) if groups else 'Errata_Total'
+    for (values, count) in db.count(groups, *query):
+	key = '-'.join([name] + [ unicode(v) for v in values ])
+	print u'{}={}'.format(key, count).encode('utf-8')
 
 def runList(args):
     import repostats.certfinder as certfinder
@@ -112,13 +357,11 @@ def runList(args):
 	if ovr in args_var and args_var[ovr] is not None:
 	    override_map[ovr]=args_var[ovr]
 
-    finder = certfinder.CertFinder(None, None, None, **override_map)
+    finder = certfinder.CertFinder(None, None, None, args.cache_dir, **override_map)
     list = finder.list().keys()
     list.sort()
     if args.filter is not None:
-	import re
-	re_comp = re.compile(args.filter, re.IGNORECASE)
-	list = filter(lambda i: re_comp.search(i) is not None, list)
+	list = finder.filter(args.filter)
     for l in list:
 	print l
 